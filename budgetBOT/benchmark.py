@@ -0,0 +1,700 @@
+"""budgetBOT のベンチマーク・負荷試験
+
+Discordに接続せず、軽量な偽の Interaction / Context / Member を使って
+budgetBOT.py の本物のコマンド・ビューのコードを動かし、処理時間とメモリを計測する。
+一時ディレクトリに config.json とデータを作ってから budgetBOT を読み込むので、手元のデータには触れない。
+
+    python benchmark.py                                  # 既定の規模で実行
+    python benchmark.py --guilds 5000 --approvals 200 --rows 100000
+    python benchmark.py --save-baseline benchmark_baseline.json
+    python benchmark.py --baseline benchmark_baseline.json   # 基準値より遅くなっていたら終了コード1
+
+処理時間はCPUやディスクで大きく変わるので、基準値はリポジトリには置かず、比べるマシンで変更前に --save-baseline して作る。
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from aiohttp import web
+
+from metrics import peak_rss_bytes
+
+from tests.fakes import (
+    FakeGuild, FakeMember, FakeDiscord, FakeChannel, FakeMessage, RecordingChannel, FakeInteraction, FakeContext
+)
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+REVIEWER_ROLE_ID = 1
+
+class LinkPageServer:
+    """商品ページの代わりを返すローカルのHTTPサーバー。ページごとの取得回数と同時接続数の最大を数える"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.hits = {}
+        self.active = 0
+        self.peak = 0
+        self._runner = None
+
+    async def handle(self, request):
+        page = request.match_info["page"]
+        self.hits[page] = self.hits.get(page, 0) + 1
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.active -= 1
+        body = (
+            f'<html><head><meta property="og:title" content="部品 {page}">'
+            f'<meta property="product:price:amount" content="{1000 + int(page):,}"></head><body>{"x" * 20000}</body></html>'
+        )
+        return web.Response(text=body, content_type="text/html")
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_get("/items/{page}", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+# --- Measurement ---
+
+def percentile(samples: list, q: float) -> float:
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def summarize(samples: list, elapsed: float, **extra) -> dict:
+    """1回ごとの所要時間 (秒) から結果をまとめる。時間はミリ秒で記録する"""
+    return {
+        "ops": len(samples),
+        "throughput": len(samples) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": max(samples, default=0.0) * 1000,
+        **extra
+    }
+
+async def timed_call(samples: list, coro):
+    started = time.perf_counter()
+    result = await coro
+    samples.append(time.perf_counter() - started)
+    return result
+
+class MemoryProbe:
+    """シナリオ中のPythonのメモリ確保量のピークを測る"""
+
+    def __enter__(self):
+        tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc):
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.peak_kib = peak / 1024
+
+# --- Scenarios ---
+
+async def bench_load_guild_data(bb, args) -> dict:
+    """多数のサーバーのデータを読み込む (初回はストレージから、2回目はキャッシュから)"""
+    guild_ids = list(range(1, args.guilds + 1))
+    for guild_id in guild_ids:
+        bb.storage.append_ledger(guild_id, [], bb.ledger_snapshot(0, {f"予算{i}": 100000 for i in range(5)}))
+        bb.storage.save_channels(guild_id, [guild_id * 10])
+        bb.storage.save_settings(guild_id, {"additional_roles": [REVIEWER_ROLE_ID], "no_overdraft": False})
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def load(samples, guild_id):
+        async with semaphore:
+            await timed_call(samples, bb.load_guild_data(guild_id))
+
+    results = {}
+    for phase in ("cold", "warm"):
+        samples = []
+        with MemoryProbe() as memory:
+            started = time.perf_counter()
+            await asyncio.gather(*(load(samples, guild_id) for guild_id in guild_ids))
+            elapsed = time.perf_counter() - started
+        results[phase] = summarize(samples, elapsed, peak_kib=memory.peak_kib)
+    results["cold"]["cache_kib"] = bb.guild_data.total_bytes / 1024
+    return results
+
+async def bench_save(bb, args) -> dict:
+    """保存関数で書き込みを予約し、書き出しまでにかかる時間を測る"""
+    guild_ids = list(range(1, min(args.guilds, args.save_guilds) + 1))
+    samples = []
+    writes = 0
+    with MemoryProbe() as memory:
+        started = time.perf_counter()
+        for round_no in range(args.save_rounds):
+            for guild_id in guild_ids:
+                data = await bb.load_guild_data(guild_id)
+                bb.post_ledger_entry(guild_id, data, "予算0", 1, "credit")
+                bb.save_settings(guild_id, data)
+                writes += 2
+            await timed_call(samples, bb.persistence.flush())
+        elapsed = time.perf_counter() - started
+    result = summarize(samples, elapsed, peak_kib=memory.peak_kib)
+    # ここでの1回は1ラウンド分のフラッシュなので、書き込み件数の処理量も出しておく
+    result["writes_per_second"] = writes / elapsed if elapsed else 0.0
+    return result
+
+async def bench_finalize_approval(bb, api, args) -> dict:
+    """同じ予算への一括承認を同時に送り、二重押しも混ぜて二重引き落としが起きないか確かめる"""
+    guild_id = args.guilds + 1
+    guild = FakeGuild(guild_id)
+    channel = FakeChannel(api, guild_id * 10)
+    reviewer = FakeMember(2, guild, [REVIEWER_ROLE_ID])
+    applicant = FakeMember(3, guild)
+    data = await bb.load_guild_data(guild_id)
+    initial_balance = 10 ** 9
+    bb.post_ledger_entry(guild_id, data, "備品", initial_balance, "credit")
+
+    requests = []
+    expected_total = 0
+    for i in range(args.approvals):
+        items = [bb.RequestItem(f"部品{i}-{j}", "", 100 + j, 2) for j in range(args.items_per_request)]
+        expected_total += sum(item.amount for item in items)
+        request = await bb.open_pending_request(applicant.id, applicant.display_name, applicant.display_avatar.url, guild_id, items, "備品")
+        await bb.attach_request_message(request, FakeMessage(api, channel))
+        requests.append(request)
+
+    async def click(request):
+        button = bb.ApprovalButton("approve", guild_id, request.request_id)
+        interaction = FakeInteraction(api, reviewer, FakeMessage(api, channel))
+        if await button.interaction_check(interaction):
+            await button.callback(interaction)
+
+    samples = []
+    with MemoryProbe() as memory:
+        started = time.perf_counter()
+        # 1件につき2回ずつ押す
+        clicks = [request for request in requests for _ in range(2)]
+        random.Random(0).shuffle(clicks)
+        await asyncio.gather(*(timed_call(samples, click(request)) for request in clicks))
+        elapsed = time.perf_counter() - started
+    await bb.outbound.drain()
+    await bb.persistence.flush()
+
+    debited = initial_balance - data["budgets"]["備品"]
+    # 申請ごとの台帳の取引がちょうど1件ずつあるか
+    decisions = {}
+    for entry in bb.storage.iter_ledger(guild_id):
+        if entry["request_id"] is not None:
+            decisions[entry["request_id"]] = decisions.get(entry["request_id"], 0) + 1
+    applied = sum(1 for request in requests if decisions.get(request.request_id) == 1)
+    correct = debited == expected_total and applied == len(decisions) == len(requests) and not data["pending_requests"]
+    return summarize(samples, elapsed, peak_kib=memory.peak_kib, correct=correct, applied=applied,
+                     debited=debited, expected=expected_total)
+
+async def bench_pending_requests(bb, args) -> dict:
+    """審査待ちの申請1件あたりのメモリと、メモリから外した申請をボタンから読み直す時間を測る"""
+    guild_id = args.guilds + 3
+    applicant = FakeMember(3, FakeGuild(guild_id))
+    data = await bb.load_guild_data(guild_id)
+    await bb.persistence.flush()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    request_ids = []
+    for i in range(args.pending):
+        items = [
+            bb.RequestItem(f"部品{i}-{j}", f"https://example.com/items/{i}/{j}", 100 + j, 2)
+            for j in range(args.items_per_request)
+        ]
+        request = await bb.open_pending_request(applicant.id, applicant.display_name, applicant.display_avatar.url, guild_id, items, "備品")
+        request_ids.append(request.request_id)
+    # 書き込み待ち・書き込み中の分を除いて、申請そのものが占める量を測る
+    while bb.persistence.pending_count():
+        await bb.persistence.flush()
+        await asyncio.sleep(0.01)
+    loaded = tracemalloc.get_traced_memory()[0]
+    evicted = bb.dormant_requests.sweep(time.monotonic() + bb.dormant_requests.idle_seconds)
+    dormant = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    samples = []
+    random.Random(0).shuffle(request_ids)
+    with MemoryProbe() as memory:
+        started = time.perf_counter()
+        for request_id in request_ids:
+            await timed_call(samples, bb.get_pending_request(guild_id, request_id))
+        elapsed = time.perf_counter() - started
+    rehydrated = sum(1 for request_id in request_ids if data["pending_requests"][request_id] is not None)
+    return summarize(
+        samples, elapsed, peak_kib=memory.peak_kib, evicted=evicted, rehydrated=rehydrated,
+        bytes_per_request=(loaded - before) / args.pending if args.pending else 0.0,
+        dormant_bytes_per_request=(dormant - before) / args.pending if args.pending else 0.0
+    )
+
+async def bench_pending_list(bb, api, args) -> dict:
+    """審査待ちの申請が多いサーバーで !pending の一覧を絞り込み・並べ替えを変えて出す"""
+    guild_id = args.guilds + 3
+    reviewer = FakeMember(2, FakeGuild(guild_id), [REVIEWER_ROLE_ID])
+    ctx = FakeContext(api, reviewer, FakeChannel(api, guild_id * 10))
+    variants = [{"sort": sort} for sort in bb.PENDING_SORTS] + [{"budget": "備品", "min_amount": 500}, {"applicant": "member", "days": 0}]
+    samples = []
+    with MemoryProbe() as memory:
+        started = time.perf_counter()
+        for _ in range(args.export_runs):
+            for variant in variants:
+                flags = bb.PendingFlags.__new__(bb.PendingFlags)
+                for flag in bb.PendingFlags.get_flags().values():
+                    setattr(flags, flag.attribute, variant.get(flag.attribute, flag.default))
+                await timed_call(samples, bb.pending(ctx, flags=flags))
+        elapsed = time.perf_counter() - started
+    return summarize(samples, elapsed, peak_kib=memory.peak_kib)
+
+async def bench_export_csv(bb, api, args) -> dict:
+    """大量の審査記録を !export_csv で書き出す"""
+    guild_id = args.guilds + 2
+    guild = FakeGuild(guild_id)
+    reviewer = FakeMember(2, guild, [REVIEWER_ROLE_ID])
+    rng = random.Random(0)
+    batch = []
+    for i in range(args.rows):
+        amount = rng.randrange(100, 50000)
+        batch.append({
+            "applicant": f"member-{i % 50}", "name": f"部品{i}", "link": "https://example.com/item",
+            "unit_price": amount, "quantity": 1, "amount": amount,
+            "result": "承認" if i % 4 else "却下", "approver": "member-2",
+            "budget_name": f"予算{i % 8}", "created_at": f"2025-{i % 12 + 1:02d}-15T12:00:00"
+        })
+        if len(batch) == 5000:
+            bb.storage.append_review_rows(guild_id, batch)
+            batch = []
+    if batch:
+        bb.storage.append_review_rows(guild_id, batch)
+    bb.storage.sync_review_logs()
+
+    results = {}
+    for file_format in ("csv", "gzip"):
+        samples = []
+        ctx = FakeContext(api, reviewer, FakeChannel(api, guild_id * 10))
+        flags = bb.ExportFlags.__new__(bb.ExportFlags)
+        for flag in bb.ExportFlags.get_flags().values():
+            setattr(flags, flag.attribute, flag.default)
+        flags.file_format = file_format
+        with MemoryProbe() as memory:
+            started = time.perf_counter()
+            for _ in range(args.export_runs):
+                ctx.files.clear()
+                await timed_call(samples, bb.export_csv(ctx, flags=flags))
+            elapsed = time.perf_counter() - started
+        output_bytes = sum(len(file.fp.getbuffer()) for file in ctx.files)
+        results[file_format] = summarize(
+            samples, elapsed, peak_kib=memory.peak_kib, parts=len(ctx.files),
+            rows_per_second=args.rows * len(samples) / elapsed if elapsed else 0.0,
+            output_kib=output_bytes / 1024
+        )
+    return results
+
+HISTORY_DOMAINS = ("partscabi.net", "shop.example.com", "www.amazon.co.jp", "akizukidenshi.com", "")
+HISTORY_QUERIES = (
+    {"domain": "partscabi.net", "approver": "member-3", "budget": "F3EC"},
+    {"domain": "example.com", "result": "承認"},
+    {"applicant": "member-7"},
+    {"keyword": "ネジ", "budget": "予算2"},
+    {"keyword": "モーター部品", "result": "却下"},
+)
+
+async def bench_history(bb, api, args) -> dict:
+    """数十万行の審査記録から !history で絞り込む。初回の索引作りと、その後の検索を分けて測る"""
+    guild_id = args.guilds + 4
+    guild = FakeGuild(guild_id)
+    reviewer = FakeMember(2, guild, [REVIEWER_ROLE_ID])
+    rng = random.Random(1)
+    names = ("M3ネジ", "モーター部品", "ケーブル", "はんだ", "アルミフレーム", "センサー基板")
+    records = []
+    for i in range(args.rows):
+        amount = rng.randrange(100, 50000)
+        domain = rng.choice(HISTORY_DOMAINS)
+        records.append({
+            "applicant": f"member-{i % 50}", "name": f"{rng.choice(names)} {i}", "link": f"https://{domain}/items/{i}" if domain else "",
+            "unit_price": amount, "quantity": 1, "amount": amount,
+            "result": "承認" if i % 4 else "却下", "approver": f"member-{i % 7}",
+            "budget_name": "F3EC" if i % 5 == 0 else f"予算{i % 8}", "created_at": f"2025-{i % 12 + 1:02d}-15T12:00:00"
+        })
+    for start in range(0, len(records), 5000):
+        bb.storage.append_review_rows(guild_id, records[start:start + 5000])
+    bb.storage.sync_review_logs()
+
+    ctx = FakeContext(api, reviewer, FakeChannel(api, guild_id * 10))
+
+    def make_flags(values: dict):
+        flags = bb.HistoryFlags.__new__(bb.HistoryFlags)
+        for flag in bb.HistoryFlags.get_flags().values():
+            setattr(flags, flag.attribute, values.get(flag.attribute, flag.default))
+        return flags
+
+    build_samples = []
+    with MemoryProbe() as memory:
+        started = time.perf_counter()
+        await timed_call(build_samples, bb.history(ctx, flags=make_flags({"applicant": "member-1"})))
+        build_elapsed = time.perf_counter() - started
+    build = summarize(build_samples, build_elapsed, peak_kib=memory.peak_kib)
+
+    samples = []
+    with MemoryProbe() as memory:
+        started = time.perf_counter()
+        for _ in range(args.export_runs):
+            for query in HISTORY_QUERIES:
+                await timed_call(samples, bb.history(ctx, flags=make_flags(query)))
+        elapsed = time.perf_counter() - started
+
+    # 索引の件数が審査記録を素直に絞り込んだ件数と一致するか
+    index = await bb.review_search.get(guild_id)
+    correct = True
+    for query in HISTORY_QUERIES:
+        terms, keywords = bb.history_query(make_flags(query))
+        expected = sum(
+            1 for record in records
+            if (query.get("applicant") is None or record["applicant"] == query["applicant"])
+            and (query.get("approver") is None or record["approver"] == query["approver"])
+            and (query.get("budget") is None or record["budget_name"] == query["budget"])
+            and (query.get("result") is None or record["result"] == query["result"])
+            and (query.get("domain") is None or query["domain"] in record["link"])
+            and all(keyword in bb.normalize_search_key(record["name"]) for keyword in keywords)
+        )
+        candidates = index.search(terms)
+        # 3文字以上のキーワードは候補が多めに出ることがあるので、読んで確かめた件数で比べる
+        matched = [
+            record for record in bb.storage.read_review_rows(guild_id, [index.locators[row] for row in candidates])
+            if all(keyword in bb.normalize_search_key(record["name"]) for keyword in keywords)
+        ]
+        correct = correct and len(matched) == expected
+    return {
+        "build": build,
+        "query": summarize(samples, elapsed, peak_kib=memory.peak_kib, correct=correct, index_kib=index.estimate_size() / 1024),
+    }
+
+async def bench_snapshot(bb, args) -> dict:
+    """ここまでのシナリオで作った data/ のスナップショットを取る。
+    初回 (全体) と、一部のサーバーを変更して審査記録を追記した後 (増分) を比べ、書き戻しと検証も測る"""
+    loop = asyncio.get_running_loop()
+    results = {}
+    with MemoryProbe() as memory:
+        samples = []
+        started = time.perf_counter()
+        _, stats = await timed_call(samples, bb.snapshots.take())
+        elapsed = time.perf_counter() - started
+    results["full"] = summarize(samples, elapsed, peak_kib=memory.peak_kib, stored_kib=stats["stored_bytes"] / 1024)
+
+    for guild_id in range(1, min(args.guilds, args.save_guilds) + 1):
+        data = await bb.load_guild_data(guild_id)
+        bb.post_ledger_entry(guild_id, data, "予算0", 1, "credit")
+    history_guild_id = args.guilds + 4
+    bb.review_log.append(history_guild_id, [{
+        "applicant": "member-1", "name": f"追加 {i}", "link": "", "unit_price": 100, "quantity": 1, "amount": 100,
+        "result": "承認", "approver": "member-2", "budget_name": "予算0", "created_at": "2026-01-15T12:00:00"
+    } for i in range(1000)])
+    with MemoryProbe() as memory:
+        samples = []
+        started = time.perf_counter()
+        name, stats = await timed_call(samples, bb.snapshots.take())
+        elapsed = time.perf_counter() - started
+    results["incremental"] = summarize(
+        samples, elapsed, peak_kib=memory.peak_kib, stored_kib=stats["stored_bytes"] / 1024, read_kib=stats["read_bytes"] / 1024
+    )
+
+    restore_dir = os.path.join(os.getcwd(), "restored")
+    restore_db = os.path.join(restore_dir, os.path.basename(bb.SQLITE_PATH)) if args.backend == "sqlite" else None
+    for phase, job in (
+        ("restore", lambda: bb.restore_snapshot(bb.SNAPSHOT_DIR, name, restore_dir, restore_db)),
+        ("verify", lambda: bb.verify_snapshots(bb.SNAPSHOT_DIR, [name])),
+    ):
+        with MemoryProbe() as memory:
+            samples = []
+            started = time.perf_counter()
+            outcome = await timed_call(samples, loop.run_in_executor(None, job))
+            elapsed = time.perf_counter() - started
+        results[phase] = summarize(samples, elapsed, peak_kib=memory.peak_kib)
+    results["verify"]["correct"] = not outcome
+    return results
+
+async def bench_link_preview(bb, api, args) -> dict:
+    """同じ商品ページのリンクを含む !send を繰り返し、リンク先を手元のHTTPサーバーから読み込む。
+    申請が読み込みを待たないこと、読み込みがページごとに1回・同時接続数の上限内に収まること、
+    再起動後はディスクのキャッシュから読めることを確かめる"""
+    server = LinkPageServer(args.link_latency_ms / 1000)
+    base_url = await server.start()
+    store_path = os.path.join(os.getcwd(), "link_previews.sqlite3")
+
+    def make_resolver():
+        return bb.LinkPreviewResolver(
+            bb.LinkPreviewStore(store_path), bb.LINK_PREVIEW_CACHE_SIZE, bb.LINK_PREVIEW_TTL,
+            bb.LINK_PREVIEW_CONCURRENCY, bb.LINK_PREVIEW_PER_HOST, bb.LINK_PREVIEW_TIMEOUT, True
+        )
+
+    # ほかのシナリオがリンク先を読みに行かないよう、このシナリオの間だけ有効にする
+    bb.LINK_PREVIEW = True
+    bb.link_previews = make_resolver()
+    bb.link_previews.start()
+    try:
+        guild_id = args.guilds + 5
+        bb.storage.append_ledger(guild_id, [], bb.ledger_snapshot(0, {"予算0": 10 ** 12}))
+        applicant = FakeMember(3, FakeGuild(guild_id))
+        messages = []
+        rng = random.Random(3)
+        pages = [rng.randrange(args.link_pages) for _ in range(args.link_requests)]
+        samples = []
+        with MemoryProbe() as memory:
+            started = time.perf_counter()
+            for i, page in enumerate(pages):
+                link = f"{base_url}/items/{page}?utm_source=discord&ref={i % 2}"
+                # チャンネルごとの送信の間隔調整で待たないよう、申請ごとに別のチャンネルに送る
+                ctx = FakeContext(api, applicant, RecordingChannel(api, guild_id * 100000 + i, messages))
+                await timed_call(samples, bb.send(ctx, f"member-{i % 50}", f"部品 {page}", link, 1000 + page, "予算0"))
+            elapsed = time.perf_counter() - started
+            while bb.link_previews.pending_count():
+                await asyncio.sleep(0.01)
+            await bb.outbound.drain()
+        send = summarize(samples, elapsed, peak_kib=memory.peak_kib)
+        requested = {(page, i % 2) for i, page in enumerate(pages)}
+        send["fetches"] = bb.link_previews.fetches
+        send["edited"] = sum(1 for message in messages if message.edits)
+        send["peak_connections"] = server.peak
+        send["correct"] = (
+            bb.link_previews.fetches == len(requested)
+            and bb.link_previews.failures == 0
+            and server.peak <= bb.LINK_PREVIEW_CONCURRENCY
+            and all(
+                bb.link_previews.peek(f"{base_url}/items/{page}?ref={ref}").price == 1000 + page
+                for page, ref in requested
+            )
+        )
+
+        results = {"send": send}
+        for phase in ("memory", "disk"):
+            if phase == "disk":
+                # 再起動した想定で、メモリが空の状態から読む
+                await bb.link_previews.close()
+                bb.link_previews = make_resolver()
+                bb.link_previews.start()
+            samples = []
+            with MemoryProbe() as memory:
+                started = time.perf_counter()
+                for page, ref in sorted(requested):
+                    await timed_call(samples, bb.link_previews.resolve(f"{base_url}/items/{page}?ref={ref}"))
+                elapsed = time.perf_counter() - started
+            results[phase] = summarize(
+                samples, elapsed, peak_kib=memory.peak_kib,
+                hits=bb.link_previews.hits if phase == "memory" else bb.link_previews.disk_hits, fetches=bb.link_previews.fetches
+            )
+        return results
+    finally:
+        bb.LINK_PREVIEW = False
+        await bb.link_previews.close()
+        await server.stop()
+
+# --- Runner ---
+
+def load_bot_module(workdir: str, args):
+    """一時ディレクトリに config.json を作ってから budgetBOT を読み込む"""
+    config = {
+        "TOKEN": "benchmark",
+        "ALLOWED_ROLE_ID": REVIEWER_ROLE_ID,
+        "STORAGE_BACKEND": args.backend,
+        "PERSIST_DELAY": 0.05,
+        "GUILD_CACHE_MAX_GUILDS": args.guilds + 10,
+        # メモリから外す処理はシナリオの中で直接呼ぶ
+        "PENDING_REQUEST_IDLE_SECONDS": 3600,
+    }
+    with open(os.path.join(workdir, "config.json"), "w", encoding="utf-8") as f:
+        json.dump(config, f)
+    os.chdir(workdir)
+    sys.path.insert(0, BOT_DIR)
+    return importlib.import_module("budgetBOT")
+
+async def run(args) -> dict:
+    with tempfile.TemporaryDirectory(prefix="budgetbot-bench-") as workdir:
+        cwd = os.getcwd()
+        bb = load_bot_module(workdir, args)
+        api = FakeDiscord(args.latency_ms / 1000)
+        bb.persistence.start()
+        bb.review_log.start()
+        try:
+            scenarios = {}
+            scenarios["load_guild_data"] = await bench_load_guild_data(bb, args)
+            scenarios["save"] = await bench_save(bb, args)
+            scenarios["finalize_approval"] = await bench_finalize_approval(bb, api, args)
+            scenarios["pending_requests"] = await bench_pending_requests(bb, args)
+            scenarios["pending_list"] = await bench_pending_list(bb, api, args)
+            scenarios["export_csv"] = await bench_export_csv(bb, api, args)
+            scenarios["history"] = await bench_history(bb, api, args)
+            scenarios["link_preview"] = await bench_link_preview(bb, api, args)
+            scenarios["snapshot"] = await bench_snapshot(bb, args)
+        finally:
+            await bb.outbound.drain()
+            await bb.persistence.drain()
+            await bb.review_log.drain()
+            bb.storage.close()
+            os.chdir(cwd)
+    rss = peak_rss_bytes()
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            # 基準値は作ったマシンでだけ比べられる
+            "host": platform.node(),
+            "backend": args.backend,
+            "guilds": args.guilds,
+            "approvals": args.approvals,
+            "pending": args.pending,
+            "rows": args.rows,
+            "latency_ms": args.latency_ms,
+        },
+        "scenarios": scenarios,
+        # ru_maxrss の単位はOSで違うので、KiBにそろえて保存する
+        "max_rss_kib": rss // 1024 if rss is not None else None,
+    }
+
+def flatten(scenarios: dict, prefix: str = "") -> dict:
+    """{"export_csv": {"csv": {...}}} を {"export_csv.csv": {...}} にする"""
+    flat = {}
+    for name, value in scenarios.items():
+        if "ops" in value:
+            flat[prefix + name] = value
+        else:
+            flat.update(flatten(value, f"{prefix}{name}."))
+    return flat
+
+def print_report(results: dict):
+    print(f"{'scenario':<28}{'ops':>8}{'ops/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'peak KiB':>12}")
+    for name, result in flatten(results["scenarios"]).items():
+        print(
+            f"{name:<28}{result['ops']:>8}{result['throughput']:>12.1f}{result['p50_ms']:>10.2f}"
+            f"{result['p99_ms']:>10.2f}{result['max_ms']:>10.2f}{result['peak_kib']:>12.0f}"
+        )
+    approval = results["scenarios"]["finalize_approval"]
+    status = "OK" if approval["correct"] else "NG"
+    print(f"finalize_approval correctness: {status} (applied {approval['applied']}, debited ¥{approval['debited']:,} / expected ¥{approval['expected']:,})")
+    pending = results["scenarios"].get("pending_requests")
+    if pending is not None:
+        print(
+            f"pending requests: {pending['bytes_per_request']:.0f} B/request in memory, "
+            f"{pending['dormant_bytes_per_request']:.0f} B/request after eviction ({pending['evicted']} evicted, {pending['rehydrated']} rehydrated)"
+        )
+    history = results["scenarios"].get("history")
+    if history is not None:
+        status = "OK" if history["query"]["correct"] else "NG"
+        print(f"history: index {history['query']['index_kib']:,.0f} KiB, built in {history['build']['p50_ms']:.0f} ms, results {status}")
+    link_preview = results["scenarios"].get("link_preview")
+    if link_preview is not None:
+        send = link_preview["send"]
+        status = "OK" if send["correct"] else "NG"
+        print(
+            f"link preview: {send['fetches']} fetches for {send['ops']} requests, {send['edited']} embeds updated, "
+            f"peak {send['peak_connections']} connections, restart {link_preview['disk']['fetches']} fetches, results {status}"
+        )
+    snapshot = results["scenarios"].get("snapshot")
+    if snapshot is not None:
+        status = "OK" if snapshot["verify"]["correct"] else "NG"
+        print(
+            f"snapshot: full {snapshot['full']['stored_kib']:,.0f} KiB stored, "
+            f"incremental {snapshot['incremental']['stored_kib']:,.0f} KiB stored / {snapshot['incremental']['read_kib']:,.0f} KiB read, verify {status}"
+        )
+    rss = results["max_rss_kib"]
+    print(f"max RSS: {rss:,} KiB" if rss is not None else "max RSS: 不明")
+
+# 結果を確かめるシナリオと、その結果が正しいかどうかの場所
+CORRECTNESS_CHECKS = (
+    ("finalize_approval", lambda result: result["correct"]),
+    ("history", lambda result: result["query"]["correct"]),
+    ("link_preview", lambda result: result["send"]["correct"]),
+    ("snapshot", lambda result: result["verify"]["correct"]),
+)
+
+def correctness_failures(results: dict) -> list:
+    """結果が正しくなかったシナリオの名前を返す (実行しなかったシナリオは数えない)"""
+    return [
+        name for name, check in CORRECTNESS_CHECKS
+        if name in results["scenarios"] and not check(results["scenarios"][name])
+    ]
+
+def compare_with_baseline(results: dict, baseline: dict, threshold: float) -> list:
+    """基準値より threshold の割合以上悪化した項目を返す"""
+    regressions = []
+    current = flatten(results["scenarios"])
+    for name, base in flatten(baseline["scenarios"]).items():
+        result = current.get(name)
+        if result is None:
+            continue
+        for key in ("p50_ms", "p99_ms"):
+            if base[key] > 0 and result[key] > base[key] * (1 + threshold):
+                regressions.append(f"{name} {key}: {base[key]:.2f} -> {result[key]:.2f}")
+        if base["throughput"] > 0 and result["throughput"] < base["throughput"] * (1 - threshold):
+            regressions.append(f"{name} throughput: {base['throughput']:.1f} -> {result['throughput']:.1f}")
+    return regressions
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="budgetBOT のベンチマーク")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--guilds", type=int, default=5000, help="読み込むサーバー数")
+    parser.add_argument("--concurrency", type=int, default=64, help="同時に読み込むサーバー数")
+    parser.add_argument("--save-guilds", type=int, default=500, help="保存のシナリオで書き込むサーバー数")
+    parser.add_argument("--save-rounds", type=int, default=10)
+    parser.add_argument("--approvals", type=int, default=200, help="同時に承認する申請数")
+    parser.add_argument("--items-per-request", type=int, default=5)
+    parser.add_argument("--pending", type=int, default=10000, help="メモリ使用量を測る審査待ちの申請数")
+    parser.add_argument("--rows", type=int, default=100000, help="エクスポートする審査記録の行数")
+    parser.add_argument("--export-runs", type=int, default=3)
+    parser.add_argument("--link-requests", type=int, default=500, help="リンク付きで送る申請の数")
+    parser.add_argument("--link-pages", type=int, default=50, help="申請に使う商品ページの種類")
+    parser.add_argument("--link-latency-ms", type=float, default=50.0, help="手元の商品ページの応答にかける時間")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="偽のDiscord APIの応答にかける時間")
+    parser.add_argument("--output", help="結果をJSONで保存する")
+    parser.add_argument("--baseline", help="比較する基準値のJSON")
+    parser.add_argument("--save-baseline", help="今回の結果を基準値として保存する")
+    parser.add_argument("--threshold", type=float, default=0.2, help="悪化とみなす割合 (既定 20%%)")
+    args = parser.parse_args(argv)
+
+    # 一時ディレクトリに移動する前にパスを確定させておく
+    for name in ("output", "baseline", "save_baseline"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    results = asyncio.run(run(args))
+    print_report(results)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+
+    exit_code = 0
+    for name in correctness_failures(results):
+        print(f"❌ {name}: 結果が正しくありません")
+        exit_code = 1
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"基準値 ({baseline['environment'].get('host', '不明なマシン')} で保存) と比較します。")
+        if baseline["environment"] != results["environment"]:
+            print("⚠️ 基準値と実行条件またはマシンが異なります。比較結果は参考値です (このマシンで --save-baseline し直してください)。")
+        regressions = compare_with_baseline(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"❌ {regression}")
+        if regressions:
+            exit_code = 1
+        else:
+            print("✅ 基準値からの悪化はありません。")
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,53 @@
 import discord
-from discord import ui
+from discord import ui, app_commands
 from discord.ext import commands
+import asyncio
 import csv
 import os
 import json
+import datetime
+import gzip
+import io
+import sys
+import argparse
+import contextlib
+import time
+import secrets
+import weakref
+import functools
+import math
+import itertools
+from array import array
+from collections import OrderedDict, deque
+
+from embeds import (
+    EMBED_FIELD_LIMIT, EMBED_NAME_LIMIT, SELECT_OPTION_LIMIT, SELECT_TEXT_LIMIT, ItemListRenderer, clip_text,
+    page_footer, paginate_lines, render_result_line
+)
+from guild_cache import GuildCache
+from link_preview import LinkPreviewResolver, LinkPreviewStore, format_link_preview
+from metrics import instrument_http, metrics, process_rss_bytes, start_metrics_server, timed
+from outbound import OutboundDispatcher
+from permissions import PermissionCache
+from search import BUDGET_SUGGESTION_LIMIT, ReviewSearchIndex, bigrams, budget_index, link_domains, normalize_search_key
+from snapshots import (
+    SnapshotScheduler, create_snapshot, format_snapshot_stats, list_snapshots, load_snapshot_manifest, prune_snapshots,
+    restore_snapshot, verify_snapshots
+)
+from storage import (
+    AGGREGATE_DIMENSIONS, PENDING_SORTS, REVIEW_LOG_HEADER, JsonStorage, PendingRequest, PendingSummary, RequestItem,
+    SqliteStorage, add_to_aggregates, apply_ledger_entry, ledger_snapshot, ledger_time_visible, migrate_json_to_sqlite,
+    new_aggregates, now_timestamp, replay_ledger, review_row_to_csv
+)
+from write_behind import ReviewLogWriter, WriteBehindQueue
+
+try:
+    import openpyxl  # XLSX形式のエクスポートにのみ使用 (任意)
+except ImportError:
+    openpyxl = None
+
+# 起動から準備完了までの時間の計測用
+PROCESS_STARTED_AT = time.perf_counter()
 
 # --- Bot and File Configuration ---
 intents = discord.Intents.default()
@@ -12,7 +56,46 @@ intents.message_content = True
 intents.reactions = True
 intents.members = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+class BudgetBot(commands.AutoShardedBot):
+    async def setup_hook(self):
+        persistence.start()
+        review_log.start()
+        dormant_requests.start()
+        if LINK_PREVIEW:
+            link_previews.start()
+        if CLUSTER_ID == 0:
+            # data/ は全クラスタで共有しているので、スナップショットはクラスタ0だけが取る
+            snapshots.start()
+        self.startup_seconds = None
+        # 審査待ちの申請のボタンはcustom_idから申請を引くので、ビューを個別に作り直す必要はない
+        self.add_dynamic_items(ApprovalButton, RequestPageButton)
+        instrument_http(self.http, "rest")
+        try:
+            # インタラクションへの応答はWebhook用のアダプターから送られる
+            from discord.webhook.async_ import async_context
+            instrument_http(async_context.get(), "webhook")
+        except (ImportError, AttributeError):
+            pass
+        if SYNC_APP_COMMANDS and CLUSTER_ID == 0:
+            # スラッシュコマンドの登録はクラスタ0だけが行う
+            await self.tree.sync()
+        self.metrics_runner = None
+        if METRICS_PORT is not None:
+            # クラスタごとに別のポートで公開する
+            self.metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT + CLUSTER_ID, collect_metric_samples)
+
+    async def close(self):
+        # 終了前に送信待ちのメッセージと未保存の変更をすべて書き出す
+        await outbound.drain()
+        dormant_requests.stop()
+        snapshots.stop()
+        await link_previews.close()
+        await persistence.drain()
+        await review_log.drain()
+        if getattr(self, "metrics_runner", None) is not None:
+            await self.metrics_runner.cleanup()
+        storage.close()
+        await super().close()
 
 # --- Load Configuration ---
 with open("config.json", "r", encoding="utf-8") as config_file:
@@ -20,109 +103,698 @@ with open("config.json", "r", encoding="utf-8") as config_file:
 
 TOKEN = config["TOKEN"]
 ALLOWED_ROLE_ID = config.get("ALLOWED_ROLE_ID")
+PERSIST_DELAY = config.get("PERSIST_DELAY", 1.0)  # 変更をまとめて書き出すまでの待ち時間(秒)
+GUILD_CACHE_MAX_GUILDS = config.get("GUILD_CACHE_MAX_GUILDS", 1000)  # メモリに保持するサーバー数の上限
+GUILD_CACHE_MAX_BYTES = config.get("GUILD_CACHE_MAX_BYTES")  # メモリ使用量の上限 (バイト, 未設定なら無制限)
+PERMISSION_CACHE_MAX_ENTRIES = config.get("PERMISSION_CACHE_MAX_ENTRIES", 10000)  # 会計権限の判定結果を覚えておく (サーバー, メンバー) の数
+REVIEW_SEARCH_MAX_GUILDS = config.get("REVIEW_SEARCH_MAX_GUILDS", 8)  # !history の索引をメモリに保持するサーバー数
+PENDING_REQUEST_IDLE_SECONDS = config.get("PENDING_REQUEST_IDLE_SECONDS", 3600)  # この秒数操作されなかった審査待ちの申請はメモリから外す (Noneなら外さない)
+PRELOAD_CONCURRENCY = config.get("PRELOAD_CONCURRENCY", 8)  # 起動時に並列で読み込むサーバー数
+LEDGER_SNAPSHOT_INTERVAL = config.get("LEDGER_SNAPSHOT_INTERVAL", 1000)  # 予算の取引がこの件数たまるごとに残高のスナップショットを取る
+REVIEW_LOG_BATCH_DELAY = config.get("REVIEW_LOG_BATCH_DELAY", 0.2)  # 審査記録をまとめて書き込むまでの待ち時間(秒)
+REVIEW_LOG_BATCH_MAX_ROWS = config.get("REVIEW_LOG_BATCH_MAX_ROWS", 500)  # この行数がたまったら待たずに書き込む
+REVIEW_LOG_FSYNC = config.get("REVIEW_LOG_FSYNC", "batch")  # "batch" (書き込みごと) / "interval" / "none"
+REVIEW_LOG_FSYNC_INTERVAL = config.get("REVIEW_LOG_FSYNC_INTERVAL", 5.0)  # "interval" のときのfsync間隔(秒)
+REVIEW_LOG_ROTATE = config.get("REVIEW_LOG_ROTATE", "none")  # "none" / "month" (月ごと) / "size" (REVIEW_LOG_MAX_BYTESごと)
+REVIEW_LOG_MAX_BYTES = config.get("REVIEW_LOG_MAX_BYTES", 8 * 1024 * 1024)
+REVIEW_LOG_MAX_OPEN_FILES = config.get("REVIEW_LOG_MAX_OPEN_FILES", 64)  # 開いたままにしておく審査記録ファイルの数
+METRICS_HOST = config.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = config.get("METRICS_PORT")  # Prometheus形式のメトリクスを公開するポート (未設定なら公開しない)
+OUTBOUND_CHANNEL_RATE = config.get("OUTBOUND_CHANNEL_RATE", 5)  # 1チャンネルへの送信・編集の回数の上限 (OUTBOUND_CHANNEL_PER 秒あたり)
+OUTBOUND_CHANNEL_PER = config.get("OUTBOUND_CHANNEL_PER", 5.0)
+SYNC_APP_COMMANDS = config.get("SYNC_APP_COMMANDS", True)  # 起動時にスラッシュコマンドをDiscordに登録する
+LOW_MEMORY_MODE = config.get("LOW_MEMORY_MODE", False)  # メンバー・メッセージ本文のインテントを使わず、メンバーをキャッシュしない
+SLOW_CALL_THRESHOLD = config.get("SLOW_CALL_THRESHOLD")  # この秒数以上かかった処理をログに出す (未設定なら出さない)
+EXPORT_PART_MAX_BYTES = config.get("EXPORT_PART_MAX_BYTES")  # エクスポート1ファイルの上限 (未設定ならサーバーのアップロード上限)
+LINK_PREVIEW = config.get("LINK_PREVIEW", False)  # 申請の参考リンクを読み込み、ページのタイトルと価格を審査用の表示に添える
+LINK_PREVIEW_CONCURRENCY = config.get("LINK_PREVIEW_CONCURRENCY", 8)  # 同時に読み込むリンクの数
+LINK_PREVIEW_PER_HOST = config.get("LINK_PREVIEW_PER_HOST", 2)  # 同じサイトへの同時接続数
+LINK_PREVIEW_TIMEOUT = config.get("LINK_PREVIEW_TIMEOUT", 10.0)  # 1件の読み込みを諦めるまでの秒数
+LINK_PREVIEW_TTL = config.get("LINK_PREVIEW_TTL", 86400)  # 読み込んだ結果を使い回す秒数
+LINK_PREVIEW_CACHE_SIZE = config.get("LINK_PREVIEW_CACHE_SIZE", 2048)  # メモリに保持する件数 (あふれた分もディスクには残る)
+LINK_PREVIEW_ALLOW_PRIVATE = config.get("LINK_PREVIEW_ALLOW_PRIVATE", False)  # ローカル・社内ネットワークのアドレスも読み込む (テスト用)
+SNAPSHOT_DIR = config.get("SNAPSHOT_DIR", "snapshots")  # スナップショットの保存先
+SNAPSHOT_INTERVAL = config.get("SNAPSHOT_INTERVAL")  # Botの動作中にこの秒数ごとにスナップショットを取る (未設定なら取らない)
+SNAPSHOT_KEEP = config.get("SNAPSHOT_KEEP", 48)  # 残すスナップショットの数 (Noneなら消さない)
+
+def parse_shard_ids(value):
+    """"0,1,2" や "0-3" のような指定をシャードIDのリストにする"""
+    if value is None or isinstance(value, list):
+        return value
+    shard_ids = []
+    for part in str(value).split(","):
+        start, _, end = part.strip().partition("-")
+        shard_ids.extend(range(int(start), int(end or start) + 1))
+    return shard_ids
+
+# シャード設定: cluster.py から起動したときは環境変数で渡される。
+# どちらも未設定ならDiscordの推奨シャード数で1プロセスがすべてのシャードを受け持つ
+SHARD_COUNT = int(os.environ.get("BUDGETBOT_SHARD_COUNT") or config.get("SHARD_COUNT") or 0) or None
+SHARD_IDS = parse_shard_ids(os.environ.get("BUDGETBOT_SHARD_IDS") or config.get("SHARD_IDS"))
+CLUSTER_ID = int(os.environ.get("BUDGETBOT_CLUSTER_ID") or 0)
+if SHARD_IDS is not None and SHARD_COUNT is None:
+    raise SystemExit("SHARD_IDS を指定する場合は SHARD_COUNT も指定してください。")
+
+bot_options = {"command_prefix": "!"}
+if LOW_MEMORY_MODE:
+    # 会計権限はコマンド・ボタンのペイロードに含まれるロールで判定するので、サーバーのメンバー一覧は要らない。
+    # メッセージ本文が届かないため、プレフィックスのコマンドはBotにメンションしたときだけ使える (普段はスラッシュコマンドを使う)
+    intents.members = False
+    intents.message_content = False
+    bot_options.update(
+        command_prefix=commands.when_mentioned_or("!"),
+        chunk_guilds_at_startup=False,
+        member_cache_flags=discord.MemberCacheFlags.none(),
+        max_messages=None
+    )
+
+bot = BudgetBot(intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS, **bot_options)
+
+def owns_guild(guild_id: int) -> bool:
+    """このプロセスが受け持つシャードのサーバーか (Discordのシャード割り当て: (guild_id >> 22) % shard_count)"""
+    if bot.shard_ids is None or not bot.shard_count:
+        return True
+    return (guild_id >> 22) % bot.shard_count in bot.shard_ids
+
+class GuildNotOwned(Exception):
+    """このプロセスが受け持たないシャードのサーバーのデータを読もうとした"""
+
+    def __init__(self, guild_id: int):
+        super().__init__(f"guild {guild_id} belongs to another cluster (shards {bot.shard_ids} of {bot.shard_count})")
+        self.guild_id = guild_id
 
 ### ▼▼▼ ファイル設定 ▼▼▼
 DATA_DIR = "data"
-REVIEW_LOG_FILE = "review_results.csv"
-BUDGET_FILE = "budgets.json"
-CHANNEL_FILE = "channels.json"
-SETTINGS_FILE = "settings.json"
 
-# In-memory storage
-guild_data = {}
+# 保存先: "json" (data/<guild_id>/ 以下のファイル) または "sqlite"
+STORAGE_BACKEND = config.get("STORAGE_BACKEND", "json")
+SQLITE_PATH = config.get("SQLITE_PATH", os.path.join(DATA_DIR, "budgetbot.sqlite3"))
+LINK_PREVIEW_CACHE_PATH = config.get("LINK_PREVIEW_CACHE_PATH", os.path.join(DATA_DIR, "link_previews.sqlite3"))
 
-# --- Helper Functions for Server-Specific Data ---
+# --- Metrics ---
 
-def get_guild_data_path(guild_id: int) -> str:
-    """サーバーIDに対応するデータディレクトリのパスを返し、なければ作成する"""
-    path = os.path.join(DATA_DIR, str(guild_id))
-    os.makedirs(path, exist_ok=True)
-    return path
+metrics.slow_threshold = SLOW_CALL_THRESHOLD
 
-def load_guild_data(guild_id: int):
-    """指定されたサーバーのデータをファイルから読み込み、メモリに格納する"""
-    if guild_id in guild_data:
-        return
+def cached_member_count() -> int:
+    """discord.pyがキャッシュしているメンバーの数 (LOW_MEMORY_MODEでは自分だけになる)"""
+    return sum(len(guild.members) for guild in bot.guilds)
 
-    guild_data[guild_id] = {
-        "budgets": {},
-        "channels": set(),
-        "additional_roles": set()
-    }
-    
-    guild_path = get_guild_data_path(guild_id)
-    budget_file_path = os.path.join(guild_path, BUDGET_FILE)
-    channel_file_path = os.path.join(guild_path, CHANNEL_FILE)
-    settings_file_path = os.path.join(guild_path, SETTINGS_FILE)
+# --- Storage Backends ---
 
-    try:
-        with open(budget_file_path, "r", encoding="utf-8") as f:
-            guild_data[guild_id]["budgets"] = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        pass
+def create_storage(backend: str):
+    if backend == "json":
+        return JsonStorage(DATA_DIR, REVIEW_LOG_ROTATE, REVIEW_LOG_MAX_BYTES, REVIEW_LOG_MAX_OPEN_FILES)
+    if backend == "sqlite":
+        return SqliteStorage(SQLITE_PATH)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
 
-    try:
-        with open(channel_file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            guild_data[guild_id]["channels"] = set(data.get("registered_channels", []))
-    except (FileNotFoundError, json.JSONDecodeError):
-        pass
-        
-    try:
-        with open(settings_file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            guild_data[guild_id]["additional_roles"] = set(data.get("additional_role_ids", []))
-    except (FileNotFoundError, json.JSONDecodeError):
-        pass
+storage = create_storage(STORAGE_BACKEND)
+
+# --- Helper Functions for Server-Specific Data ---
 
-def save_budgets(guild_id: int):
-    path = get_guild_data_path(guild_id)
-    file_path = os.path.join(path, BUDGET_FILE)
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(guild_data[guild_id]["budgets"], f, indent=4, ensure_ascii=False)
-
-def save_channels(guild_id: int):
-    path = get_guild_data_path(guild_id)
-    file_path = os.path.join(path, CHANNEL_FILE)
-    with open(file_path, "w", encoding="utf-8") as f:
-        data_to_save = {"registered_channels": list(guild_data[guild_id]["channels"])}
-        json.dump(data_to_save, f, indent=4)
-
-def save_settings(guild_id: int):
-    path = get_guild_data_path(guild_id)
-    file_path = os.path.join(path, SETTINGS_FILE)
-    data_to_save = {
-        "additional_role_ids": list(guild_data[guild_id].get("additional_roles", []))
+class ReviewExportPart:
+    """エクスポートファイル1つ分。CSV・gzip圧縮CSV・XLSXのいずれかをメモリ上に書き出す"""
+
+    def __init__(self, file_format: str):
+        self.file_format = file_format
+        self.buffer = io.BytesIO()
+        self.raw_bytes = 0
+        self.unflushed_bytes = 0
+        self.rows = 0
+        if file_format == "xlsx":
+            self.workbook = openpyxl.Workbook(write_only=True)
+            self.sheet = self.workbook.create_sheet("審査記録")
+            self._append(REVIEW_LOG_HEADER)
+        else:
+            self.stream = gzip.GzipFile(fileobj=self.buffer, mode="wb") if file_format == "gzip" else self.buffer
+            self.csv_writer = csv.writer(self)
+            self.csv_writer.writerow(REVIEW_LOG_HEADER)
+
+    def write(self, text: str):
+        # csv.writer の書き込み先として呼ばれる
+        data = text.encode("utf-8")
+        self.stream.write(data)
+        self.raw_bytes += len(data)
+        if self.file_format == "gzip":
+            self.unflushed_bytes += len(data)
+            # 圧縮後の大きさを正確に測れるよう、ときどき圧縮器の中身を吐き出させる
+            if self.unflushed_bytes >= 64 * 1024:
+                self.stream.flush()
+                self.unflushed_bytes = 0
+
+    def _append(self, row: list):
+        self.sheet.append(row)
+        self.raw_bytes += sum(len(str(value).encode("utf-8")) + 1 for value in row)
+
+    def add(self, record: dict):
+        row = review_row_to_csv(record)
+        if self.file_format == "xlsx":
+            self._append(row)
+        else:
+            self.csv_writer.writerow(row)
+        self.rows += 1
+
+    def estimated_size(self) -> int:
+        if self.file_format == "gzip":
+            # まだ圧縮されていない分は圧縮前の大きさで見積もる
+            return self.buffer.tell() + self.unflushed_bytes
+        # XLSXは圧縮されるので、元のCSVの大きさを上限の目安にする
+        return self.raw_bytes
+
+    def finish(self) -> io.BytesIO:
+        if self.file_format == "xlsx":
+            self.workbook.save(self.buffer)
+        elif self.file_format == "gzip":
+            self.stream.close()
+        self.buffer.seek(0)
+        return self.buffer
+
+EXPORT_EXTENSIONS = {"csv": "csv", "gzip": "csv.gz", "xlsx": "xlsx"}
+
+def export_review_log(guild_id: int, filters: dict, file_format: str, max_part_bytes: int) -> list:
+    """(スレッドプール上で実行) 条件に合う審査記録を1行ずつ読みながら書き出し、
+    max_part_bytesを超えないよう複数のファイルに分ける。(ファイル名, データ) のリストを返す"""
+    buffers = []
+    part = ReviewExportPart(file_format)
+    for record in storage.iter_review_rows(guild_id, filters):
+        part.add(record)
+        if part.estimated_size() >= max_part_bytes:
+            buffers.append(part.finish())
+            part = ReviewExportPart(file_format)
+    if part.rows:
+        buffers.append(part.finish())
+
+    extension = EXPORT_EXTENSIONS[file_format]
+    if len(buffers) == 1:
+        return [(f"review_results.{extension}", buffers[0])]
+    return [(f"review_results_part{i}.{extension}", buffer) for i, buffer in enumerate(buffers, 1)]
+
+def guilds_with_pending_writes() -> set:
+    # 書き出し待ちの変更が残っているサーバーは追い出さない
+    return persistence.pending_guilds()
+
+guild_data = GuildCache(storage, GUILD_CACHE_MAX_GUILDS, GUILD_CACHE_MAX_BYTES, guilds_with_pending_writes)
+
+async def load_guild_data(guild_id: int) -> dict:
+    """指定されたサーバーのデータを返す。メモリになければストレージから読み込む"""
+    # 別のクラスタが受け持つサーバーのデータを書き換えると保存内容が食い違うので、読み込み自体をさせない
+    if not owns_guild(guild_id):
+        raise GuildNotOwned(guild_id)
+    return await guild_data.get(guild_id)
+
+# --- Write-behind Persistence ---
+
+def update_guild_size(guild_id: int):
+    # 書き込みが終わったのでメモリ上限の判定をやり直す (追い出せるようになったかもしれない)
+    guild_data.update_size(guild_id)
+
+persistence = WriteBehindQueue(PERSIST_DELAY, update_guild_size)
+
+def save_channels(guild_id: int, data: dict):
+    channels = data["channels"]
+    persistence.mark_dirty(
+        (guild_id, "channels"),
+        lambda: list(channels),
+        lambda snapshot: storage.save_channels(guild_id, snapshot)
+    )
+
+def save_settings(guild_id: int, data: dict):
+    persistence.mark_dirty(
+        (guild_id, "settings"),
+        lambda: {"additional_roles": list(data.get("additional_roles", [])), "no_overdraft": data.get("no_overdraft", False)},
+        lambda snapshot: storage.save_settings(guild_id, snapshot)
+    )
+
+def save_aggregates(guild_id: int, data: dict):
+    persistence.mark_dirty(
+        (guild_id, "aggregates"),
+        lambda: {dimension: {key: list(totals) for key, totals in data["aggregates"][dimension].items()} for dimension in AGGREGATE_DIMENSIONS},
+        lambda snapshot: storage.save_aggregates(guild_id, snapshot)
+    )
+
+def save_pending_request(guild_id: int, data: dict, request_id: str, on_written=None):
+    """審査待ちの申請を保存する。data["pending_requests"]から消えていれば削除する"""
+    pending = data["pending_requests"]
+    persistence.mark_dirty(
+        (guild_id, "pending", request_id),
+        lambda: (pending[request_id].to_json(), pending[request_id].summary()) if request_id in pending else (None, None),
+        lambda snapshot: storage.save_pending_request(guild_id, request_id, *snapshot),
+        on_written
+    )
+
+# --- Budget Ledger ---
+
+def post_ledger_entry(guild_id: int, data: dict, budget_name: str, delta: int, kind: str, request_id: str = None, actor: str = None) -> int:
+    """予算の取引を台帳に記録して残高に反映し、反映後の残高を返す。呼び出し側でサーバーのロックを取っておくこと"""
+    data["ledger_seq"] += 1
+    entry = {
+        "seq": data["ledger_seq"], "at": now_timestamp(), "budget": budget_name, "delta": delta,
+        "kind": kind, "request_id": request_id, "actor": actor
     }
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(data_to_save, f, indent=4)
-
-def save_review_result_partial(guild_id: int, applicant, budget_name, approver, approved_items, rejected_items):
-    guild_path = get_guild_data_path(guild_id)
-    log_file_path = os.path.join(guild_path, REVIEW_LOG_FILE)
-    file_exists = os.path.exists(log_file_path)
-    with open(log_file_path, "a", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        if not file_exists:
-            writer.writerow(["申請者", "購入物", "リンク", "単価", "個数", "合計金額", "結果", "承認者", "予算項目"])
-        for item in approved_items:
-            writer.writerow([applicant, item["name"], item["link"], item.get("unit_price", item["amount"]), item.get("quantity", 1), item["amount"], "承認", approver, budget_name])
-        for item in rejected_items:
-            writer.writerow([applicant, item["name"], item["link"], item.get("unit_price", item["amount"]), item.get("quantity", 1), item["amount"], "却下", approver, budget_name])
+    balance = apply_ledger_entry(data["budgets"], entry)
+    data["ledger"].append(entry)
+    save_ledger(guild_id, data)
+    return balance
+
+def save_ledger(guild_id: int, data: dict):
+    """未書き込みの取引を追記する。取引が LEDGER_SNAPSHOT_INTERVAL 件たまったらスナップショットも書き出す"""
+    ledger = data["ledger"]
+
+    def snapshot():
+        # 書き込み済みの取引はもうメモリに持っておく必要がない
+        while ledger and ledger[0]["seq"] <= data["ledger_saved_seq"]:
+            ledger.popleft()
+        compaction = None
+        if data.pop("ledger_force_snapshot", False) or data["ledger_seq"] - data["ledger_snapshot_seq"] >= LEDGER_SNAPSHOT_INTERVAL:
+            compaction = ledger_snapshot(data["ledger_seq"], dict(data["budgets"]), dict(data["applied_requests"]))
+        return list(ledger), compaction
+
+    def writer(snapshot):
+        entries, compaction = snapshot
+        storage.append_ledger(guild_id, entries, compaction)
+        # 書き込めた位置を返し、反映はイベントループ上で行う
+        return entries[-1]["seq"] if entries else None, compaction["seq"] if compaction is not None else None
+
+    def written(result):
+        saved_seq, snapshot_seq = result
+        if saved_seq is not None:
+            data["ledger_saved_seq"] = max(data["ledger_saved_seq"], saved_seq)
+        if snapshot_seq is not None:
+            data["ledger_snapshot_seq"] = max(data["ledger_snapshot_seq"], snapshot_seq)
+        waiters = data.get("ledger_waiters")
+        while waiters and waiters[0][0] <= data["ledger_saved_seq"]:
+            waiters.popleft()[1]()
+
+    persistence.mark_dirty((guild_id, "ledger"), snapshot, writer, written)
+
+def after_ledger_saved(data: dict, seq: int, callback):
+    """番号seqまでの取引が書き出されたらcallback()を呼ぶ (書き出し済みならすぐに呼ぶ)"""
+    if seq <= data["ledger_saved_seq"]:
+        callback()
+        return
+    data.setdefault("ledger_waiters", deque()).append((seq, callback))
+
+async def replay_guild_ledger(guild_id: int, data: dict, upto: str = None, full: bool = False):
+    """台帳から残高を計算する。まだ書き出していない取引も含める"""
+    unsaved = list(data["ledger"])
+    result = await asyncio.get_running_loop().run_in_executor(None, replay_ledger, storage, guild_id, upto, full)
+    if result is None:
+        return None
+    balances, last_seq = result
+    for entry in unsaved:
+        if entry["seq"] > last_seq and ledger_time_visible(entry["at"], upto):
+            apply_ledger_entry(balances, entry)
+            last_seq = entry["seq"]
+    return balances
+
+# --- Budget Debits ---
+
+# サーバーごとのロック (使われていないロックは自動で破棄される)
+guild_locks = weakref.WeakValueDictionary()
+
+def get_guild_lock(guild_id: int) -> asyncio.Lock:
+    lock = guild_locks.get(guild_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        guild_locks[guild_id] = lock
+    return lock
+
+def new_request_id() -> str:
+    return secrets.token_hex(8)
+
+async def apply_review_decision(guild_id: int, request: PendingRequest, approver_name: str, approved_items: list, rejected_items: list):
+    """審査結果を予算・審査記録・集計に反映する。同じ申請は一度しか反映されない。
+    (結果, 反映後の残高) を返す。結果は "applied" / "duplicate" / "insufficient" / "unknown_budget" のいずれか。"""
+    request_id = request.request_id
+    budget_name = request.budget_name
+    approved_amount = sum(item.amount for item in approved_items)
+    async with get_guild_lock(guild_id):
+        data = await load_guild_data(guild_id)
+        current_budgets = data["budgets"]
+        balance = current_budgets.get(budget_name)
+        # 反映と審査待ちからの削除はロックの中で一緒に行うので、審査待ちに残っていなければ反映済み
+        # (メモリから外していた申請はNoneになっているので、キーの有無で判断する)
+        if request_id not in data["pending_requests"]:
+            return "duplicate", balance
+        if approved_amount > 0:
+            if balance is None:
+                return "unknown_budget", None
+            if data.get("no_overdraft") and balance < approved_amount:
+                return "insufficient", balance
+            balance = post_ledger_entry(guild_id, data, budget_name, -approved_amount, "debit", request_id, approver_name)
+        else:
+            # 引き落としのない却下も、反映済みの印として台帳に残す
+            post_ledger_entry(guild_id, data, budget_name, 0, "review", request_id, approver_name)
+        # 申請の削除を書き出すまでの間だけ覚えておき、その間に取る台帳のスナップショットに含める
+        data["applied_requests"][request_id] = data["ledger"][-1]["at"]
+        del data["pending_requests"][request_id]
+        data["pending_index"].remove(request_id)
+        # 台帳より先に申請の削除が書き出されると、途中で止まったときに引き落としのないまま申請が消えるので、
+        # 台帳の書き出しを待ってから削除を予約する (逆の順で止まった場合は読み込み時に台帳から削除し直す)
+        after_ledger_saved(data, data["ledger_seq"], lambda: save_pending_request(
+            guild_id, data, request_id,
+            lambda _: data["applied_requests"].pop(request_id, None)
+        ))
+        save_review_result_partial(guild_id, data, request.author_name, budget_name, approver_name, approved_items, rejected_items)
+        return "applied", balance
+
+# --- Pending Requests ---
+
+async def open_pending_request(author_id: int, author_name: str, author_avatar: str, guild_id: int, items: list, budget_name: str) -> PendingRequest:
+    """審査待ちの申請を登録する。メッセージを送信したら attach_request_message で紐付ける"""
+    request = PendingRequest(new_request_id(), guild_id, author_id, author_name, author_avatar, budget_name, items, now_timestamp())
+    data = await load_guild_data(guild_id)
+    data["pending_requests"][request.request_id] = request
+    data["pending_index"].add(request.summary())
+    save_pending_request(guild_id, data, request.request_id)
+    return request
+
+async def attach_request_message(request: PendingRequest, message: discord.Message):
+    request.channel_id = message.channel.id
+    request.message_id = message.id
+    data = await load_guild_data(request.guild_id)
+    if request.request_id in data["pending_requests"]:
+        data["pending_index"].add(request.summary())
+        save_pending_request(request.guild_id, data, request.request_id)
+
+async def get_pending_request(guild_id: int, request_id: str):
+    data = await load_guild_data(guild_id)
+    pending = data["pending_requests"]
+    if request_id not in pending:
+        return None
+    request = pending[request_id]
+    if request is None:
+        request = await dormant_requests.rehydrate(guild_id, data, request_id)
+        if request is None:
+            return None
+    request.last_used = time.monotonic()
+    return request
+
+class DormantRequestSweeper:
+    """しばらく操作されていない審査待ちの申請をメモリから外す。
+    外した申請はIDだけが残り、ボタンが押されたときにストレージから読み直す。"""
+
+    def __init__(self, idle_seconds: float):
+        self.idle_seconds = idle_seconds
+        self.evictions = 0
+        self.rehydrations = 0
+        self._task = None
+
+    def start(self):
+        if self.idle_seconds and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(max(self.idle_seconds / 4, 1.0))
+            self.sweep()
+
+    def sweep(self, now: float = None) -> int:
+        now = time.monotonic() if now is None else now
+        evicted_guilds = []
+        evicted = 0
+        for guild_id, data in guild_data.items():
+            pending = data["pending_requests"]
+            count = 0
+            for request_id, request in pending.items():
+                if request is None or now - request.last_used < self.idle_seconds:
+                    continue
+                # 書き出す前に外すと保存する内容がなくなるので、書き込み待ちのものは残す
+                if persistence.is_pending((guild_id, "pending", request_id)):
+                    continue
+                pending[request_id] = None
+                count += 1
+            if count:
+                evicted += count
+                evicted_guilds.append(guild_id)
+        self.evictions += evicted
+        for guild_id in evicted_guilds:
+            guild_data.update_size(guild_id)
+        return evicted
+
+    async def rehydrate(self, guild_id: int, data: dict, request_id: str):
+        started = time.perf_counter()
+        request = await asyncio.get_running_loop().run_in_executor(None, storage.load_pending_request, guild_id, request_id)
+        metrics.observe("budgetbot_storage_seconds", time.perf_counter() - started, operation="load_pending_request")
+        pending = data["pending_requests"]
+        # 読み込んでいる間に審査済みになった、または別の呼び出しが先に読み直した場合
+        if request_id not in pending:
+            return None
+        if pending[request_id] is not None:
+            return pending[request_id]
+        if request is None:
+            del pending[request_id]
+            data["pending_index"].remove(request_id)
+            return None
+        pending[request_id] = request
+        self.rehydrations += 1
+        guild_data.add_size(guild_id, request.estimate_size())
+        return request
+
+dormant_requests = DormantRequestSweeper(PENDING_REQUEST_IDLE_SECONDS)
+
+# --- Review Log Writer ---
+
+def index_review_rows(guild_id: int, records: list, locators: list):
+    # 書き込んだ審査記録を !history の索引に加える
+    review_search.add_rows(guild_id, records, locators)
+
+review_log = ReviewLogWriter(
+    storage, REVIEW_LOG_BATCH_DELAY, REVIEW_LOG_BATCH_MAX_ROWS, REVIEW_LOG_FSYNC, REVIEW_LOG_FSYNC_INTERVAL, index_review_rows
+)
+
+def save_review_result_partial(guild_id: int, data: dict, applicant, budget_name, approver, approved_items, rejected_items):
+    created_at = now_timestamp()
+    records = [
+        {
+            "applicant": applicant, "name": item.name, "link": item.link,
+            "unit_price": item.unit_price, "quantity": item.quantity, "amount": item.amount,
+            "result": result, "approver": approver, "budget_name": budget_name, "created_at": created_at
+        }
+        for items, result in ((approved_items, "承認"), (rejected_items, "却下"))
+        for item in items
+    ]
+    if records:
+        review_log.append(guild_id, records)
+        # 集計がまだ作られていないサーバーは、初回の !report で審査記録から作り直す
+        if data["aggregates"] is not None:
+            for record in records:
+                add_to_aggregates(data["aggregates"], record)
+            save_aggregates(guild_id, data)
+
+# --- Spending Aggregates ---
+
+def build_aggregates(guild_id: int) -> dict:
+    """(スレッドプール上で実行) 審査記録を最初から読み直して集計を作る"""
+    aggregates = new_aggregates()
+    for record in storage.iter_review_rows(guild_id):
+        add_to_aggregates(aggregates, record)
+    return aggregates
+
+async def rebuild_aggregates(guild_id: int) -> dict:
+    # 作り直している間に審査が反映されないよう、サーバーのロックを取ったまま読み直す
+    async with get_guild_lock(guild_id):
+        await review_log.flush()
+        aggregates = await asyncio.get_running_loop().run_in_executor(None, build_aggregates, guild_id)
+        data = await load_guild_data(guild_id)
+        data["aggregates"] = aggregates
+        save_aggregates(guild_id, data)
+    return aggregates
+
+# --- Review History Search ---
+
+def build_review_search_index(guild_id: int) -> ReviewSearchIndex:
+    """(スレッドプール上で実行) 審査記録を最初から読み直して索引を作る"""
+    index = ReviewSearchIndex()
+    for locator, record in storage.iter_review_locators(guild_id):
+        index.add(record, locator)
+    return index
+
+class ReviewSearchCache:
+    """!history の索引を最近使ったサーバーの分だけ保持する。
+    索引は初回の検索時に審査記録から作り、以降は審査記録の書き込みに合わせて行を足していく。"""
+
+    def __init__(self, max_guilds: int):
+        self.max_guilds = max_guilds
+        self._indexes = OrderedDict()
+        self.builds = 0
+
+    def __len__(self) -> int:
+        return len(self._indexes)
+
+    def total_rows(self) -> int:
+        return sum(len(index) for index in self._indexes.values())
+
+    async def get(self, guild_id: int, rebuild: bool = False) -> ReviewSearchIndex:
+        if rebuild:
+            self._indexes.pop(guild_id, None)
+        index = self._indexes.get(guild_id)
+        if index is not None:
+            self._indexes.move_to_end(guild_id)
+            return index
+        # 作っている間に審査記録が書き込まれないよう、サーバーのロックを取ってから書き込み待ちを書き出して読む
+        async with get_guild_lock(guild_id):
+            index = self._indexes.get(guild_id)
+            if index is not None:
+                return index
+            await review_log.flush()
+            started = time.perf_counter()
+            index = await asyncio.get_running_loop().run_in_executor(None, build_review_search_index, guild_id)
+            metrics.observe("budgetbot_storage_seconds", time.perf_counter() - started, operation="build_review_search")
+            self.builds += 1
+            self._indexes[guild_id] = index
+            while len(self._indexes) > self.max_guilds:
+                self._indexes.popitem(last=False)
+        return index
+
+    def add_rows(self, guild_id: int, records: list, locators: list):
+        """書き込んだ審査記録を索引に足す (索引を持っていないサーバーは、次に検索したときに作る)"""
+        index = self._indexes.get(guild_id)
+        if index is None:
+            return
+        for record, locator in zip(records, locators):
+            index.add(record, locator)
+
+review_search = ReviewSearchCache(REVIEW_SEARCH_MAX_GUILDS)
 
 # --- Helper Function for Permission Check ---
 
-def has_accounting_role(member: discord.Member) -> bool:
+permission_cache = PermissionCache(PERMISSION_CACHE_MAX_ENTRIES)
+
+def member_has_accounting_role(data: dict, member: discord.Member) -> bool:
+    server_roles = data.get("additional_roles", set())
+    member_role_ids = {role.id for role in member.roles}
+    return bool(ALLOWED_ROLE_ID and ALLOWED_ROLE_ID in member_role_ids) or not server_roles.isdisjoint(member_role_ids)
+
+async def has_accounting_role(member: discord.Member) -> bool:
     if not member.guild:
         return False
-    load_guild_data(member.guild.id)
-    server_roles = guild_data[member.guild.id].get("additional_roles", set())
-    member_role_ids = {role.id for role in member.roles}
-    if ALLOWED_ROLE_ID and ALLOWED_ROLE_ID in member_role_ids:
-        return True
-    if not server_roles.isdisjoint(member_role_ids):
-        return True
-    return False
+    guild_id = member.guild.id
+    if LOW_MEMORY_MODE:
+        # メンバーの更新イベントが届かず判定結果を無効化できないので、キャッシュせず
+        # コマンド・ボタンのペイロードに含まれる最新のロールで毎回判定する
+        return member_has_accounting_role(await load_guild_data(guild_id), member)
+    allowed = permission_cache.get(guild_id, member.id)
+    if allowed is not None:
+        return allowed
+    generation = permission_cache.generation(guild_id)
+    data = await load_guild_data(guild_id)
+    allowed = member_has_accounting_role(data, member)
+    permission_cache.put(guild_id, member.id, allowed, generation)
+    return allowed
+
+# --- Outbound Messages ---
+
+outbound = OutboundDispatcher(OUTBOUND_CHANNEL_RATE, OUTBOUND_CHANNEL_PER)
+
+# --- Link Previews ---
+# 申請の参考リンクを読み込んで、ページのタイトルと価格を審査用のEmbedに添える。
+# 読み込みは申請の投稿後にバックグラウンドで行い、終わったらEmbedを描き直す (応答は待たせない)。
+
+link_previews = LinkPreviewResolver(
+    LinkPreviewStore(LINK_PREVIEW_CACHE_PATH), LINK_PREVIEW_CACHE_SIZE, LINK_PREVIEW_TTL,
+    LINK_PREVIEW_CONCURRENCY, LINK_PREVIEW_PER_HOST, LINK_PREVIEW_TIMEOUT, LINK_PREVIEW_ALLOW_PRIVATE
+)
+
+def schedule_link_previews(request: PendingRequest, message: discord.Message, build_embed):
+    """投稿した申請のリンク先をバックグラウンドで読み込み、新しく読み込めたらbuild_embed()でEmbedを描き直す"""
+    if not LINK_PREVIEW:
+        return
+    links = {item.link for item in request.items if item.link and not link_previews.cached(item.link)}
+    if links:
+        link_previews.track(asyncio.create_task(_update_link_previews(request, message, links, build_embed)))
+
+async def _update_link_previews(request: PendingRequest, message: discord.Message, links: set, build_embed):
+    previews = await asyncio.gather(*(link_previews.resolve(link) for link in links))
+    if not any(previews):
+        return
+    async def still_pending() -> bool:
+        data = await load_guild_data(request.guild_id)
+        return request.request_id in data["pending_requests"]
+
+    # 審査が済んだ申請は結果のEmbedになっているので描き直さない
+    if not await still_pending():
+        return
+    request_renderers.pop(request.request_id, None)
+    # 品物の選択中でも崩れないよう、ボタンはそのままにしてEmbedだけを差し替える。
+    # 予約してから送るまでの間に審査が済むことがあるので、送る直前にもう一度確かめる。
+    # 確かめてから送り終わるまでは同じメッセージへの審査結果の編集を送らないので、描き直しが結果を上書きすることはない
+    outbound.edit_message(message, only_if=still_pending, embed=build_embed())
+
+# --- Request Embeds ---
+
+REQUEST_RENDERER_CACHE_SIZE = 256
+
+def link_preview_line(item: RequestItem):
+    """読み込み済みのリンク先の情報を品物の表示に添える行 (まだ読み込んでいなければNone)"""
+    preview = link_previews.peek(item.link) if LINK_PREVIEW else None
+    return format_link_preview(preview, item.unit_price) if preview is not None else None
+
+# 投稿済みの申請のページ切り替え用。申請IDごとに描画済みの行を使い回す
+request_renderers = OrderedDict()
+
+def request_renderer(request: PendingRequest) -> ItemListRenderer:
+    renderer = request_renderers.pop(request.request_id, None)
+    if renderer is None or len(renderer) != len(request.items):
+        renderer = ItemListRenderer(request.items, link_preview_line)
+    request_renderers[request.request_id] = renderer
+    while len(request_renderers) > REQUEST_RENDERER_CACHE_SIZE:
+        request_renderers.popitem(last=False)
+    return renderer
+
+def build_request_embed(request: PendingRequest, page: int = 0) -> discord.Embed:
+    renderer = request_renderer(request)
+    pages = renderer.pages
+    page = max(0, min(page, len(pages) - 1))
+    embed = discord.Embed(title="購入申請", color=discord.Color.gold())
+    embed.set_author(name=clip_text(f"申請者: {request.author_name}", EMBED_NAME_LIMIT), icon_url=request.author_avatar)
+    embed.description = pages[page]
+    embed.add_field(name="💰 合計金額", value=f"**¥{renderer.total:,}**", inline=True)
+    embed.add_field(name="🧾 予算項目", value=clip_text(request.budget_name, EMBED_NAME_LIMIT), inline=True)
+    embed.set_footer(text=page_footer("ステータス: 審査中", page, len(pages)))
+    return embed
+
+class EmbedPageView(ui.View):
+    """作成済みのEmbedをページ送りで切り替える。時間切れになったらボタンを外す"""
+
+    def __init__(self, embeds: list, timeout: float = 600):
+        super().__init__(timeout=timeout)
+        self.embeds = embeds
+        self.page = 0
+        self.message = None
+        self.update_buttons()
+
+    def update_buttons(self):
+        self.prev_button.disabled = self.page == 0
+        self.next_button.disabled = self.page >= len(self.embeds) - 1
+
+    async def on_timeout(self):
+        if self.message is not None:
+            try:
+                await outbound.edit_message(self.message, view=None)
+            except discord.HTTPException:
+                pass
+
+    async def show(self, interaction: discord.Interaction, page: int):
+        self.page = max(0, min(page, len(self.embeds) - 1))
+        self.update_buttons()
+        await interaction.response.defer()
+        outbound.edit_interaction(interaction, embed=self.embeds[self.page], view=self)
+
+    @ui.button(label="前へ", style=discord.ButtonStyle.secondary, emoji="◀️")
+    @timed("EmbedPageView.prev_button")
+    async def prev_button(self, interaction: discord.Interaction, button: ui.Button):
+        await self.show(interaction, self.page - 1)
+
+    @ui.button(label="次へ", style=discord.ButtonStyle.secondary, emoji="▶️")
+    @timed("EmbedPageView.next_button")
+    async def next_button(self, interaction: discord.Interaction, button: ui.Button):
+        await self.show(interaction, self.page + 1)
 
 # --- UI Classes ---
 class AddItemModal(ui.Modal, title="品物をリストに追加"):
@@ -130,11 +802,12 @@ class AddItemModal(ui.Modal, title="品物をリストに追加"):
         super().__init__()
         self.parent_view = parent_view
 
-    item_name = ui.TextInput(label="購入物", placeholder="例: USB Type-C ケーブル", required=True)
-    link = ui.TextInput(label="参考リンク", placeholder="https://example.com/item", required=False)
+    item_name = ui.TextInput(label="購入物", placeholder="例: USB Type-C ケーブル", required=True, max_length=200)
+    link = ui.TextInput(label="参考リンク", placeholder="https://example.com/item", required=False, max_length=1000)
     amount = ui.TextInput(label="単価（半角数字のみ）", placeholder="例: 1500", required=True)
     quantity = ui.TextInput(label="個数（半角数字のみ）", placeholder="例: 2 (デフォルト: 1)", required=False)
 
+    @timed("AddItemModal.on_submit")
     async def on_submit(self, interaction: discord.Interaction):
         try:
             amount_val = int(self.amount.value)
@@ -153,32 +826,72 @@ class AddItemModal(ui.Modal, title="品物をリストに追加"):
             except ValueError:
                 await interaction.response.send_message("⚠️ 個数は半角数字で入力してください。", ephemeral=True)
                 return
-        new_item = {
-            "name": self.item_name.value,
-            "link": self.link.value,
-            "unit_price": amount_val,
-            "quantity": quantity_val,
-            "amount": amount_val * quantity_val,
-            "status": "保留"
-        }
-        self.parent_view.items.append(new_item)
+        new_item = RequestItem(self.item_name.value, self.link.value, amount_val, quantity_val)
+        if LINK_PREVIEW and new_item.link:
+            # 提出までの間に読み込んでおく
+            link_previews.prefetch(new_item.link)
+        self.parent_view.add_item_to_list(new_item)
+        await self.parent_view.update_message(interaction)
+
+class RemoveItemModal(ui.Modal, title="品物をリストから削除"):
+    def __init__(self, parent_view):
+        super().__init__()
+        self.parent_view = parent_view
+
+    number = ui.TextInput(label="削除する品物の番号", placeholder="例: 3", required=True, max_length=4)
+
+    @timed("RemoveItemModal.on_submit")
+    async def on_submit(self, interaction: discord.Interaction):
+        try:
+            index = int(self.number.value) - 1
+        except ValueError:
+            index = -1
+        if not 0 <= index < len(self.parent_view.items):
+            await interaction.response.send_message("⚠️ リストにある品物の番号を入力してください。", ephemeral=True)
+            return
+        self.parent_view.remove_item_from_list(index)
+        await self.parent_view.update_message(interaction)
+
+class SearchBudgetModal(ui.Modal, title="予算を検索"):
+    def __init__(self, parent_view):
+        super().__init__()
+        self.parent_view = parent_view
+
+    query = ui.TextInput(label="予算名 (一部だけでも可)", placeholder="例: 備品", required=True, max_length=100)
+
+    @timed("SearchBudgetModal.on_submit")
+    async def on_submit(self, interaction: discord.Interaction):
+        data = await load_guild_data(self.parent_view.guild_id)
+        matches = budget_index(data).search(self.query.value)
+        if not matches:
+            await interaction.response.send_message(f"ℹ️ 「{self.query.value}」に一致する予算はありません。", ephemeral=True)
+            return
+        self.parent_view.update_budget_options({name: data["budgets"][name] for name in matches})
+        if len(matches) == 1:
+            self.parent_view.selected_budget = matches[0]
         await self.parent_view.update_message(interaction)
 
 class MultiItemRequestView(ui.View):
-    def __init__(self, author: discord.User, guild_id: int):
+    def __init__(self, author: discord.User, guild_id: int, budgets: dict):
         super().__init__(timeout=600)
-        self.author = author
+        # Userオブジェクトは持たず、表示と本人確認に必要な値だけを覚えておく
+        self.author_id = author.id
+        self.author_name = author.display_name
+        self.author_avatar = str(author.display_avatar.url)
         self.guild_id = guild_id
         self.items = []
+        self.renderer = ItemListRenderer(link_preview_line=link_preview_line)
+        self.page = 0
         self.selected_budget = None
-        self.update_budget_options()
+        # セレクトに並べきれないときだけ検索ボタンを出す
+        if len(budgets) <= SELECT_OPTION_LIMIT:
+            self.remove_item(self.search_budget_button)
+        self.update_budget_options(budgets)
     
-    def update_budget_options(self):
-        load_guild_data(self.guild_id)
-        current_budgets = guild_data[self.guild_id]["budgets"]
+    def update_budget_options(self, current_budgets: dict):
         options = [
-            discord.SelectOption(label=name, description=f"残高: ¥{amount:,}")
-            for name, amount in current_budgets.items()
+            discord.SelectOption(label=clip_text(name, SELECT_TEXT_LIMIT), value=name, description=f"残高: ¥{amount:,}")
+            for name, amount in itertools.islice(current_budgets.items(), SELECT_OPTION_LIMIT)
         ]
         
         # custom_idを使ってコンポーネントを安全に取得
@@ -188,27 +901,37 @@ class MultiItemRequestView(ui.View):
             select_menu.placeholder = "利用可能な予算がありません"
         else:
             select_menu.options = options
+            if len(current_budgets) > SELECT_OPTION_LIMIT:
+                select_menu.placeholder = f"① 予算を選択 (全{len(current_budgets):,}件中{SELECT_OPTION_LIMIT}件・🔍で検索)"
+            else:
+                select_menu.placeholder = "① 使用する予算を選択してください..."
+
+    def add_item_to_list(self, item: RequestItem):
+        self.items.append(item)
+        self.renderer.append(item)
+        # 追加した品物が見えるよう最後のページに移る
+        self.page = len(self.renderer.pages) - 1
+
+    def remove_item_from_list(self, index: int):
+        del self.items[index]
+        self.renderer.remove(index)
 
     def create_embed(self):
         embed = discord.Embed(title="🛒 購入申請リスト", color=discord.Color.blue())
-        embed.set_author(name=f"申請者: {self.author.display_name}", icon_url=self.author.display_avatar)
+        embed.set_author(name=clip_text(f"申請者: {self.author_name}", EMBED_NAME_LIMIT), icon_url=self.author_avatar)
         
-        total_amount = 0
         if not self.items:
             embed.description = "まだ品物は追加されていません。\n「品物を追加」ボタンから入力してください。"
         else:
-            description = ""
-            for i, item in enumerate(self.items, 1):
-                description += f"**{i}. {item['name']}**\n"
-                description += f"   `¥{item['unit_price']:,} × {item['quantity']}個 =` **¥{item['amount']:,}**\n"
-                if item['link']:
-                    description += f"   [リンク]({item['link']})\n"
-                total_amount += item['amount']
-            embed.description = description
-            embed.add_field(name="合計金額", value=f"**¥{total_amount:,}**")
+            pages = self.renderer.pages
+            self.page = max(0, min(self.page, len(pages) - 1))
+            embed.description = pages[self.page]
+            embed.add_field(name="合計金額", value=f"**¥{self.renderer.total:,}**")
+            if len(pages) > 1:
+                embed.set_footer(text=f"ページ {self.page + 1}/{len(pages)} ・ 全{len(self.items)}件")
 
         if self.selected_budget:
-            embed.add_field(name="選択中の予算", value=self.selected_budget)
+            embed.add_field(name="選択中の予算", value=clip_text(self.selected_budget, EMBED_NAME_LIMIT))
         return embed
 
     async def update_message(self, interaction: discord.Interaction):
@@ -216,151 +939,312 @@ class MultiItemRequestView(ui.View):
         submit_button = discord.utils.get(self.children, custom_id="submit_request_button")
         if submit_button:
             submit_button.disabled = not (self.items and self.selected_budget)
+        self.remove_button.disabled = not self.items
         
         embed = self.create_embed()
-        await interaction.response.edit_message(embed=embed, view=self)
+        page_count = len(self.renderer.pages) if self.items else 1
+        self.prev_page_button.disabled = self.page == 0
+        self.next_page_button.disabled = self.page >= page_count - 1
+        # 応答だけ先に返し、続けて操作されたときは編集を1回にまとめて送る
+        await interaction.response.defer()
+        outbound.edit_interaction(interaction, embed=embed, view=self)
     
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
-        if interaction.user.id != self.author.id:
+        if interaction.user.id != self.author_id:
             await interaction.response.send_message("⚠️ この申請を操作できるのは申請者本人のみです。", ephemeral=True)
             return False
         return True
 
     @ui.button(label="品物を追加", style=discord.ButtonStyle.secondary, emoji="➕", row=0)
+    @timed("MultiItemRequestView.add_item_button")
     async def add_item_button(self, interaction: discord.Interaction, button: ui.Button):
         modal = AddItemModal(parent_view=self)
         await interaction.response.send_modal(modal)
 
+    @ui.button(label="予算を検索", style=discord.ButtonStyle.secondary, emoji="🔍", row=0)
+    @timed("MultiItemRequestView.search_budget_button")
+    async def search_budget_button(self, interaction: discord.Interaction, button: ui.Button):
+        await interaction.response.send_modal(SearchBudgetModal(parent_view=self))
+
+    @ui.button(label="品物を削除", style=discord.ButtonStyle.secondary, emoji="➖", disabled=True, row=0)
+    @timed("MultiItemRequestView.remove_button")
+    async def remove_button(self, interaction: discord.Interaction, button: ui.Button):
+        await interaction.response.send_modal(RemoveItemModal(parent_view=self))
+
     @ui.select(placeholder="① 使用する予算を選択してください...", row=1, custom_id="budget_select_menu")
+    @timed("MultiItemRequestView.select_budget")
     async def select_budget(self, interaction: discord.Interaction, select: ui.Select):
         self.selected_budget = select.values[0]
         await self.update_message(interaction)
     
     @ui.button(label="申請を提出", style=discord.ButtonStyle.primary, emoji="🚀", disabled=True, row=2, custom_id="submit_request_button")
+    @timed("MultiItemRequestView.submit_button")
     async def submit_button(self, interaction: discord.Interaction, button: ui.Button):
-        total_amount = sum(item['amount'] for item in self.items)
-        
-        final_embed = discord.Embed(title="購入申請", color=discord.Color.gold())
-        final_embed.set_author(name=f"申請者: {self.author.display_name}", icon_url=self.author.display_avatar)
-        description = ""
-        for i, item in enumerate(self.items, 1):
-            description += f"**{i}. {item['name']}**\n"
-            description += f"   `¥{item['unit_price']:,} × {item['quantity']}個 =` **¥{item['amount']:,}**\n"
-            if item['link']:
-                description += f"   [リンク]({item['link']})\n"
-        final_embed.description = description
-        final_embed.add_field(name="💰 合計金額", value=f"**¥{total_amount:,}**", inline=True)
-        final_embed.add_field(name="🧾 予算項目", value=self.selected_budget, inline=True)
-        final_embed.set_footer(text="ステータス: 審査中")
         await interaction.message.delete()
-        approval_view = ApprovalView(author=self.author, items=self.items, budget_name=self.selected_budget, guild_id=self.guild_id)
-        await interaction.channel.send(embed=final_embed, view=approval_view)
+        request = await open_pending_request(self.author_id, self.author_name, self.author_avatar, self.guild_id, self.items, self.selected_budget)
+        # 入力中に描画した行をそのまま投稿後のページ切り替えにも使う
+        # (リンク先の情報を表示する場合は、入力中に読み込めた分を含めて描き直す)
+        if not LINK_PREVIEW:
+            request_renderers[request.request_id] = self.renderer
+        message = await outbound.send(interaction.channel, embed=build_request_embed(request), view=ApprovalView(request))
+        await attach_request_message(request, message)
+        schedule_link_previews(request, message, functools.partial(build_request_embed, request))
 
     # ★★★ 新機能: キャンセルボタン ★★★
     @ui.button(label="キャンセル", style=discord.ButtonStyle.danger, emoji="✖️", row=2)
+    @timed("MultiItemRequestView.cancel_button")
     async def cancel_button(self, interaction: discord.Interaction, button: ui.Button):
         """申請をキャンセルし、メッセージを削除します。"""
         await interaction.message.delete()
         await interaction.response.send_message("申請をキャンセルしました。", ephemeral=True, delete_after=5)
 
+    @ui.button(label="前のページ", style=discord.ButtonStyle.secondary, emoji="◀️", disabled=True, row=3)
+    @timed("MultiItemRequestView.prev_page_button")
+    async def prev_page_button(self, interaction: discord.Interaction, button: ui.Button):
+        self.page -= 1
+        await self.update_message(interaction)
+
+    @ui.button(label="次のページ", style=discord.ButtonStyle.secondary, emoji="▶️", disabled=True, row=3)
+    @timed("MultiItemRequestView.next_page_button")
+    async def next_page_button(self, interaction: discord.Interaction, button: ui.Button):
+        self.page += 1
+        await self.update_message(interaction)
+
 
 class PartialApprovalView(ui.View):
-    def __init__(self, original_view: 'ApprovalView'):
+    def __init__(self, request: PendingRequest):
         super().__init__(timeout=300)
-        self.original_view = original_view
-        self.items = original_view.items
-        
-        options = [
+        self.request = request
+        self.items = request.items
+        self.message = None
+        # セレクトには25個までしか並べられないので、品物が多いときはページに分けて選ばせる
+        self.approved_indices = set()
+        self.page = 0
+        self.page_count = (len(self.items) + SELECT_OPTION_LIMIT - 1) // SELECT_OPTION_LIMIT
+        if self.page_count <= 1:
+            self.remove_item(self.prev_button)
+            self.remove_item(self.next_button)
+        self.show_page()
+
+    def page_indices(self) -> range:
+        start = self.page * SELECT_OPTION_LIMIT
+        return range(start, min(start + SELECT_OPTION_LIMIT, len(self.items)))
+
+    def show_page(self):
+        indices = self.page_indices()
+        self.item_select.options = [
             discord.SelectOption(
-                label=f"{item['name']} (¥{item['amount']:,})", 
-                description=f"単価: ¥{item.get('unit_price', item['amount']):,} × {item.get('quantity', 1)}個",
-                value=str(i)
+                label=clip_text(f"{i + 1}. {self.items[i].name} (¥{self.items[i].amount:,})", SELECT_TEXT_LIMIT),
+                description=clip_text(f"単価: ¥{self.items[i].unit_price:,} × {self.items[i].quantity}個", SELECT_TEXT_LIMIT),
+                value=str(i),
+                default=i in self.approved_indices
             )
-            for i, item in enumerate(self.items)
+            for i in indices
         ]
-        
-        self.item_select.options = options
-        self.item_select.max_values = len(self.items)
+        self.item_select.min_values = 0
+        self.item_select.max_values = len(indices)
+        if self.page_count > 1:
+            self.item_select.placeholder = f"承認する品物をすべて選択してください... ({self.page + 1}/{self.page_count})"
+            self.prev_button.disabled = self.page == 0
+            self.next_button.disabled = self.page >= self.page_count - 1
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return await check_reviewer(interaction)
+
+    async def on_timeout(self):
+        # 時間切れになったら元の審査ボタンに戻す
+        if self.message is not None and await get_pending_request(self.request.guild_id, self.request.request_id):
+            # 複数ページの申請は表示中のページとボタンの移動先を合わせるため、先頭ページに戻す
+            embed = build_request_embed(self.request) if len(request_renderer(self.request).pages) > 1 else None
+            try:
+                if embed is None:
+                    await outbound.edit_message(self.message, view=ApprovalView(self.request))
+                else:
+                    await outbound.edit_message(self.message, embed=embed, view=ApprovalView(self.request))
+            except discord.HTTPException:
+                pass
 
     @ui.select(placeholder="承認する品物をすべて選択してください...")
+    @timed("PartialApprovalView.item_select")
     async def item_select(self, interaction: discord.Interaction, select: ui.Select):
+        indices = self.page_indices()
+        self.approved_indices.difference_update(indices)
+        self.approved_indices.update(int(v) for v in select.values)
         await interaction.response.defer()
 
     @ui.button(label="この内容で確定", style=discord.ButtonStyle.success)
+    @timed("PartialApprovalView.confirm_button")
     async def confirm_button(self, interaction: discord.Interaction, button: ui.Button):
-        if not self.item_select.values:
+        if not self.approved_indices:
             await interaction.response.send_message("⚠️ 承認する品物を1つ以上選択してください。", ephemeral=True)
             return
 
-        approved_indices = {int(v) for v in self.item_select.values}
         approved_items = []
         rejected_items = []
 
         for i, item in enumerate(self.items):
-            if i in approved_indices:
+            if i in self.approved_indices:
                 approved_items.append(item)
             else:
                 rejected_items.append(item)
-        await self.original_view.finalize_approval(interaction, approved_items, rejected_items)
-
-class ApprovalView(ui.View):
-    def __init__(self, author: discord.User, items: list, budget_name: str, guild_id: int):
-        super().__init__(timeout=None)
-        self.author = author
-        self.items = items
-        self.budget_name = budget_name
-        self.guild_id = guild_id
-    
-    async def interaction_check(self, interaction: discord.Interaction) -> bool:
-        if not has_accounting_role(interaction.user):
-            await interaction.response.send_message("⚠️ この申請を審査する権限がありません。", ephemeral=True)
-            return False
-        return True
+        if await finalize_approval(interaction, self.request, approved_items, rejected_items):
+            self.stop()
+
+    @ui.button(label="前の25件", style=discord.ButtonStyle.secondary, emoji="◀️")
+    @timed("PartialApprovalView.prev_button")
+    async def prev_button(self, interaction: discord.Interaction, button: ui.Button):
+        self.page -= 1
+        self.show_page()
+        await interaction.response.defer()
+        outbound.edit_interaction(interaction, view=self)
 
-    async def finalize_approval(self, interaction: discord.Interaction, approved_items: list, rejected_items: list):
-        approver = interaction.user
-        approved_amount = sum(item['amount'] for item in approved_items)
-        load_guild_data(self.guild_id)
-        current_budgets = guild_data[self.guild_id]["budgets"]
+    @ui.button(label="次の25件", style=discord.ButtonStyle.secondary, emoji="▶️")
+    @timed("PartialApprovalView.next_button")
+    async def next_button(self, interaction: discord.Interaction, button: ui.Button):
+        self.page += 1
+        self.show_page()
+        await interaction.response.defer()
+        outbound.edit_interaction(interaction, view=self)
 
-        if approved_amount > 0:
-            current_budgets[self.budget_name] -= approved_amount
-            save_budgets(self.guild_id)
-        
+async def check_reviewer(interaction: discord.Interaction) -> bool:
+    if not await has_accounting_role(interaction.user):
+        await interaction.response.send_message("⚠️ この申請を審査する権限がありません。", ephemeral=True)
+        return False
+    return True
+
+@timed("finalize_approval")
+async def finalize_approval(interaction: discord.Interaction, request: PendingRequest, approved_items: list, rejected_items: list) -> bool:
+    """審査結果を予算と審査記録に反映し、申請メッセージを結果表示に置き換える。反映できたらTrueを返す"""
+    approver = interaction.user
+    guild_id = request.guild_id
+    budget_name = request.budget_name
+    approved_amount = sum(item.amount for item in approved_items)
+    # 反映はサーバーのロック待ちやストレージからの読み込みで3秒を超えることがあるので、先に応答しておく
+    if not interaction.response.is_done():
+        await interaction.response.defer()
+    status, balance = await apply_review_decision(guild_id, request, approver.display_name, approved_items, rejected_items)
+    if status == "duplicate":
+        await interaction.followup.send("ℹ️ この申請は既に審査済みです。", ephemeral=True)
+        return False
+    if status == "unknown_budget":
+        await interaction.followup.send(f"⚠️ 予算項目「{budget_name}」が存在しないため承認できません。", ephemeral=True)
+        return False
+    if status == "insufficient":
+        await interaction.followup.send(
+            f"⚠️ 予算「{budget_name}」の残高 (¥{balance:,}) が不足しているため、¥{approved_amount:,} を承認できません。",
+            ephemeral=True
+        )
+        return False
+    request_renderers.pop(request.request_id, None)
+
+    lines = []
+    if approved_items:
+        lines.append("**✅ 承認された品物**")
+        lines.extend(render_result_line(item) for item in approved_items)
+    if rejected_items:
+        if lines:
+            lines.append("")
+        lines.append("**❌ 却下された品物**")
+        lines.extend(render_result_line(item) for item in rejected_items)
+    pages = paginate_lines(lines)
+
+    footer_text = f"審査者: {approver.display_name}"
+    if approved_amount > 0:
+        footer_text += f"\n「{clip_text(budget_name, EMBED_NAME_LIMIT)}」から ¥{approved_amount:,} を支出 (残高: ¥{balance:,})"
+
+    embeds = []
+    for page, description in enumerate(pages):
         final_embed = discord.Embed(title="審査結果", color=discord.Color.dark_grey())
-        final_embed.set_author(name=f"申請者: {self.author.display_name}", icon_url=self.author.display_avatar)
-
-        description = ""
-        if approved_items:
-            description += "**✅ 承認された品物**\n"
-            for item in approved_items:
-                description += f"- {item['name']} (`¥{item.get('unit_price', item['amount']):,} × {item.get('quantity', 1)}個` = **¥{item['amount']:,}**) {item['link']}\n"
-        if rejected_items:
-            description += "\n**❌ 却下された品物**\n"
-            for item in rejected_items:
-                description += f"- {item['name']} (`¥{item.get('unit_price', item['amount']):,} × {item.get('quantity', 1)}個` = **¥{item['amount']:,}**) {item['link']}\n"
+        final_embed.set_author(name=clip_text(f"申請者: {request.author_name}", EMBED_NAME_LIMIT), icon_url=request.author_avatar)
         final_embed.description = description
+        final_embed.set_footer(text=page_footer(footer_text, page, len(pages)))
+        embeds.append(final_embed)
 
-        footer_text = f"審査者: {approver.display_name}"
-        if approved_amount > 0:
-            footer_text += f"\n「{self.budget_name}」から ¥{approved_amount:,} を支出 (残高: ¥{current_budgets[self.budget_name]:,})"
-        final_embed.set_footer(text=footer_text)
+    if len(embeds) == 1:
+        outbound.edit_interaction(interaction, embed=embeds[0], view=None)
+    else:
+        # 審査後の申請は保存されないので、結果のページ送りはメモリ上のビューで行う
+        view = EmbedPageView(embeds)
+        outbound.edit_interaction(interaction, embed=embeds[0], view=view)
+        view.message = interaction.message
+    return True
+
+# 審査ボタンの種類: (ラベル, スタイル)
+APPROVAL_ACTIONS = {
+    "approve": ("一括承認", discord.ButtonStyle.success),
+    "reject": ("一括却下", discord.ButtonStyle.danger),
+    "partial": ("個別審査", discord.ButtonStyle.secondary),
+}
+
+class ApprovalButton(ui.DynamicItem[ui.Button], template=r"budget:(?P<action>approve|reject|partial):(?P<guild_id>[0-9]+):(?P<request_id>[0-9a-f]+)"):
+    """custom_idに申請のキーを埋め込んだ審査ボタン。再起動後も bot.add_dynamic_items で一括して復元される"""
+
+    def __init__(self, action: str, guild_id: int, request_id: str):
+        label, style = APPROVAL_ACTIONS[action]
+        super().__init__(ui.Button(label=label, style=style, custom_id=f"budget:{action}:{guild_id}:{request_id}"))
+        self.action = action
+        self.guild_id = guild_id
+        self.request_id = request_id
 
-        save_review_result_partial(self.guild_id, self.author.display_name, self.budget_name, approver.display_name, approved_items, rejected_items)
-        await interaction.response.edit_message(embed=final_embed, view=None)
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: ui.Button, match):
+        return cls(match["action"], int(match["guild_id"]), match["request_id"])
 
-    @ui.button(label="一括承認", style=discord.ButtonStyle.success)
-    async def approve_all_button(self, interaction: discord.Interaction, button: ui.Button):
-        await self.finalize_approval(interaction, self.items, [])
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return await check_reviewer(interaction)
 
-    @ui.button(label="一括却下", style=discord.ButtonStyle.danger)
-    async def reject_all_button(self, interaction: discord.Interaction, button: ui.Button):
-        await self.finalize_approval(interaction, [], self.items)
+    @timed("ApprovalButton.callback")
+    async def callback(self, interaction: discord.Interaction):
+        # 申請の読み込みにも時間がかかることがあるので、先に応答しておく
+        await interaction.response.defer()
+        request = await get_pending_request(self.guild_id, self.request_id)
+        if request is None:
+            await interaction.followup.send("ℹ️ この申請は既に審査済みか、見つかりませんでした。", ephemeral=True)
+            return
+        if self.action == "approve":
+            await finalize_approval(interaction, request, request.items, [])
+        elif self.action == "reject":
+            await finalize_approval(interaction, request, [], request.items)
+        else:
+            view = PartialApprovalView(request)
+            outbound.edit_interaction(interaction, view=view)
+            view.message = interaction.message
+
+class RequestPageButton(ui.DynamicItem[ui.Button], template=r"budget:page:(?P<guild_id>[0-9]+):(?P<request_id>[0-9a-f]+):(?P<page>[0-9]+)"):
+    """投稿済みの申請のページ送りボタン。移動先のページをcustom_idに持つので再起動後も使える"""
+
+    def __init__(self, guild_id: int, request_id: str, page: int, label: str, emoji: str, disabled: bool = False):
+        super().__init__(ui.Button(
+            label=label, emoji=emoji, style=discord.ButtonStyle.secondary, disabled=disabled,
+            custom_id=f"budget:page:{guild_id}:{request_id}:{page}"
+        ))
+        self.guild_id = guild_id
+        self.request_id = request_id
+        self.page = page
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: ui.Button, match):
+        return cls(int(match["guild_id"]), match["request_id"], int(match["page"]), item.label, item.emoji)
+
+    @timed("RequestPageButton.callback")
+    async def callback(self, interaction: discord.Interaction):
+        request = await get_pending_request(self.guild_id, self.request_id)
+        if request is None:
+            await interaction.response.send_message("ℹ️ この申請は既に審査済みか、見つかりませんでした。", ephemeral=True)
+            return
+        await interaction.response.defer()
+        outbound.edit_interaction(interaction, embed=build_request_embed(request, self.page), view=ApprovalView(request, self.page))
 
-    @ui.button(label="個別審査", style=discord.ButtonStyle.secondary)
-    async def partial_approval_button(self, interaction: discord.Interaction, button: ui.Button):
-        view = PartialApprovalView(original_view=self)
-        await interaction.response.edit_message(view=view)
+class ApprovalView(ui.View):
+    def __init__(self, request: PendingRequest, page: int = 0):
+        super().__init__(timeout=None)
+        for action in APPROVAL_ACTIONS:
+            self.add_item(ApprovalButton(action, request.guild_id, request.request_id))
+        page_count = len(request_renderer(request).pages)
+        if page_count > 1:
+            # 前後のボタンは移動先のページが違うのでcustom_idが重ならない
+            self.add_item(RequestPageButton(request.guild_id, request.request_id, max(page - 1, 0), "前のページ", "◀️", disabled=page == 0))
+            self.add_item(RequestPageButton(request.guild_id, request.request_id, min(page + 1, page_count - 1), "次のページ", "▶️", disabled=page >= page_count - 1))
 
 # --- Bot Checks and Events ---
 
@@ -368,11 +1252,12 @@ class ApprovalView(ui.View):
 async def is_in_registered_channel(ctx: commands.Context):
     if not ctx.guild:
         return False
-    load_guild_data(ctx.guild.id)
-    registered_channels = guild_data[ctx.guild.id]["channels"]
+    data = await load_guild_data(ctx.guild.id)
+    registered_channels = data["channels"]
     management_commands = [
         "register_channel", "unregister_channel", "list_channels", 
-        "add_accounting_role", "remove_accounting_role", "list_accounting_roles"
+        "add_accounting_role", "remove_accounting_role", "list_accounting_roles",
+        "no_overdraft", "cache_stats", "stats"
     ]
     if ctx.command and ctx.command.name in management_commands:
         return True
@@ -380,6 +1265,23 @@ async def is_in_registered_channel(ctx: commands.Context):
         return True
     return ctx.channel.id in registered_channels
     
+@bot.before_invoke
+async def start_command_timer(ctx: commands.Context):
+    ctx.started_at = time.perf_counter()
+
+@bot.after_invoke
+async def record_command_timing(ctx: commands.Context):
+    metrics.observe(
+        "budgetbot_command_seconds", time.perf_counter() - ctx.started_at,
+        command=ctx.command.qualified_name, status="error" if ctx.command_failed else "ok"
+    )
+
+def unwrap_command_error(error: Exception) -> Exception:
+    """CommandInvokeError・HybridCommandError などに包まれた元の例外を取り出す"""
+    while getattr(error, "original", None) is not None:
+        error = error.original
+    return error
+
 @bot.event
 async def on_command_error(ctx, error):
     if isinstance(error, commands.CheckFailure):
@@ -388,6 +1290,12 @@ async def on_command_error(ctx, error):
         await ctx.send("⚠️ このコマンドを実行する管理者権限がありません。")
     elif isinstance(error, commands.CommandNotFound):
         pass
+    elif isinstance(error, commands.UserInputError):
+        await ctx.send(f"⚠️ 引数が正しくありません: {error}")
+    elif isinstance(unwrap_command_error(error), GuildNotOwned):
+        # シャードの割り当てが変わった直後などに、別のクラスタが受け持つサーバーのコマンドが届くことがある
+        print(f"Skipped a command for another cluster: {unwrap_command_error(error)}")
+        await ctx.send("⚠️ このサーバーは現在別のプロセスが担当しています。しばらくしてからもう一度お試しください。")
     else:
         print(f"Unhandled error: {error}")
 
@@ -395,50 +1303,81 @@ async def on_command_error(ctx, error):
 async def on_ready():
     print(f"✅ Botログイン成功: {bot.user}")
     os.makedirs(DATA_DIR, exist_ok=True)
-    print("--- 所属サーバーのデータチェック ---")
-    for guild in bot.guilds:
-        print(f"-> サーバー: {guild.name} ({guild.id})")
-        load_guild_data(guild.id)
-    print("---------------------------------")
-    print("📢 全サーバーのデータをロードしました。")
+    # 残りのサーバーは最初に使われたときに読み込む
+    started = time.perf_counter()
+    await guild_data.preload([guild.id for guild in bot.guilds if owns_guild(guild.id)], PRELOAD_CONCURRENCY)
+    elapsed = time.perf_counter() - started
+    print(f"📢 {len(bot.guilds)} サーバー中 {len(guild_data)} サーバーのデータを先読みしました ({elapsed:.2f}秒)。")
+    # 再接続でも呼ばれるので、起動時間は最初の1回だけ記録する
+    if bot.startup_seconds is None:
+        bot.startup_seconds = time.perf_counter() - PROCESS_STARTED_AT
+        rss = process_rss_bytes()
+        rss_text = f"{rss / 1024 / 1024:,.1f} MiB" if rss is not None else "不明"
+        print(
+            f"⏱️ 起動から準備完了まで {bot.startup_seconds:.1f}秒 / メモリ (RSS) {rss_text} / "
+            f"キャッシュ済みメンバー {cached_member_count():,}人 (LOW_MEMORY_MODE: {'on' if LOW_MEMORY_MODE else 'off'})"
+        )
+    if bot.shard_ids is not None:
+        print(f"🧩 クラスタ {CLUSTER_ID}: シャード {bot.shard_ids} / 全 {bot.shard_count} シャード")
+
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    if before.roles != after.roles:
+        permission_cache.invalidate_member(after.guild.id, after.id)
+
+@bot.event
+async def on_member_remove(member: discord.Member):
+    # 再参加したときはロールなしから始まるので、残っている判定結果を捨てる
+    permission_cache.invalidate_member(member.guild.id, member.id)
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    guild_id = role.guild.id
+    permission_cache.invalidate_guild(guild_id)
+    data = await load_guild_data(guild_id)
+    if role.id in data["additional_roles"]:
+        data["additional_roles"].discard(role.id)
+        save_settings(guild_id, data)
 
 # --- Management Commands ---
 
-@bot.command()
+@bot.hybrid_command()
 @commands.has_permissions(administrator=True)
 async def add_accounting_role(ctx, role: discord.Role):
     """【管理者用】このサーバーで会計権限を持つロールを追加します。"""
     guild_id = ctx.guild.id
-    load_guild_data(guild_id)
+    data = await load_guild_data(guild_id)
     
-    if role.id in guild_data[guild_id]["additional_roles"]:
+    if role.id in data["additional_roles"]:
         await ctx.send(f"✅ ロール {role.mention} は既に登録されています。")
         return
         
-    guild_data[guild_id]["additional_roles"].add(role.id)
-    save_settings(guild_id)
+    data["additional_roles"].add(role.id)
+    save_settings(guild_id, data)
+    permission_cache.invalidate_guild(guild_id)
     await ctx.send(f"✅ 会計ロールとして {role.mention} を追加しました。")
 
-@bot.command()
+@bot.hybrid_command()
 @commands.has_permissions(administrator=True)
 async def remove_accounting_role(ctx, role: discord.Role):
     """【管理者用】サーバーに追加された会計ロールを削除します。"""
     guild_id = ctx.guild.id
-    load_guild_data(guild_id)
+    data = await load_guild_data(guild_id)
 
-    if role.id not in guild_data[guild_id]["additional_roles"]:
+    if role.id not in data["additional_roles"]:
         await ctx.send(f"ℹ️ ロール {role.mention} はこのサーバーの会計ロールとして登録されていません。")
         return
 
-    guild_data[guild_id]["additional_roles"].discard(role.id)
-    save_settings(guild_id)
+    data["additional_roles"].discard(role.id)
+    save_settings(guild_id, data)
+    permission_cache.invalidate_guild(guild_id)
     await ctx.send(f"✅ 会計ロール {role.mention} を削除しました。")
 
-@bot.command()
+@bot.hybrid_command()
 async def list_accounting_roles(ctx):
     """現在有効な会計ロールの一覧を表示します。"""
     guild_id = ctx.guild.id
-    load_guild_data(guild_id)
+    data = await load_guild_data(guild_id)
     
     embed = discord.Embed(title="🔒 会計権限を持つロール一覧", color=discord.Color.dark_green())
     
@@ -448,7 +1387,7 @@ async def list_accounting_roles(ctx):
         common_role_str = role.mention if role else f"不明なロール (ID: {ALLOWED_ROLE_ID})"
     embed.add_field(name="共通ロール (config.jsonで指定)", value=common_role_str, inline=False)
     
-    server_roles = guild_data[guild_id].get("additional_roles", set())
+    server_roles = data.get("additional_roles", set())
     server_roles_str = "なし"
     if server_roles:
         role_mentions = []
@@ -460,38 +1399,41 @@ async def list_accounting_roles(ctx):
     
     await ctx.send(embed=embed)
 
-@bot.command()
+@bot.hybrid_command()
 @commands.has_permissions(administrator=True)
 async def register_channel(ctx, channel: discord.TextChannel = None):
+    """【管理者用】チャンネルを予算申請用に登録します (省略時はこのチャンネル)。"""
     target_channel = channel or ctx.channel
     guild_id = ctx.guild.id
-    load_guild_data(guild_id)
-    if target_channel.id in guild_data[guild_id]["channels"]:
+    data = await load_guild_data(guild_id)
+    if target_channel.id in data["channels"]:
         await ctx.send(f"✅ チャンネル {target_channel.mention} は既に登録されています。")
         return
-    guild_data[guild_id]["channels"].add(target_channel.id)
-    save_channels(guild_id)
+    data["channels"].add(target_channel.id)
+    save_channels(guild_id, data)
     await ctx.send(f"✅ チャンネル {target_channel.mention} を登録しました。")
 
-@bot.command()
+@bot.hybrid_command()
 @commands.has_permissions(administrator=True)
 async def unregister_channel(ctx, channel: discord.TextChannel = None):
+    """【管理者用】予算申請用のチャンネルの登録を解除します (省略時はこのチャンネル)。"""
     target_channel = channel or ctx.channel
     guild_id = ctx.guild.id
-    load_guild_data(guild_id)
-    if target_channel.id not in guild_data[guild_id]["channels"]:
+    data = await load_guild_data(guild_id)
+    if target_channel.id not in data["channels"]:
         await ctx.send(f"ℹ️ チャンネル {target_channel.mention} は登録されていません。")
         return
-    guild_data[guild_id]["channels"].discard(target_channel.id)
-    save_channels(guild_id)
+    data["channels"].discard(target_channel.id)
+    save_channels(guild_id, data)
     await ctx.send(f"✅ チャンネル {target_channel.mention} の登録を解除しました。")
 
-@bot.command()
+@bot.hybrid_command()
 @commands.has_permissions(administrator=True)
 async def list_channels(ctx):
+    """【管理者用】予算申請用に登録されたチャンネルの一覧を表示します。"""
     guild_id = ctx.guild.id
-    load_guild_data(guild_id)
-    registered_channels = guild_data[guild_id]["channels"]
+    data = await load_guild_data(guild_id)
+    registered_channels = data["channels"]
     if not registered_channels:
         await ctx.send("現在、このサーバーで登録されているチャンネルはありません。")
         return
@@ -500,56 +1442,314 @@ async def list_channels(ctx):
     embed.description = "\n".join(channel_links)
     await ctx.send(embed=embed)
 
+@bot.hybrid_command()
+@commands.has_permissions(administrator=True)
+async def no_overdraft(ctx, mode: str):
+    """【管理者用】予算残高を超える承認を禁止するかどうかを設定します (on/off)。"""
+    if mode not in ("on", "off"):
+        await ctx.send("⚠️ `on` または `off` を指定してください。")
+        return
+    guild_id = ctx.guild.id
+    async with get_guild_lock(guild_id):
+        data = await load_guild_data(guild_id)
+        data["no_overdraft"] = mode == "on"
+        save_settings(guild_id, data)
+    if mode == "on":
+        await ctx.send("✅ 残高を超える承認を禁止しました。")
+    else:
+        await ctx.send("✅ 残高を超える承認を許可しました。")
+
+@bot.hybrid_command()
+@commands.has_permissions(administrator=True)
+async def cache_stats(ctx):
+    """【管理者用】サーバーデータのキャッシュ状況を表示します。"""
+    lookups = guild_data.hits + guild_data.misses
+    hit_rate = guild_data.hits / lookups * 100 if lookups else 0
+    embed = discord.Embed(title="🗃️ キャッシュ状況", color=discord.Color.blue())
+    embed.add_field(name="保持サーバー数", value=f"{len(guild_data):,} / {guild_data.max_guilds:,}", inline=True)
+    embed.add_field(name="推定メモリ", value=f"{guild_data.total_bytes / 1024:,.1f} KiB", inline=True)
+    embed.add_field(name="ヒット / ミス", value=f"{guild_data.hits:,} / {guild_data.misses:,} ({hit_rate:.1f}%)", inline=False)
+    embed.add_field(name="追い出し回数", value=f"{guild_data.evictions:,}", inline=True)
+    permission_lookups = permission_cache.hits + permission_cache.misses
+    permission_hit_rate = permission_cache.hits / permission_lookups * 100 if permission_lookups else 0
+    embed.add_field(
+        name="会計権限の判定 ヒット / ミス",
+        value=f"{permission_cache.hits:,} / {permission_cache.misses:,} ({permission_hit_rate:.1f}%)",
+        inline=False
+    )
+    embed.add_field(name="判定結果の保持数", value=f"{len(permission_cache):,} / {permission_cache.max_entries:,}", inline=True)
+    embed.add_field(name="判定結果の無効化回数", value=f"{permission_cache.invalidations:,}", inline=True)
+    embed.add_field(
+        name="審査待ちの申請 メモリから外した / 読み直した",
+        value=f"{dormant_requests.evictions:,} / {dormant_requests.rehydrations:,}",
+        inline=False
+    )
+    if LINK_PREVIEW:
+        embed.add_field(
+            name="リンク先の情報 メモリ / ディスク / 読み込み (失敗)",
+            value=f"{link_previews.hits:,} / {link_previews.disk_hits:,} / {link_previews.fetches:,} ({link_previews.failures:,}) ・ 保持 {len(link_previews):,}件",
+            inline=False
+        )
+    rss = process_rss_bytes()
+    embed.add_field(name="プロセスのメモリ (RSS)", value=f"{rss / 1024 / 1024:,.1f} MiB" if rss is not None else "不明", inline=True)
+    embed.add_field(name="キャッシュ済みメンバー", value=f"{cached_member_count():,}人", inline=True)
+    startup_seconds = getattr(bot, "startup_seconds", None)
+    if startup_seconds is not None:
+        embed.add_field(name="起動にかかった時間", value=f"{startup_seconds:.1f}秒", inline=True)
+    await ctx.send(embed=embed)
+
+def collect_metric_samples() -> list:
+    """メトリクスのエンドポイントで公開する現在値 (名前, 種類, 値)"""
+    return [
+        ("budgetbot_guild_cache_entries", "gauge", len(guild_data)),
+        ("budgetbot_guild_cache_bytes", "gauge", guild_data.total_bytes),
+        ("budgetbot_guild_cache_hits_total", "counter", guild_data.hits),
+        ("budgetbot_guild_cache_misses_total", "counter", guild_data.misses),
+        ("budgetbot_guild_cache_evictions_total", "counter", guild_data.evictions),
+        ("budgetbot_permission_cache_hits_total", "counter", permission_cache.hits),
+        ("budgetbot_permission_cache_misses_total", "counter", permission_cache.misses),
+        ("budgetbot_pending_writes", "gauge", persistence.pending_count()),
+        ("budgetbot_pending_requests_evicted_total", "counter", dormant_requests.evictions),
+        ("budgetbot_pending_requests_rehydrated_total", "counter", dormant_requests.rehydrations),
+        ("budgetbot_review_log_buffered_rows", "gauge", review_log.buffered_rows),
+        ("budgetbot_review_search_indexes", "gauge", len(review_search)),
+        ("budgetbot_review_search_rows", "gauge", review_search.total_rows()),
+        ("budgetbot_review_search_builds_total", "counter", review_search.builds),
+        ("budgetbot_link_preview_entries", "gauge", len(link_previews)),
+        ("budgetbot_link_preview_hits_total", "counter", link_previews.hits),
+        ("budgetbot_link_preview_disk_hits_total", "counter", link_previews.disk_hits),
+        ("budgetbot_link_preview_fetches_total", "counter", link_previews.fetches),
+        ("budgetbot_link_preview_failures_total", "counter", link_previews.failures),
+        ("budgetbot_snapshots_total", "counter", snapshots.taken),
+        ("budgetbot_snapshot_failures_total", "counter", snapshots.failures),
+        ("budgetbot_snapshot_stored_bytes", "gauge", (snapshots.last_stats or {}).get("stored_bytes", 0)),
+        ("budgetbot_gateway_latency_seconds", "gauge", 0.0 if math.isnan(bot.latency) else bot.latency),
+        ("budgetbot_process_resident_bytes", "gauge", process_rss_bytes() or 0),
+        ("budgetbot_startup_seconds", "gauge", getattr(bot, "startup_seconds", None) or 0.0),
+        ("budgetbot_cached_members", "gauge", cached_member_count()),
+        *((f'budgetbot_outbound_queue_depth{{route="{route}"}}', "gauge", depth) for route, depth in outbound.queue_depths().items()),
+        ("budgetbot_outbound_completed_total", "counter", outbound.completed),
+        ("budgetbot_outbound_coalesced_total", "counter", outbound.coalesced),
+        ("budgetbot_outbound_throttled_total", "counter", outbound.throttled),
+    ]
+
+STATS_MAX_LINES = 25
+
+@bot.hybrid_command()
+@commands.has_permissions(administrator=True)
+async def stats(ctx, kind: str = None):
+    """【管理者用】コマンド・ボタン・保存処理・Discord APIの処理時間を合計時間の長い順に表示します。
+    例: !stats / !stats command / !stats callback / !stats storage / !stats discord_http / !stats outbound"""
+    entries = [
+        (name, labels, histogram) for name, labels, histogram in metrics.histograms()
+        if kind is None or name == f"budgetbot_{kind}_seconds"
+    ]
+    if not entries:
+        await ctx.send("ℹ️ まだ計測結果がありません。")
+        return
+    entries.sort(key=lambda entry: entry[2].total, reverse=True)
+    lines = []
+    for name, labels, histogram in entries[:STATS_MAX_LINES]:
+        label_text = " ".join(str(v) for v in labels.values())
+        lines.append(
+            f"`{name[len('budgetbot_'):-len('_seconds')]}` **{label_text}**\n"
+            f"{histogram.count:,}回 / 平均 {histogram.total / histogram.count * 1000:.1f}ms / "
+            f"p50 {histogram.quantile(0.5) * 1000:.1f}ms / p99 {histogram.quantile(0.99) * 1000:.1f}ms / "
+            f"最大 {histogram.max * 1000:.1f}ms"
+        )
+    embed = discord.Embed(title="⏱️ 処理時間", color=discord.Color.blue())
+    embed.description = paginate_lines(lines)[0]
+    depths = outbound.queue_depths()
+    embed.add_field(
+        name="送信待ち (送信 / 編集 / 応答の編集)",
+        value=f"{depths['channel_send']:,} / {depths['channel_edit']:,} / {depths['interaction_edit']:,} "
+              f"(まとめた編集 {outbound.coalesced:,}件・制限待ち {outbound.throttled:,}回)",
+        inline=False
+    )
+    if len(entries) > STATS_MAX_LINES:
+        embed.set_footer(text=f"合計時間の上位 {STATS_MAX_LINES} 件を表示 (全 {len(entries)} 件)")
+    await ctx.send(embed=embed)
 
 # --- Bot Commands ---
+# どのコマンドもスラッシュコマンドとしても使えるようにしている (LOW_MEMORY_MODEではメッセージ本文が届かないため)
+
+async def send_command_result(ctx, **kwargs):
+    """プレフィックスのコマンドは送信キューからチャンネルに投稿し、スラッシュコマンドはインタラクションへの応答として送る"""
+    if ctx.interaction is not None:
+        return await ctx.send(**kwargs)
+    return await outbound.send(ctx.channel, **kwargs)
 
-@bot.command()
+@bot.hybrid_command()
 async def request(ctx):
+    """複数の品物をまとめて予算申請します。"""
     guild_id = ctx.guild.id
-    load_guild_data(guild_id)
-    if not guild_data[guild_id]["budgets"]:
+    data = await load_guild_data(guild_id)
+    if not data["budgets"]:
         await ctx.send("現在、このサーバーで登録されている予算はありません。")
         return
-    view = MultiItemRequestView(author=ctx.author, guild_id=guild_id)
+    view = MultiItemRequestView(author=ctx.author, guild_id=guild_id, budgets=data["budgets"])
     embed = view.create_embed()
-    await ctx.send(embed=embed, view=view)
+    await send_command_result(ctx, embed=embed, view=view)
     
-@bot.command()
+@bot.hybrid_command()
 async def budget(ctx):
+    """予算項目ごとの残高を表示します。"""
     guild_id = ctx.guild.id
-    load_guild_data(guild_id)
-    current_budgets = guild_data[guild_id]["budgets"]
+    data = await load_guild_data(guild_id)
+    current_budgets = data["budgets"]
     if not current_budgets:
         await ctx.send("現在、このサーバーで登録されている予算はありません。")
         return
-    embed = discord.Embed(title="💰 現在の予算状況", color=discord.Color.gold())
-    for name, amount in current_budgets.items():
-        embed.add_field(name=name, value=f"¥{amount:,}", inline=False)
-    await ctx.send(embed=embed)
+    # Embedのフィールドは25個までなので、予算が多いサーバーでも収まるよう説明文に並べてページに分ける
+    pages = paginate_lines(f"**{name}**: ¥{amount:,}" for name, amount in current_budgets.items())
+    footer = f"{len(current_budgets):,}件"
+    embeds = []
+    for page, description in enumerate(pages):
+        embed = discord.Embed(title="💰 現在の予算状況", description=description, color=discord.Color.gold())
+        embed.set_footer(text=page_footer(footer, page, len(pages)))
+        embeds.append(embed)
+    if len(embeds) == 1:
+        await send_command_result(ctx, embed=embeds[0])
+        return
+    view = EmbedPageView(embeds)
+    view.message = await send_command_result(ctx, embed=embeds[0], view=view)
 
-@bot.command()
+@bot.hybrid_command()
 async def add_budget(ctx, name: str, amount: int):
     """【会計ロール用】予算を追加・補充します。"""
-    if not has_accounting_role(ctx.author):
+    if not await has_accounting_role(ctx.author):
         await ctx.send("⚠️ このコマンドを実行する権限がありません。")
         return
         
     guild_id = ctx.guild.id
-    load_guild_data(guild_id)
-    current_budgets = guild_data[guild_id]["budgets"]
-    current_budgets[name] = current_budgets.get(name, 0) + amount
-    save_budgets(guild_id)
-    await ctx.send(f"✅ 予算「{name}」に ¥{amount:,} を追加しました。現在の残高: ¥{current_budgets[name]:,}")
+    async with get_guild_lock(guild_id):
+        data = await load_guild_data(guild_id)
+        kind = "credit" if amount >= 0 else "adjustment"
+        balance = post_ledger_entry(guild_id, data, name, amount, kind, actor=ctx.author.display_name)
+        budget_index(data).add(name)
+    await ctx.send(f"✅ 予算「{name}」に ¥{amount:,} を追加しました。現在の残高: ¥{balance:,}")
+
+LEDGER_KIND_LABELS = {"credit": "追加", "debit": "承認", "adjustment": "調整", "review": "審査 (引き落としなし)"}
+LEDGER_MAX_LINES = 50
+
+def format_ledger_entry(entry: dict) -> str:
+    label = LEDGER_KIND_LABELS.get(entry["kind"], entry["kind"])
+    line = f"`#{entry['seq']}` {entry['at'][:16].replace('T', ' ')} {label} **{entry['budget']}** {entry['delta']:+,}円"
+    if entry.get("actor"):
+        line += f" ({entry['actor']})"
+    return line
+
+def format_balance_differences(expected: dict, actual: dict) -> list:
+    return [
+        f"**{name}**: 台帳 ¥{expected.get(name, 0):,} / 現在 ¥{actual.get(name, 0):,}"
+        for name in sorted(expected.keys() | actual.keys())
+        if expected.get(name, 0) != actual.get(name, 0)
+    ]
+
+@bot.hybrid_command()
+async def ledger(ctx, budget_name: str = None, limit: int = 20):
+    """【会計ロール用】予算の取引履歴を表示します。
+    例: !ledger / !ledger F3EC 50 / !ledger verify / !ledger rebuild"""
+    if not await has_accounting_role(ctx.author):
+        await ctx.send("⚠️ このコマンドを実行する権限がありません。")
+        return
+    # 台帳をたどると時間がかかることがあるので、スラッシュコマンドなら先に応答しておく
+    await ctx.defer()
+
+    guild_id = ctx.guild.id
+    data = await load_guild_data(guild_id)
+    if budget_name in ("verify", "rebuild"):
+        # 最初のスナップショットからすべての取引をたどり直し、現在の残高と比べる
+        async with get_guild_lock(guild_id):
+            replayed = await replay_guild_ledger(guild_id, data, full=True)
+            differences = format_balance_differences(replayed, data["budgets"])
+            if differences and budget_name == "rebuild":
+                data["budgets"].clear()
+                data["budgets"].update(replayed)
+                data.pop("budget_index", None)
+                data["ledger_force_snapshot"] = True
+                save_ledger(guild_id, data)
+        if not differences:
+            await ctx.send("✅ 台帳の取引から計算した残高と現在の残高は一致しています。")
+            return
+        header = "✅ 台帳の取引から残高を作り直しました。" if budget_name == "rebuild" else "⚠️ 台帳と現在の残高が食い違っています (`!ledger rebuild` で台帳に合わせます)。"
+        await ctx.send(clip_text("\n".join([header, *differences]), MESSAGE_LIMIT))
+        return
+
+    limit = max(1, min(limit, LEDGER_MAX_LINES))
+    stored = await asyncio.get_running_loop().run_in_executor(None, storage.recent_ledger_entries, guild_id, budget_name, limit)
+    # まだ書き出していない取引も含める
+    entries = {entry["seq"]: entry for entry in stored}
+    entries.update((entry["seq"], entry) for entry in data["ledger"] if budget_name is None or entry["budget"] == budget_name)
+    entries = [entries[seq] for seq in sorted(entries)[-limit:]]
+    if not entries:
+        await ctx.send("ℹ️ 台帳に取引がありません。")
+        return
+    title = f"📒 予算「{budget_name}」の取引履歴" if budget_name else "📒 予算の取引履歴"
+    embeds = [
+        discord.Embed(title=title, description=page, color=discord.Color.gold())
+        for page in paginate_lines([format_ledger_entry(entry) for entry in entries])
+    ]
+    if budget_name is not None and budget_name in data["budgets"]:
+        embeds[-1].set_footer(text=f"現在の残高: ¥{data['budgets'][budget_name]:,}")
+    for embed in embeds:
+        await ctx.send(embed=embed)
+
+def parse_ledger_time(value: str) -> str:
+    """日付 (その日の終わり) または日時を YYYY-MM-DDTHH:MM:SS 形式にする"""
+    try:
+        if len(value) == 10:
+            return datetime.date.fromisoformat(value).isoformat() + "T23:59:59"
+        return datetime.datetime.fromisoformat(value).strftime("%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        raise commands.BadArgument(f"日時は YYYY-MM-DD または YYYY-MM-DDTHH:MM 形式で指定してください: {value}")
+
+@bot.hybrid_command()
+async def balance_at(ctx, when: str, *, budget_name: str = None):
+    """【会計ロール用】指定した日時の時点の予算残高を表示します。
+    例: !balance_at 2025-03-31 / !balance_at 2025-04-01T12:00 F3EC"""
+    if not await has_accounting_role(ctx.author):
+        await ctx.send("⚠️ このコマンドを実行する権限がありません。")
+        return
+    await ctx.defer()
+
+    upto = parse_ledger_time(when)
+    guild_id = ctx.guild.id
+    data = await load_guild_data(guild_id)
+    balances = await replay_guild_ledger(guild_id, data, upto)
+    label = upto.replace("T", " ")
+    if balances is None:
+        await ctx.send(f"ℹ️ {label} 時点の台帳の記録はありません。")
+        return
+    if budget_name is not None:
+        if budget_name not in balances:
+            await ctx.send(f"ℹ️ {label} 時点で予算「{budget_name}」はまだありません。")
+            return
+        balances = {budget_name: balances[budget_name]}
+    if not balances:
+        await ctx.send(f"ℹ️ {label} 時点で登録されている予算はありません。")
+        return
+    for page in paginate_lines([f"**{name}**: ¥{amount:,}" for name, amount in balances.items()]):
+        await ctx.send(embed=discord.Embed(title=f"💰 {label} 時点の予算残高", description=page, color=discord.Color.gold()))
     
-@bot.command()
+@bot.hybrid_command()
+@app_commands.describe(
+    applicant="申請者名", item="購入物", link="参考リンク", amount="単価", budget_name="予算項目 (入力すると候補が出ます)", quantity="個数"
+)
 async def send(ctx, applicant: str, item: str, link: str, amount: int, budget_name: str, quantity: int = 1):
     """単一の購入申請を送信します。 amountは単価です。"""
     guild_id = ctx.guild.id
-    load_guild_data(guild_id)
-    current_budgets = guild_data[guild_id]["budgets"]
+    # スラッシュコマンドのときは先に応答し、申請は通常のメッセージとして投稿する
+    await ctx.defer(ephemeral=True)
+    data = await load_guild_data(guild_id)
+    current_budgets = data["budgets"]
     
     if budget_name not in current_budgets:
-        await ctx.send(f"⚠️ **エラー:** 予算項目「{budget_name}」は存在しません。")
+        suggestions = budget_index(data).search(budget_name, 5)
+        message = f"⚠️ **エラー:** 予算項目「{budget_name}」は存在しません。"
+        if suggestions:
+            message += f"\n候補: {' / '.join(suggestions)}"
+        await ctx.send(message)
         return
      
     if quantity <= 0:
@@ -557,44 +1757,591 @@ async def send(ctx, applicant: str, item: str, link: str, amount: int, budget_na
         return
     total_amount = amount * quantity
 
-    embed = discord.Embed(title="購入申請", color=discord.Color.gold())
-    embed.set_author(name=f"申請者: {applicant}", icon_url=ctx.author.display_avatar)
-    embed.add_field(name="購入物", value=item, inline=False)
-    embed.add_field(name="リンク", value=link, inline=False)
-    embed.add_field(name="単価", value=f"¥{amount:,}", inline=True)
-    embed.add_field(name="個数", value=f"{quantity}", inline=True)
-    embed.add_field(name="💰 合計金額", value=f"¥{total_amount:,}", inline=True)
-    embed.add_field(name="🧾 予算項目", value=budget_name, inline=True)
-    embed.set_footer(text="ステータス: 審査中")
-
-    items = [{"name": item, "link": link, "amount": total_amount, "unit_price": amount, "quantity": quantity}]
-    approval_view = ApprovalView(author=ctx.author, items=items, budget_name=budget_name, guild_id=guild_id)
-    await ctx.send(embed=embed, view=approval_view)
-
-@bot.command()
-async def export_csv(ctx):
-    """【会計ロール用】これまでの申請・審査結果をCSVファイルで出力します。"""
-    if not has_accounting_role(ctx.author):
+    def build_embed() -> discord.Embed:
+        embed = discord.Embed(title="購入申請", color=discord.Color.gold())
+        embed.set_author(name=clip_text(f"申請者: {applicant}", EMBED_NAME_LIMIT), icon_url=ctx.author.display_avatar)
+        embed.add_field(name="購入物", value=clip_text(item, EMBED_FIELD_LIMIT), inline=False)
+        embed.add_field(name="リンク", value=clip_text(link, EMBED_FIELD_LIMIT), inline=False)
+        preview = link_previews.peek(link) if LINK_PREVIEW else None
+        if preview is not None:
+            embed.add_field(name="リンク先", value=clip_text(format_link_preview(preview, amount), EMBED_FIELD_LIMIT), inline=False)
+        embed.add_field(name="単価", value=f"¥{amount:,}", inline=True)
+        embed.add_field(name="個数", value=f"{quantity}", inline=True)
+        embed.add_field(name="💰 合計金額", value=f"¥{total_amount:,}", inline=True)
+        embed.add_field(name="🧾 予算項目", value=clip_text(budget_name, EMBED_NAME_LIMIT), inline=True)
+        embed.set_footer(text="ステータス: 審査中")
+        return embed
+
+    items = [RequestItem(item, link, amount, quantity)]
+    request = await open_pending_request(ctx.author.id, ctx.author.display_name, str(ctx.author.display_avatar.url), guild_id, items, budget_name)
+    message = await outbound.send(ctx.channel, embed=build_embed(), view=ApprovalView(request))
+    await attach_request_message(request, message)
+    schedule_link_previews(request, message, build_embed)
+    if ctx.interaction is not None:
+        await ctx.send("✅ 申請を送信しました。")
+
+@send.autocomplete("budget_name")
+@timed("send.autocomplete")
+async def send_budget_name_autocomplete(interaction: discord.Interaction, current: str) -> list:
+    try:
+        data = await load_guild_data(interaction.guild_id)
+    except GuildNotOwned as e:
+        # 入力補完は on_command_error を通らないので、ここで候補なしにする
+        print(f"Skipped an autocomplete for another cluster: {e}")
+        return []
+    # 選択肢の値は100文字までなので、それより長い予算名は候補に出せない
+    return [
+        app_commands.Choice(name=name, value=name)
+        for name in budget_index(data).search(current, BUDGET_SUGGESTION_LIMIT * 2)
+        if len(name) <= 100
+    ][:BUDGET_SUGGESTION_LIMIT]
+
+# 一括申請の列名 (見出し行で使える名前)
+BULK_COLUMNS = {
+    "name": ("購入物", "品名", "name", "item"),
+    "link": ("リンク", "参考リンク", "link", "url"),
+    "unit_price": ("単価", "unit_price", "price"),
+    "quantity": ("個数", "数量", "quantity", "qty"),
+    "budget_name": ("予算項目", "予算", "budget", "budget_name"),
+}
+BULK_REQUEST_MAX_BYTES = 1024 * 1024
+MESSAGE_LIMIT = 2000
+
+def decode_bulk_file(raw: bytes) -> str:
+    # Excelで保存したCSVはBOM付きUTF-8かShift_JISのことが多い
+    for encoding in ("utf-8-sig", "cp932"):
+        try:
+            return raw.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    raise ValueError("文字コードを判別できません。UTF-8で保存してください。")
+
+def parse_bulk_amount(value: str) -> int:
+    return int(value.strip().lstrip("¥￥").replace(",", ""))
+
+def parse_bulk_rows(text: str, budgets: dict, default_budget: str = None):
+    """CSV/TSVを1回で読み、(予算項目ごとの品物, エラー行のリスト) を返す"""
+    lines = text.splitlines()
+    if not lines:
+        return {}, ["ファイルが空です。"]
+    delimiter = "\t" if "\t" in lines[0] else ","
+    reader = csv.reader(lines, delimiter=delimiter)
+    header = [cell.strip().lower() for cell in next(reader)]
+    columns = {}
+    for key, names in BULK_COLUMNS.items():
+        for index, cell in enumerate(header):
+            if cell in names:
+                columns[key] = index
+                break
+    missing = [BULK_COLUMNS[key][0] for key in ("name", "unit_price") if key not in columns]
+    if "budget_name" not in columns and default_budget is None:
+        missing.append(BULK_COLUMNS["budget_name"][0])
+    if missing:
+        return {}, [f"見出し行に「{'」「'.join(missing)}」の列がありません。"]
+
+    grouped = {}
+    errors = []
+    for line_no, row in enumerate(reader, 2):
+        if not any(cell.strip() for cell in row):
+            continue
+
+        def cell(key):
+            index = columns.get(key)
+            return row[index].strip() if index is not None and index < len(row) else ""
+
+        name = cell("name")
+        link = cell("link")
+        budget_name = cell("budget_name") or default_budget
+        problems = []
+        if not name:
+            problems.append("購入物が空です")
+        elif len(name) > 200:
+            problems.append("購入物は200文字以内にしてください")
+        if len(link) > 1000:
+            problems.append("リンクは1000文字以内にしてください")
+        try:
+            unit_price = parse_bulk_amount(cell("unit_price"))
+            if unit_price < 0:
+                problems.append("単価は0以上にしてください")
+        except ValueError:
+            problems.append(f"単価「{cell('unit_price')}」が数字ではありません")
+        try:
+            quantity = parse_bulk_amount(cell("quantity")) if cell("quantity") else 1
+            if quantity <= 0:
+                problems.append("個数は1以上にしてください")
+        except ValueError:
+            problems.append(f"個数「{cell('quantity')}」が数字ではありません")
+        if not budget_name:
+            problems.append("予算項目が空です")
+        elif budget_name not in budgets:
+            problems.append(f"予算項目「{budget_name}」は存在しません")
+        if problems:
+            errors.append(f"{line_no}行目: " + " / ".join(problems))
+            continue
+        grouped.setdefault(budget_name, []).append(RequestItem(name, link, unit_price, quantity))
+    if not grouped and not errors:
+        errors.append("申請する品物の行がありません。")
+    return grouped, errors
+
+def format_error_report(title: str, errors: list) -> str:
+    """エラーの一覧を1通のメッセージに収まるように切り詰める"""
+    text = title
+    for shown, error in enumerate(errors):
+        rest = f"\n…ほか{len(errors) - shown}件"
+        if len(text) + 1 + len(error) + len(rest) > MESSAGE_LIMIT:
+            return text + rest
+        text += "\n" + error
+    return text
+
+@bot.hybrid_command()
+async def bulk_send(ctx, attachment: discord.Attachment = None, *, budget_name: str = None):
+    """CSV/TSVファイルを添付して、複数の品物を予算項目ごとにまとめて申請します。
+    見出し行: 購入物,リンク,単価,個数,予算項目 (予算項目の列がなければ引数の予算名を使います)"""
+    if attachment is None:
+        await ctx.send("⚠️ CSVまたはTSVファイルを添付してください。")
+        return
+    # スラッシュコマンドのときは先に応答し、申請は通常のメッセージとして投稿する
+    await ctx.defer(ephemeral=True)
+    if attachment.size > BULK_REQUEST_MAX_BYTES:
+        await ctx.send(f"⚠️ ファイルが大きすぎます (上限 {BULK_REQUEST_MAX_BYTES // 1024:,} KiB)。")
+        return
+
+    guild_id = ctx.guild.id
+    data = await load_guild_data(guild_id)
+    if budget_name is not None and budget_name not in data["budgets"]:
+        await ctx.send(f"⚠️ **エラー:** 予算項目「{budget_name}」は存在しません。")
+        return
+    try:
+        text = decode_bulk_file(await attachment.read())
+    except ValueError as e:
+        await ctx.send(f"⚠️ {e}")
+        return
+    grouped, errors = parse_bulk_rows(text, data["budgets"], budget_name)
+    if errors:
+        # 一部だけ申請されると直した後の再提出で二重になるので、エラーがあれば何も申請しない
+        await ctx.send(format_error_report(f"⚠️ {len(errors)}件のエラーがあるため申請しませんでした。", errors))
+        return
+
+    for name, items in grouped.items():
+        request = await open_pending_request(ctx.author.id, ctx.author.display_name, str(ctx.author.display_avatar.url), guild_id, items, name)
+        message = await outbound.send(ctx.channel, embed=build_request_embed(request), view=ApprovalView(request))
+        await attach_request_message(request, message)
+        schedule_link_previews(request, message, functools.partial(build_request_embed, request))
+    item_count = sum(len(items) for items in grouped.values())
+    await ctx.send(f"✅ {item_count}件の品物を {len(grouped)}件の申請にまとめて送信しました。")
+
+PENDING_LIST_MAX = 500
+
+class PendingFlags(commands.FlagConverter):
+    budget: str = None
+    applicant: str = None
+    min_amount: int = commands.flag(name="min", default=None)
+    max_amount: int = commands.flag(name="max", default=None)
+    days: int = None
+    sort: str = "age"
+
+def format_elapsed(created_at: str) -> str:
+    try:
+        elapsed = datetime.datetime.now().astimezone() - datetime.datetime.fromisoformat(created_at)
+    except ValueError:
+        return created_at
+    if elapsed.days >= 1:
+        return f"{elapsed.days}日前"
+    if elapsed.seconds >= 3600:
+        return f"{elapsed.seconds // 3600}時間前"
+    return f"{elapsed.seconds // 60}分前"
+
+def format_pending_summary(guild_id: int, summary: PendingSummary) -> str:
+    line = (
+        f"**¥{summary.amount:,}** 「{clip_text(summary.budget_name, SELECT_TEXT_LIMIT)}」 {summary.item_count}品"
+        f" ・ {clip_text(summary.author_name, SELECT_TEXT_LIMIT)} ・ {format_elapsed(summary.created_at)}"
+    )
+    url = summary.jump_url(guild_id)
+    return f"{line} [申請を開く]({url})" if url else f"{line} (メッセージなし)"
+
+@bot.hybrid_command()
+async def pending(ctx, *, flags: PendingFlags):
+    """【会計ロール用】審査待ちの申請を一覧表示します。
+    並べ替え (sort): age (古い順) / new (新しい順) / amount (金額順) / budget (予算項目順)
+    例: !pending / !pending budget: 備品 sort: amount / !pending applicant: 山田 days: 7 min: 10000"""
+    if not await has_accounting_role(ctx.author):
+        await ctx.send("⚠️ このコマンドを実行する権限がありません。")
+        return
+    if flags.sort not in PENDING_SORTS:
+        await ctx.send(f"⚠️ sort には {' / '.join(PENDING_SORTS)} のいずれかを指定してください。")
+        return
+
+    guild_id = ctx.guild.id
+    data = await load_guild_data(guild_id)
+    index = data["pending_index"]
+    created_before = None
+    if flags.days is not None:
+        created_before = (datetime.datetime.now() - datetime.timedelta(days=flags.days)).isoformat(timespec="seconds")
+    summaries = index.query(flags.budget, flags.applicant, flags.min_amount, flags.max_amount, created_before, flags.sort)
+    if not summaries:
+        await ctx.send("ℹ️ 条件に合う審査待ちの申請はありません。" if len(index) else "ℹ️ 審査待ちの申請はありません。")
+        return
+
+    total = sum(summary.amount for summary in summaries)
+    pages = paginate_lines(format_pending_summary(guild_id, summary) for summary in summaries[:PENDING_LIST_MAX])
+    footer = f"{len(summaries):,}件 ・ 合計 ¥{total:,}"
+    if len(summaries) > PENDING_LIST_MAX:
+        footer += f" (先頭の {PENDING_LIST_MAX} 件を表示)"
+    embeds = []
+    for page, description in enumerate(pages):
+        embed = discord.Embed(title="📋 審査待ちの申請", color=discord.Color.gold())
+        embed.description = description
+        embed.set_footer(text=page_footer(footer, page, len(pages)))
+        embeds.append(embed)
+    if len(embeds) == 1:
+        await ctx.send(embed=embeds[0])
+        return
+    view = EmbedPageView(embeds)
+    view.message = await ctx.send(embed=embeds[0], view=view)
+
+REPORT_DIMENSIONS = {"budget": "予算項目", "applicant": "申請者", "month": "月"}
+REPORT_MAX_LINES = 20
+
+def format_aggregate_totals(totals: list) -> str:
+    approved_total, approved_count, rejected_total, rejected_count = totals
+    reviewed = approved_count + rejected_count
+    ratio = approved_count / reviewed * 100 if reviewed else 0
+    return f"承認 ¥{approved_total:,} ({approved_count}件) / 却下 ¥{rejected_total:,} ({rejected_count}件) / 承認率 {ratio:.0f}%"
+
+@bot.hybrid_command()
+async def report(ctx, dimension: str = "budget", *, key: str = None):
+    """【会計ロール用】予算項目・申請者・月ごとの支出を集計して表示します。
+    例: !report / !report applicant / !report month 2025-04 / !report rebuild"""
+    if not await has_accounting_role(ctx.author):
         await ctx.send("⚠️ このコマンドを実行する権限がありません。")
         return
+    await ctx.defer()
 
     guild_id = ctx.guild.id
-    guild_path = get_guild_data_path(guild_id)
-    log_file_path = os.path.join(guild_path, REVIEW_LOG_FILE)
+    if dimension == "rebuild":
+        await rebuild_aggregates(guild_id)
+        await ctx.send("✅ 審査記録から集計を作り直しました。")
+        return
+    if dimension not in REPORT_DIMENSIONS:
+        await ctx.send("⚠️ 集計の種類は budget / applicant / month のいずれかを指定してください。")
+        return
+
+    data = await load_guild_data(guild_id)
+    aggregates = data["aggregates"]
+    if aggregates is None:
+        aggregates = await rebuild_aggregates(guild_id)
+    entries = aggregates[dimension]
+    label = REPORT_DIMENSIONS[dimension]
+
+    if key is not None:
+        totals = entries.get(key)
+        if totals is None:
+            await ctx.send(f"ℹ️ {label}「{key}」の審査記録はありません。")
+            return
+        embed = discord.Embed(title=f"📊 {label}「{key}」の集計", color=discord.Color.gold())
+        embed.description = format_aggregate_totals(totals)
+        await ctx.send(embed=embed)
+        return
+
+    if not entries:
+        await ctx.send("ℹ️ まだ審査記録がありません。")
+        return
+    if dimension == "month":
+        keys = sorted(entries, reverse=True)
+    else:
+        keys = sorted(entries, key=lambda k: entries[k][0], reverse=True)
+    embed = discord.Embed(title=f"📊 {label}ごとの集計", color=discord.Color.gold())
+    embed.description = "\n".join(f"**{k}**\n{format_aggregate_totals(entries[k])}" for k in keys[:REPORT_MAX_LINES])
+    if len(keys) > REPORT_MAX_LINES:
+        embed.set_footer(text=f"上位 {REPORT_MAX_LINES} 件を表示 (全 {len(keys)} 件)")
+    await ctx.send(embed=embed)
+
+class ExportFlags(commands.FlagConverter):
+    since: str = None
+    until: str = None
+    budget: str = None
+    applicant: str = None
+    result: str = None
+    file_format: str = commands.flag(name="format", default="csv")
+
+def parse_export_date(value: str) -> datetime.date:
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise commands.BadArgument(f"日付は YYYY-MM-DD 形式で指定してください: {value}")
+
+@bot.hybrid_command()
+async def export_csv(ctx, *, flags: ExportFlags):
+    """【会計ロール用】これまでの申請・審査結果をCSVファイルで出力します。
+    例: !export_csv since: 2025-04-01 until: 2025-09-30 budget: F3EC result: 承認 format: gzip"""
+    if not await has_accounting_role(ctx.author):
+        await ctx.send("⚠️ このコマンドを実行する権限がありません。")
+        return
+    await ctx.defer()
+
+    if flags.file_format not in EXPORT_EXTENSIONS:
+        await ctx.send("⚠️ format には csv / gzip / xlsx のいずれかを指定してください。")
+        return
+    if flags.file_format == "xlsx" and openpyxl is None:
+        await ctx.send("⚠️ XLSX形式で出力するには openpyxl をインストールしてください。")
+        return
+    if flags.result is not None and flags.result not in ("承認", "却下"):
+        await ctx.send("⚠️ result には 承認 または 却下 を指定してください。")
+        return
+    filters = {"budget_name": flags.budget, "applicant": flags.applicant, "result": flags.result}
+    if flags.since:
+        filters["since"] = parse_export_date(flags.since).isoformat()
+    if flags.until:
+        filters["until"] = (parse_export_date(flags.until) + datetime.timedelta(days=1)).isoformat()
 
-    if not os.path.exists(log_file_path):
-        await ctx.send("ℹ️ まだ審査記録がありません。CSVファイルは作成されていません。")
+    guild_id = ctx.guild.id
+    # アップロード上限ぎりぎりを避けるため少し余裕を持たせる
+    max_part_bytes = EXPORT_PART_MAX_BYTES or ctx.guild.filesize_limit - 512 * 1024
+    # 書き込み待ちの記録も含めて出力する
+    await review_log.flush()
+    parts = await asyncio.get_running_loop().run_in_executor(
+        None, export_review_log, guild_id, filters, flags.file_format, max_part_bytes
+    )
+    if not parts:
+        await ctx.send("ℹ️ 条件に合う審査記録がありません。")
         return
 
     try:
-        await ctx.send(
-            content=f"📄 {ctx.guild.name} の申請・審査記録です。",
-            file=discord.File(log_file_path, "review_results.csv")
-        )
+        for i, (file_name, data) in enumerate(parts, 1):
+            content = f"📄 {ctx.guild.name} の申請・審査記録です。"
+            if len(parts) > 1:
+                content += f" ({i}/{len(parts)})"
+            await ctx.send(content=content, file=discord.File(data, file_name))
     except Exception as e:
         await ctx.send(f"⚠️ ファイルの送信中にエラーが発生しました: {e}")
         print(f"Error sending CSV file for guild {guild_id}: {e}")
 
+HISTORY_PAGE_SIZE = 10
+
+class HistoryFlags(commands.FlagConverter):
+    applicant: str = None
+    keyword: str = None
+    domain: str = None
+    budget: str = None
+    approver: str = None
+    result: str = None
+    rebuild: bool = False
+
+def history_query(flags: HistoryFlags) -> tuple:
+    """(索引で引く語, 品名に含まれているか読んで確かめるキーワード) を返す"""
+    terms = []
+    for prefix, value in (("a:", flags.applicant), ("p:", flags.approver), ("b:", flags.budget)):
+        if value:
+            terms.append(prefix + normalize_search_key(value.strip()))
+    if flags.result:
+        terms.append("r:" + flags.result)
+    if flags.domain:
+        domain = normalize_search_key(flags.domain.strip())
+        # URLを貼られてもドメインの部分だけを使う
+        domains = link_domains(domain if "://" in domain else "https://" + domain)
+        terms.append("d:" + (domains[0] if domains else domain))
+    keywords = normalize_search_key(flags.keyword or "").split()
+    for keyword in keywords:
+        terms.extend("n:" + gram for gram in bigrams(keyword))
+    return terms, keywords
+
+def format_history_record(record: dict) -> str:
+    mark = "✅" if record["result"] == "承認" else "❌"
+    date = (record["created_at"] or "")[:10] or "日時不明"
+    line = (
+        f"{mark} **{clip_text(record['name'], SELECT_TEXT_LIMIT)}** ¥{record['amount']:,} ・ 「{clip_text(record['budget_name'], SELECT_TEXT_LIMIT)}」\n"
+        f"   {date} ・ 申請 {clip_text(record['applicant'], SELECT_TEXT_LIMIT)} ・ 審査 {clip_text(record['approver'], SELECT_TEXT_LIMIT)}"
+    )
+    if record["link"]:
+        line += f" ・ [リンク]({clip_text(record['link'], EMBED_FIELD_LIMIT)})"
+    return line
+
+class ReviewHistoryView(ui.View):
+    """!history の検索結果のページ送り。ページを開くたびに、そのページの分だけ審査記録を読む"""
+
+    def __init__(self, guild_id: int, locators: array, keywords: list, timeout: float = 600):
+        super().__init__(timeout=timeout)
+        self.guild_id = guild_id
+        self.locators = locators
+        self.keywords = keywords
+        # 3文字以上のキーワードは索引 (2文字ずつ) では候補までしか絞れないので、読んで確かめながらページを区切る
+        self.exact = all(len(keyword) <= 2 for keyword in keywords)
+        self._starts = [0]
+        self.page = 0
+        self.message = None
+
+    @property
+    def page_count(self):
+        """ページ数。候補を読んで確かめる場合は最後まで読むまで分からないのでNone"""
+        return math.ceil(len(self.locators) / HISTORY_PAGE_SIZE) if self.exact else None
+
+    async def load_page(self, page: int) -> tuple:
+        """(そのページの記録, 次のページがあるか) を返す"""
+        position = self._starts[page]
+        records = []
+        loop = asyncio.get_running_loop()
+        while len(records) < HISTORY_PAGE_SIZE and position < len(self.locators):
+            chunk = list(self.locators[position:position + HISTORY_PAGE_SIZE * 2])
+            fetched = await loop.run_in_executor(None, storage.read_review_rows, self.guild_id, chunk)
+            for record in fetched:
+                position += 1
+                if record is None:
+                    continue
+                name = normalize_search_key(record["name"])
+                if all(keyword in name for keyword in self.keywords):
+                    records.append(record)
+                    if len(records) == HISTORY_PAGE_SIZE:
+                        break
+        if page + 1 == len(self._starts):
+            self._starts.append(position)
+        return records, position < len(self.locators)
+
+    async def render(self, page: int) -> discord.Embed:
+        self.page = page
+        records, has_next = await self.load_page(page)
+        self.prev_button.disabled = page == 0
+        self.next_button.disabled = not has_next
+        embed = discord.Embed(title="🔎 審査記録の検索結果", color=discord.Color.blue())
+        embed.description = "\n".join(format_history_record(record) for record in records) or "ℹ️ これ以上の記録はありません。"
+        count = f"{len(self.locators):,}件" if self.exact else f"候補 {len(self.locators):,}件"
+        page_text = f"{page + 1}/{self.page_count}" if self.exact else f"{page + 1}"
+        embed.set_footer(text=f"{count} ・ ページ {page_text} (新しい順)")
+        return embed
+
+    async def on_timeout(self):
+        if self.message is not None:
+            try:
+                await outbound.edit_message(self.message, view=None)
+            except discord.HTTPException:
+                pass
+
+    async def show(self, interaction: discord.Interaction, page: int):
+        await interaction.response.defer()
+        embed = await self.render(max(0, min(page, len(self._starts) - 1)))
+        outbound.edit_interaction(interaction, embed=embed, view=self)
+
+    @ui.button(label="前へ", style=discord.ButtonStyle.secondary, emoji="◀️")
+    @timed("ReviewHistoryView.prev_button")
+    async def prev_button(self, interaction: discord.Interaction, button: ui.Button):
+        await self.show(interaction, self.page - 1)
+
+    @ui.button(label="次へ", style=discord.ButtonStyle.secondary, emoji="▶️")
+    @timed("ReviewHistoryView.next_button")
+    async def next_button(self, interaction: discord.Interaction, button: ui.Button):
+        await self.show(interaction, self.page + 1)
+
+@bot.hybrid_command()
+async def history(ctx, *, flags: HistoryFlags):
+    """【会計ロール用】審査記録を申請者・品名・リンクのドメイン・予算項目・審査者で検索します。
+    例: !history domain: partscabi.net approver: 山田 budget: F3EC / !history keyword: ネジ result: 承認
+    rebuild: true を付けると審査記録から索引を作り直します。"""
+    if not await has_accounting_role(ctx.author):
+        await ctx.send("⚠️ このコマンドを実行する権限がありません。")
+        return
+    if flags.result is not None and flags.result not in ("承認", "却下"):
+        await ctx.send("⚠️ result には 承認 または 却下 を指定してください。")
+        return
+    terms, keywords = history_query(flags)
+    if any(len(keyword) < 2 for keyword in keywords):
+        await ctx.send("⚠️ keyword は2文字以上で指定してください。")
+        return
+
+    await ctx.defer()
+    guild_id = ctx.guild.id
+    index = await review_search.get(guild_id, rebuild=flags.rebuild)
+    rows = index.search(terms)
+    if not rows:
+        await ctx.send("ℹ️ 条件に合う審査記録はありません。")
+        return
+    view = ReviewHistoryView(guild_id, array("Q", (index.locators[row] for row in reversed(rows))), keywords)
+    embed = await view.render(0)
+    if view.next_button.disabled:
+        await ctx.send(embed=embed)
+        return
+    view.message = await ctx.send(embed=embed, view=view)
+
+# --- Snapshots ---
+
+def snapshot_db_path() -> str:
+    return SQLITE_PATH if STORAGE_BACKEND == "sqlite" else None
+
+# リンク先の情報はキャッシュなのでスナップショットに含めない
+SNAPSHOT_EXCLUDE = (LINK_PREVIEW_CACHE_PATH,)
+
+@contextlib.asynccontextmanager
+async def quiesce_writers():
+    """スナップショットを取る間、保存処理と審査記録の追記を止める"""
+    # 止める前にたまっている分を書き出し、審査記録の目次も保存しておく
+    await persistence.flush()
+    await review_log.flush(force_sync=True)
+    async with persistence.paused(), review_log.paused():
+        yield
+
+snapshots = SnapshotScheduler(
+    SNAPSHOT_INTERVAL, SNAPSHOT_DIR, SNAPSHOT_KEEP, DATA_DIR, snapshot_db_path(), SNAPSHOT_EXCLUDE, quiesce_writers
+)
+
+# --- Command Line ---
+
+def run_cli(argv: list):
+    parser = argparse.ArgumentParser(description="budgetBOT の管理用コマンド")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="data/ 以下のJSON・CSVをSQLiteデータベースへ移行する")
+    migrate_parser.add_argument("--db", default=SQLITE_PATH, help="移行先のデータベース")
+    migrate_parser.add_argument("--legacy-log", help="サーバーIDを持たない旧形式の審査記録CSV (例: review_results.csv)")
+    migrate_parser.add_argument("--legacy-guild", type=int, help="--legacy-log の記録を割り当てるサーバーID")
+    migrate_parser.add_argument("--force", action="store_true", help="移行済みのデータベースにも再度書き込む (審査記録はサーバーごとに入れ替える)")
+    snapshot_parser = subparsers.add_parser("snapshot", help="data/ のスナップショットを取る (前回から変わった部分だけを保存する)")
+    snapshot_parser.add_argument("--dir", default=SNAPSHOT_DIR, help="スナップショットの保存先")
+    snapshot_parser.add_argument("--keep", type=int, default=SNAPSHOT_KEEP, help="残すスナップショットの数")
+    list_parser = subparsers.add_parser("snapshots", help="スナップショットの一覧を表示する")
+    list_parser.add_argument("--dir", default=SNAPSHOT_DIR, help="スナップショットの保存先")
+    restore_parser = subparsers.add_parser("restore", help="スナップショットの時点に data/ を戻す (Botを止めてから実行する)")
+    restore_parser.add_argument("name", nargs="?", help="戻すスナップショット (省略時は最新)")
+    restore_parser.add_argument("--dir", default=SNAPSHOT_DIR, help="スナップショットの保存先")
+    restore_parser.add_argument("--target", default=DATA_DIR, help="書き戻す先のディレクトリ")
+    verify_parser = subparsers.add_parser("verify", help="スナップショットのデータがそろっていて壊れていないか調べる")
+    verify_parser.add_argument("name", nargs="?", help="調べるスナップショット (省略時は最新)")
+    verify_parser.add_argument("--dir", default=SNAPSHOT_DIR, help="スナップショットの保存先")
+    verify_parser.add_argument("--all", action="store_true", help="すべてのスナップショットを調べる")
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        if args.legacy_log and args.legacy_guild is None:
+            parser.error("--legacy-log を指定する場合は --legacy-guild も必要です")
+        migrate_json_to_sqlite(DATA_DIR, args.db, args.legacy_log, args.legacy_guild, args.force)
+    elif args.command == "snapshot":
+        # Botの動作中でもファイルごとには一貫したコピーになるが、ファイル間の時点を揃えるには SNAPSHOT_INTERVAL を使う
+        name, stats = create_snapshot(DATA_DIR, args.dir, snapshot_db_path(), SNAPSHOT_EXCLUDE)
+        print(format_snapshot_stats(name, stats))
+        removed = prune_snapshots(args.dir, args.keep)
+        if removed:
+            print(f"🧹 使われなくなったチャンクを {removed:,} 個削除しました。")
+    elif args.command == "snapshots":
+        for name in list_snapshots(args.dir):
+            manifest = load_snapshot_manifest(args.dir, name)
+            stats = manifest["stats"]
+            print(f"{name}  {stats['files']:>8,} ファイル  新規保存 {stats['stored_bytes'] / 1024:>10,.0f} KiB")
+    elif args.command == "restore":
+        db_path = snapshot_db_path()
+        if db_path and args.target != DATA_DIR:
+            db_path = os.path.join(args.target, os.path.basename(db_path))
+        stats = restore_snapshot(args.dir, args.name, args.target, db_path, SNAPSHOT_EXCLUDE)
+        print(f"✅ スナップショット {stats['name']} に戻しました (書き戻し {stats['restored']:,} / 変更なし {stats['unchanged']:,} / 削除 {stats['removed']:,})。")
+    elif args.command == "verify":
+        names = list_snapshots(args.dir) if args.all else [args.name or (list_snapshots(args.dir) or [None])[-1]]
+        if names == [None]:
+            parser.error(f"{args.dir} にスナップショットがありません")
+        problems = verify_snapshots(args.dir, names)
+        for problem in problems:
+            print(f"❌ {problem}")
+        if problems:
+            sys.exit(1)
+        print(f"✅ {len(names)} 個のスナップショットに問題はありません。")
+
 # --- Run the Bot ---
 if __name__ == "__main__":
-    bot.run(TOKEN)
\ No newline at end of file
+    if len(sys.argv) > 1:
+        run_cli(sys.argv[1:])
+    else:
+        bot.run(TOKEN)
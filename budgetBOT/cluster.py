@@ -0,0 +1,137 @@
+"""budgetBOT をシャードごとに複数のプロセス (クラスタ) で動かすランチャー
+
+シャードを連続した範囲に分けて、クラスタごとに budgetBOT.py を1プロセスずつ起動する。
+落ちたクラスタだけを起動し直すので、ほかのクラスタは止まらない。
+config.json と data/ は起動したディレクトリのものを全クラスタで共有する。
+
+    python cluster.py --clusters 4              # シャード数はDiscordの推奨値
+    python cluster.py --clusters 2 --shards 8
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "budgetBOT.py")
+GATEWAY_URL = "https://discord.com/api/v10/gateway/bot"
+
+def fetch_recommended_shards(token: str) -> int:
+    request = urllib.request.Request(GATEWAY_URL, headers={
+        "Authorization": f"Bot {token}",
+        "User-Agent": "DiscordBot (budgetBOT cluster launcher)"
+    })
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.load(response)["shards"]
+
+def split_shards(shard_count: int, clusters: int) -> list:
+    """シャードIDを clusters 個の連続した範囲に分ける"""
+    base, extra = divmod(shard_count, clusters)
+    ranges = []
+    start = 0
+    for cluster_id in range(clusters):
+        size = base + (1 if cluster_id < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return [shard_ids for shard_ids in ranges if shard_ids]
+
+class Worker:
+    """1つのクラスタのプロセス。落ちたら間隔を空けて起動し直す"""
+
+    def __init__(self, cluster_id: int, shard_ids: list, shard_count: int):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.process = None
+        self.started_at = 0.0
+        self.restart_at = 0.0
+        self.backoff = 0.0
+
+    def start(self):
+        env = dict(os.environ)
+        env["BUDGETBOT_CLUSTER_ID"] = str(self.cluster_id)
+        env["BUDGETBOT_SHARD_COUNT"] = str(self.shard_count)
+        env["BUDGETBOT_SHARD_IDS"] = ",".join(str(shard_id) for shard_id in self.shard_ids)
+        # 端末のCtrl+Cが直接届かないよう別のプロセスグループで起動し、終了の合図はランチャーから送る
+        self.process = subprocess.Popen([sys.executable, BOT_SCRIPT], env=env, start_new_session=True)
+        self.started_at = time.monotonic()
+        print(f"🚀 クラスタ {self.cluster_id} を起動しました (PID {self.process.pid}, シャード {self.shard_ids[0]}-{self.shard_ids[-1]})")
+
+    def poll(self, min_backoff: float, max_backoff: float):
+        """終了していたら再起動を予約し、予約時刻になったら起動する"""
+        if self.process is not None:
+            code = self.process.poll()
+            if code is None:
+                return
+            uptime = time.monotonic() - self.started_at
+            # しばらく動いていたなら一時的な障害とみなして待ち時間を戻す
+            self.backoff = min_backoff if uptime > max_backoff else min(max(self.backoff * 2, min_backoff), max_backoff)
+            self.restart_at = time.monotonic() + self.backoff
+            self.process = None
+            print(f"⚠️ クラスタ {self.cluster_id} が終了しました (終了コード {code}, 稼働 {uptime:.0f}秒)。{self.backoff:.0f}秒後に再起動します。")
+        if time.monotonic() >= self.restart_at:
+            self.start()
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            # SIGINTならBotのclose()が呼ばれ、未保存のデータを書き出してから終了する
+            self.process.send_signal(signal.SIGINT)
+
+    def wait(self, timeout: float):
+        if self.process is None:
+            return
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            print(f"⚠️ クラスタ {self.cluster_id} が終了しないため強制終了します。")
+            self.process.kill()
+            self.process.wait()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="budgetBOT をシャードごとに複数プロセスで起動する")
+    parser.add_argument("--clusters", type=int, default=os.cpu_count() or 1, help="起動するプロセス数")
+    parser.add_argument("--shards", type=int, help="全体のシャード数 (省略時はDiscordの推奨値)")
+    parser.add_argument("--start-interval", type=float, default=5.0, help="クラスタを順に起動する間隔 (秒, IDENTIFYの制限対策)")
+    parser.add_argument("--min-backoff", type=float, default=5.0, help="再起動までの最短の待ち時間 (秒)")
+    parser.add_argument("--max-backoff", type=float, default=300.0, help="再起動までの最長の待ち時間 (秒)")
+    parser.add_argument("--shutdown-timeout", type=float, default=60.0, help="終了時にデータの書き出しを待つ時間 (秒)")
+    args = parser.parse_args(argv)
+
+    shard_count = args.shards
+    if shard_count is None:
+        with open("config.json", "r", encoding="utf-8") as f:
+            shard_count = fetch_recommended_shards(json.load(f)["TOKEN"])
+    workers = [Worker(i, shard_ids, shard_count) for i, shard_ids in enumerate(split_shards(shard_count, args.clusters))]
+    print(f"🧩 {shard_count} シャードを {len(workers)} クラスタで動かします。")
+
+    stopping = False
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    for i, worker in enumerate(workers):
+        if stopping:
+            break
+        if i:
+            time.sleep(args.start_interval)
+        worker.start()
+    while not stopping:
+        for worker in workers:
+            worker.poll(args.min_backoff, args.max_backoff)
+        time.sleep(1.0)
+
+    print("🛑 全クラスタを終了しています...")
+    for worker in workers:
+        worker.stop()
+    for worker in workers:
+        worker.wait(args.shutdown_timeout)
+
+if __name__ == "__main__":
+    main()
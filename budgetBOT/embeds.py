@@ -0,0 +1,87 @@
+"""Discordの表示の上限と、Embedに入れる文字列の整形・ページ分け"""
+from storage import RequestItem
+
+# Discordの上限: Embed本文4096文字・フィールド値1024文字・セレクトの選択肢25個
+EMBED_DESCRIPTION_LIMIT = 4096
+EMBED_FIELD_LIMIT = 1024
+EMBED_NAME_LIMIT = 256
+SELECT_OPTION_LIMIT = 25
+SELECT_TEXT_LIMIT = 100
+
+def clip_text(text: str, limit: int) -> str:
+    text = str(text)
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def format_item_price(item: RequestItem) -> str:
+    return f"`¥{item.unit_price:,} × {item.quantity}個 =` **¥{item.amount:,}**"
+
+def render_result_line(item: RequestItem) -> str:
+    return f"- {item.name} ({format_item_price(item)}) {item.link}"
+
+def paginate_lines(lines, limit: int = EMBED_DESCRIPTION_LIMIT) -> list:
+    """行を改行でつなぎ、limit文字を超えないページに分ける。1行だけで超える行は切り詰める"""
+    pages = []
+    current = []
+    size = 0
+    for line in lines:
+        line = clip_text(line, limit)
+        if current and size + 1 + len(line) > limit:
+            pages.append("\n".join(current))
+            current = []
+            size = 0
+        size += len(line) + (1 if current else 0)
+        current.append(line)
+    if current:
+        pages.append("\n".join(current))
+    return pages or [""]
+
+def page_footer(text: str, page: int, page_count: int) -> str:
+    if page_count <= 1:
+        return text
+    return f"{text} ・ ページ {page + 1}/{page_count}"
+
+class ItemListRenderer:
+    """品物ごとの表示行をキャッシュする。追加・削除では合計とページ分けだけをやり直す。
+    link_preview_line(item) を渡すと、リンクのある品物にその戻り値 (Noneでなければ) の行を添える"""
+
+    def __init__(self, items=(), link_preview_line=None):
+        self.link_preview_line = link_preview_line
+        self._names = []
+        self._details = []
+        self._amounts = []
+        self.total = 0
+        self._pages = None
+        for item in items:
+            self.append(item)
+
+    def __len__(self):
+        return len(self._names)
+
+    def append(self, item: RequestItem):
+        details = f"\n   {format_item_price(item)}"
+        if item.link:
+            details += f"\n   [リンク]({item.link})"
+            preview_line = self.link_preview_line(item) if self.link_preview_line is not None else None
+            if preview_line is not None:
+                details += f"\n   {preview_line}"
+        self._names.append(item.name)
+        self._details.append(details)
+        self._amounts.append(item.amount)
+        self.total += item.amount
+        self._pages = None
+
+    def remove(self, index: int):
+        del self._names[index]
+        del self._details[index]
+        self.total -= self._amounts.pop(index)
+        self._pages = None
+
+    @property
+    def pages(self) -> list:
+        # 番号は削除でずれるので、ページ分けのときに付ける
+        if self._pages is None:
+            self._pages = paginate_lines(
+                f"**{i}. {name}**{details}"
+                for i, (name, details) in enumerate(zip(self._names, self._details), 1)
+            )
+        return self._pages
@@ -0,0 +1,139 @@
+"""サーバーごとのデータのキャッシュ
+
+サーバーのデータは最初に使われたときにストレージから読み込み、件数・メモリの上限を超えたら最近使われていないものから追い出す。
+"""
+import asyncio
+import sys
+import time
+from collections import OrderedDict, deque
+
+from metrics import metrics
+
+def estimate_guild_size(data: dict) -> int:
+    """サーバーデータのおおよそのメモリ使用量 (バイト)"""
+    size = sys.getsizeof(data)
+    for key, value in data.items():
+        size += sys.getsizeof(value)
+        if key == "pending_requests":
+            size += sum(sys.getsizeof(k) + (request.estimate_size() if request is not None else 0) for k, request in value.items())
+        elif key == "pending_index":
+            size += value.estimate_size()
+        elif isinstance(value, dict):
+            size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in value.items())
+            # 集計は {次元: {キー: [合計]}} と一段深い
+            size += sum(sys.getsizeof(k) + sys.getsizeof(v) for nested in value.values() if isinstance(nested, dict) for k, v in nested.items())
+        elif isinstance(value, (set, list, deque)):
+            size += sum(sys.getsizeof(v) for v in value)
+    return size
+
+class GuildCache:
+    """サーバーごとのデータを最近使った順に保持し、件数・メモリの上限を超えたら古いものから追い出す。
+    読み込みは store.load_guild で行う。pending_guilds() が返すサーバー (未書き込みの変更が残っているもの) は追い出さない。"""
+
+    def __init__(self, store, max_guilds: int, max_bytes: int = None, pending_guilds=None):
+        self.store = store
+        self.pending_guilds = pending_guilds
+        self.max_guilds = max_guilds
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._total_bytes = 0
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, guild_id: int) -> bool:
+        return guild_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def items(self) -> list:
+        return list(self._entries.items())
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    async def get(self, guild_id: int) -> dict:
+        data = self._entries.get(guild_id)
+        if data is not None:
+            self._entries.move_to_end(guild_id)
+            self.hits += 1
+            return data
+        self.misses += 1
+        return await self._load(guild_id)
+
+    async def _load(self, guild_id: int) -> dict:
+        # 同じサーバーの読み込みが同時に走らないよう、読み込み中のFutureを共有する
+        future = self._loading.get(guild_id)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(None, self.store.load_guild, guild_id)
+            self._loading[guild_id] = future
+            started = time.perf_counter()
+            try:
+                data = await future
+            finally:
+                del self._loading[guild_id]
+                metrics.observe("budgetbot_storage_seconds", time.perf_counter() - started, operation="load_guild")
+            self._insert(guild_id, data)
+            return data
+        await asyncio.shield(future)
+        # 読み込みを待っている間に追い出されていた場合は読み直す
+        data = self._entries.get(guild_id)
+        return data if data is not None else await self._load(guild_id)
+
+    async def preload(self, guild_ids: list, concurrency: int):
+        """複数のサーバーをスレッドプールで並列に読み込む (キャッシュの上限まで)"""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def load_one(guild_id):
+            async with semaphore:
+                if guild_id not in self._entries:
+                    await self._load(guild_id)
+
+        await asyncio.gather(*(load_one(guild_id) for guild_id in guild_ids[:self.max_guilds]))
+
+    def update_size(self, guild_id: int):
+        """データが変わったサーバーのメモリ使用量を計算し直す"""
+        data = self._entries.get(guild_id)
+        if data is None:
+            return
+        size = estimate_guild_size(data)
+        self._total_bytes += size - self._sizes[guild_id]
+        self._sizes[guild_id] = size
+        self._evict()
+
+    def add_size(self, guild_id: int, size: int):
+        """データの一部を読み足したときに、全体を計算し直さずに使用量を加える"""
+        if guild_id not in self._sizes:
+            return
+        self._sizes[guild_id] += size
+        self._total_bytes += size
+        self._evict()
+
+    def _insert(self, guild_id: int, data: dict):
+        self._entries[guild_id] = data
+        self._sizes[guild_id] = estimate_guild_size(data)
+        self._total_bytes += self._sizes[guild_id]
+        self._evict()
+
+    def _over_limit(self) -> bool:
+        if len(self._entries) > self.max_guilds:
+            return True
+        return self.max_bytes is not None and self._total_bytes > self.max_bytes
+
+    def _evict(self):
+        if not self._over_limit():
+            return
+        pending = self.pending_guilds() if self.pending_guilds is not None else ()
+        # 最後に使われたサーバー (直前に読み込んだもの) は残す
+        for guild_id in list(self._entries)[:-1]:
+            if not self._over_limit():
+                break
+            if guild_id in pending:
+                continue
+            del self._entries[guild_id]
+            self._total_bytes -= self._sizes.pop(guild_id)
+            self.evictions += 1
@@ -0,0 +1,401 @@
+"""申請の参考リンクの読み込み
+
+リンク先のページからタイトルと掲載価格を読み、メモリ (期限付きLRU) とSQLiteのファイルにキャッシュする。
+"""
+import asyncio
+import ipaddress
+import json
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+import aiohttp  # discord.pyの依存パッケージ
+
+from embeds import clip_text
+from metrics import metrics
+
+LINK_PREVIEW_FAILURE_TTL = 600  # 読み込めなかったリンクを読み直すまでの秒数
+LINK_PREVIEW_MAX_BYTES = 512 * 1024  # ページの先頭からこのバイト数だけを読む
+LINK_PREVIEW_MAX_REDIRECTS = 3
+LINK_PREVIEW_TITLE_LIMIT = 100
+LINK_TRACKING_PARAMS = ("fbclid", "gclid", "yclid", "_ga")
+LINK_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+HTML_CHARSET_PATTERN = re.compile(rb"""<meta[^>]+charset=["']?([A-Za-z0-9_-]+)""", re.IGNORECASE)
+PRICE_PATTERN = re.compile(r"\d[\d,]*(?:\.\d+)?")
+
+def normalize_link(link: str):
+    """キャッシュのキーにするためにURLを正規化する。http(s)のURLでなければNone"""
+    try:
+        parts = urlsplit(link.strip())
+        port = parts.port
+    except ValueError:
+        return None
+    scheme = parts.scheme.lower()
+    host = parts.hostname
+    if scheme not in ("http", "https") or not host:
+        return None
+    if ":" in host:
+        host = f"[{host}]"
+    # 既定のポート・ユーザー情報・フラグメント・広告用のパラメータは同じページとみなす
+    netloc = host if port is None or port == {"http": 80, "https": 443}[scheme] else f"{host}:{port}"
+    query = "&".join(
+        param for param in parts.query.split("&")
+        if param and not param.lower().startswith("utm_") and param.split("=", 1)[0].lower() not in LINK_TRACKING_PARAMS
+    )
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+def parse_price(text) -> int:
+    match = PRICE_PATTERN.search(str(text))
+    if match is None:
+        return None
+    try:
+        return round(float(match.group().replace(",", "")))
+    except ValueError:
+        return None
+
+def _find_json_ld_price(value):
+    """JSON-LD (schema.orgのProduct/Offer) から最初に見つかった価格を返す"""
+    if isinstance(value, dict):
+        if "price" in value and not isinstance(value["price"], (dict, list)):
+            return parse_price(value["price"])
+        value = list(value.values())
+    if isinstance(value, list):
+        for child in value:
+            price = _find_json_ld_price(child)
+            if price is not None:
+                return price
+    return None
+
+class LinkPreview:
+    __slots__ = ("title", "price")
+
+    def __init__(self, title: str, price: int):
+        self.title = title
+        self.price = price
+
+class LinkPreviewParser(HTMLParser):
+    """OGP・商品のmetaタグ・itemprop・JSON-LDからタイトルと価格を拾う"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.meta_title = None
+        self.price = None
+        self._document_title = None
+        self._capture = None
+        self._text = []
+
+    @property
+    def title(self):
+        title = self.meta_title or self._document_title
+        return " ".join(title.split()) if title else None
+
+    def handle_starttag(self, tag: str, attrs: list):
+        attrs = dict(attrs)
+        key = (attrs.get("property") or attrs.get("name") or attrs.get("itemprop") or "").lower()
+        content = attrs.get("content")
+        if tag == "meta" and content:
+            if key in ("og:title", "twitter:title") and self.meta_title is None:
+                self.meta_title = content
+            elif key in ("product:price:amount", "og:price:amount", "price") and self.price is None:
+                self.price = parse_price(content)
+        elif attrs.get("itemprop") == "price" and self.price is None:
+            if content:
+                self.price = parse_price(content)
+            else:
+                self._start_capture("price")
+        elif tag == "title" and self._document_title is None:
+            self._start_capture("title")
+        elif tag == "script" and (attrs.get("type") or "").lower() == "application/ld+json" and self.price is None:
+            self._start_capture("json_ld")
+
+    def _start_capture(self, kind: str):
+        self._capture = kind
+        self._text = []
+
+    def handle_data(self, data: str):
+        if self._capture is not None:
+            self._text.append(data)
+
+    def handle_endtag(self, tag: str):
+        if self._capture is None or tag in ("meta", "br"):
+            return
+        kind, text = self._capture, "".join(self._text)
+        self._capture = None
+        if kind == "title":
+            self._document_title = text
+        elif kind == "price" and self.price is None:
+            self.price = parse_price(text)
+        elif kind == "json_ld" and self.price is None:
+            try:
+                self.price = _find_json_ld_price(json.loads(text))
+            except ValueError:
+                pass
+
+def parse_link_preview(body: bytes, charset: str = None):
+    """HTMLからタイトルと価格を取り出す。どちらも見つからなければNone"""
+    if charset is None:
+        match = HTML_CHARSET_PATTERN.search(body, 0, 4096)
+        charset = match.group(1).decode("ascii") if match else "utf-8"
+    try:
+        text = body.decode(charset, errors="replace")
+    except LookupError:
+        text = body.decode("utf-8", errors="replace")
+    parser = LinkPreviewParser()
+    parser.feed(text)
+    parser.close()
+    if parser.title is None and parser.price is None:
+        return None
+    return LinkPreview(clip_text(parser.title, LINK_PREVIEW_TITLE_LIMIT) if parser.title else None, parser.price)
+
+def is_public_address(host: str) -> bool:
+    try:
+        return ipaddress.ip_address(host).is_global
+    except ValueError:
+        return True  # ホスト名は接続時に PublicAddressResolver で確かめる
+
+class PublicAddressResolver(aiohttp.abc.AbstractResolver):
+    """名前解決の結果からローカル・社内ネットワークのアドレスを除く。
+    申請者が入力したURLを読み込むので、Botのホストから内部のサービス (メトリクスなど) に届かないようにする"""
+
+    def __init__(self):
+        self._resolver = aiohttp.DefaultResolver()
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET) -> list:
+        addresses = [address for address in await self._resolver.resolve(host, port, family) if is_public_address(address["host"])]
+        if not addresses:
+            raise OSError(f"{host} は公開されていないアドレスです")
+        return addresses
+
+    async def close(self):
+        await self._resolver.close()
+
+class LinkPreviewStore:
+    """読み込み結果をSQLiteに残し、再起動後やほかのクラスタでも使い回す。スレッドプールから呼ぶ"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS link_previews ("
+                "url TEXT PRIMARY KEY, title TEXT, price INTEGER, ok INTEGER NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("DELETE FROM link_previews WHERE expires_at < ?", (time.time(),))
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, url: str):
+        """(期限, LinkPreviewまたはNone) を返す。期限切れ・未登録ならNone"""
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT title, price, ok, expires_at FROM link_previews WHERE url = ? AND expires_at >= ?", (url, time.time())
+            ).fetchone()
+        if row is None:
+            return None
+        title, price, ok, expires_at = row
+        return expires_at, (LinkPreview(title, price) if ok else None)
+
+    def put(self, url: str, preview, expires_at: float):
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO link_previews (url, title, price, ok, expires_at) VALUES (?, ?, ?, ?, ?)",
+                (url, preview.title if preview else None, preview.price if preview else None, 1 if preview else 0, expires_at)
+            )
+            conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+class LinkPreviewResolver:
+    """リンク先の情報を、メモリ (期限付きLRU) → ディスク → HTTP の順に探す。
+    HTTPのセッションと接続プールは全体で1つを共有し、同時に読み込む数を制限する。
+    同じURLを同時に求められたときは1回だけ読み込む。"""
+
+    def __init__(self, store: LinkPreviewStore, max_entries: int, ttl: float, concurrency: int, per_host: int, timeout: float, allow_private: bool):
+        self.store = store
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.allow_private = allow_private
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._tasks = set()
+        self._session = None
+        self._semaphore = None
+        # ディスクの読み書きとHTMLの解析は、イベントループも既定のスレッドプールも止めないよう専用のスレッドで行う
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="link-preview")
+        self.hits = 0
+        self.disk_hits = 0
+        self.fetches = 0
+        self.failures = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def pending_count(self) -> int:
+        """読み込み中のリンクと、Embedの描き直しを待っている申請の数"""
+        return len(self._inflight) + len(self._tasks)
+
+    def start(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.concurrency, limit_per_host=self.per_host, ttl_dns_cache=300,
+                resolver=None if self.allow_private else PublicAddressResolver()
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"User-Agent": "Mozilla/5.0 (compatible; budgetBOT link preview)", "Accept": "text/html,application/xhtml+xml"}
+            )
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def close(self):
+        for task in [*self._tasks, *self._inflight.values()]:
+            task.cancel()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.store.close)
+        # ストアを閉じる処理が最後に予約したものなので、待つ処理は残っていない
+        self._executor.shutdown()
+
+    def _lookup(self, url: str):
+        entry = self._entries.get(url)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del self._entries[url]
+            return None
+        self._entries.move_to_end(url)
+        return entry
+
+    def _remember(self, url: str, expires_at: float, preview):
+        self._entries[url] = (expires_at, preview)
+        self._entries.move_to_end(url)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def cached(self, link: str) -> bool:
+        """読み込み済み (読み込めなかった場合も含む) ならTrue"""
+        url = normalize_link(link)
+        return url is not None and self._lookup(url) is not None
+
+    def peek(self, link: str):
+        """メモリにある読み込み結果を返す。まだ読み込んでいない・読み込めなかった場合はNone"""
+        url = normalize_link(link)
+        entry = self._lookup(url) if url is not None else None
+        return entry[1] if entry is not None else None
+
+    async def resolve(self, link: str):
+        url = normalize_link(link)
+        if url is None or self._session is None:
+            return None
+        entry = self._lookup(url)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+        task = self._inflight.get(url)
+        if task is None:
+            task = self._inflight[url] = asyncio.create_task(self._load(url))
+            task.add_done_callback(lambda _: self._inflight.pop(url, None))
+        # 待っている呼び出し元の1つがキャンセルされても、ほかの呼び出し元の読み込みは続ける
+        return await asyncio.shield(task)
+
+    def prefetch(self, link: str):
+        """結果を待たずに読み込みを始める"""
+        if self._session is not None and normalize_link(link) is not None and not self.cached(link):
+            self.track(asyncio.create_task(self.resolve(link)))
+
+    def track(self, task: asyncio.Task):
+        # 実行中のタスクが参照を失って回収されないように持っておく
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _load(self, url: str):
+        loop = asyncio.get_running_loop()
+        try:
+            entry = await loop.run_in_executor(self._executor, self.store.get, url)
+        except sqlite3.Error as e:
+            print(f"Failed to read link preview cache: {e}")
+            entry = None
+        if entry is not None:
+            self.disk_hits += 1
+            self._remember(url, *entry)
+            return entry[1]
+        preview = await self._fetch(url)
+        expires_at = time.time() + (self.ttl if preview is not None else LINK_PREVIEW_FAILURE_TTL)
+        self._remember(url, expires_at, preview)
+        try:
+            await loop.run_in_executor(self._executor, self.store.put, url, preview, expires_at)
+        except sqlite3.Error as e:
+            print(f"Failed to write link preview cache: {e}")
+        return preview
+
+    async def _fetch(self, url: str):
+        async with self._semaphore:
+            self.fetches += 1
+            started = time.perf_counter()
+            try:
+                preview = await self._fetch_page(url)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError, UnicodeError, ValueError):
+                preview = None
+            metrics.observe("budgetbot_link_preview_seconds", time.perf_counter() - started, outcome="ok" if preview else "failed")
+            if preview is None:
+                self.failures += 1
+            return preview
+
+    async def _fetch_page(self, url: str):
+        # リダイレクト先もアドレスを確かめるため、自分でたどる
+        for _ in range(LINK_PREVIEW_MAX_REDIRECTS + 1):
+            if not self.allow_private and not is_public_address(urlsplit(url).hostname or ""):
+                return None
+            async with self._session.get(url, allow_redirects=False) as response:
+                location = response.headers.get("Location")
+                if response.status in LINK_REDIRECT_STATUSES and location:
+                    url = urljoin(url, location)
+                    if normalize_link(url) is None:
+                        return None
+                    continue
+                if response.status != 200 or response.content_type not in ("text/html", "application/xhtml+xml"):
+                    return None
+                chunks = []
+                size = 0
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size >= LINK_PREVIEW_MAX_BYTES:
+                        break
+                # 大きいページの解析はイベントループを止めるので、専用のスレッドで行う
+                return await asyncio.get_running_loop().run_in_executor(
+                    self._executor, parse_link_preview, b"".join(chunks)[:LINK_PREVIEW_MAX_BYTES], response.charset
+                )
+        return None
+
+def format_link_preview(preview: LinkPreview, unit_price: int) -> str:
+    parts = [f"🔎 {preview.title}"] if preview.title else ["🔎"]
+    if preview.price is not None:
+        price = f"掲載価格 ¥{preview.price:,}"
+        if preview.price != unit_price:
+            price += " ⚠️ 単価と異なります"
+        parts.append(price)
+    return " ・ ".join(parts)
@@ -0,0 +1,159 @@
+"""処理時間のメトリクス
+
+コマンド・ボタン・保存処理・Discord APIの呼び出しの所要時間をヒストグラムに集め、
+Prometheus形式で公開する。
+"""
+import bisect
+import functools
+import os
+import sys
+import time
+
+from aiohttp import web
+
+try:
+    import resource  # メモリ使用量の表示にのみ使用 (Windowsにはない)
+except ImportError:
+    resource = None
+
+# 処理時間のヒストグラムのバケット (秒)
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    __slots__ = ("counts", "total", "count", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """バケットの上端で近似した分位点"""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(METRIC_BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+class Metrics:
+    """処理時間をメトリクス名とラベルごとのヒストグラムに集める。しきい値を超えた呼び出しはログに出す"""
+
+    def __init__(self, slow_threshold: float = None):
+        self.slow_threshold = slow_threshold
+        self._histograms = {}
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(seconds)
+        if self.slow_threshold is not None and seconds >= self.slow_threshold:
+            label_text = ", ".join(f"{k}={v}" for k, v in key[1])
+            print(f"🐢 Slow call: {name} ({label_text}) {seconds * 1000:.0f}ms")
+
+    def histograms(self) -> list:
+        """[(メトリクス名, ラベル, ヒストグラム)] を返す"""
+        return [(name, dict(labels), histogram) for (name, labels), histogram in self._histograms.items()]
+
+    def render(self, samples: list) -> str:
+        """Prometheusのテキスト形式で書き出す。samplesは (名前, 種類, 値) のリスト"""
+        lines = []
+        declared = set()
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            if name not in declared:
+                lines.append(f"# TYPE {name} histogram")
+                declared.add(name)
+            label_text = ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels)
+            prefix = label_text + "," if label_text else ""
+            cumulative = 0
+            for bound, n in zip(METRIC_BUCKETS, histogram.counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+            lines.append(f"{name}_sum{{{label_text}}} {histogram.total}")
+            lines.append(f"{name}_count{{{label_text}}} {histogram.count}")
+        for name, kind, value in samples:
+            # ラベル付きの値は同じメトリクス名で続けて並べる
+            base_name = name.split("{", 1)[0]
+            if base_name not in declared:
+                lines.append(f"# TYPE {base_name} {kind}")
+                declared.add(base_name)
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# どのモジュールからも同じ場所に記録する (しきい値は設定を読んだ側が slow_threshold に入れる)
+metrics = Metrics()
+
+def process_rss_bytes():
+    """プロセスの現在の常駐メモリ (RSS, バイト)。/proc がない環境では起動後の最大値、それもなければNone"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    return peak_rss_bytes()
+
+def peak_rss_bytes():
+    """起動後の常駐メモリの最大値 (バイト)。resource がない環境ではNone"""
+    if resource is None:
+        return None
+    # ru_maxrss はLinuxではKiB、macOSではバイト単位
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+def timed(callback: str):
+    """ボタン・セレクト・モーダルなどのコールバックの処理時間を記録するデコレーター"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                metrics.observe("budgetbot_callback_seconds", time.perf_counter() - started, callback=callback)
+        return wrapper
+    return decorator
+
+def instrument_http(client, api: str):
+    """Discord APIへのリクエストの所要時間をルートごとに記録する"""
+    original = client.request
+
+    async def request(route, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await original(route, *args, **kwargs)
+        finally:
+            metrics.observe(
+                "budgetbot_discord_http_seconds", time.perf_counter() - started,
+                api=api, route=f"{route.method} {route.path}"
+            )
+    client.request = request
+
+async def start_metrics_server(host: str, port: int, collect_samples) -> web.AppRunner:
+    """collect_samples() はヒストグラム以外の値を (名前, 種類, 値) のリストで返す"""
+    async def handle(request):
+        return web.Response(
+            body=metrics.render(collect_samples()).encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"📈 メトリクスを http://{host}:{port}/metrics で公開しています。")
+    return runner
@@ -0,0 +1,157 @@
+"""Discordへの送信・編集の待ち行列
+
+チャンネルごとのレート制限に収まるよう間隔を空け、まだ送っていない同じメッセージへの編集は1回にまとめる。
+"""
+import asyncio
+import contextlib
+import time
+import weakref
+from collections import deque
+
+import discord
+
+from metrics import metrics
+
+class OutboundOp:
+    __slots__ = ("route", "func", "kwargs", "future", "queued_at", "message_id")
+
+    def __init__(self, route: str, func, kwargs: dict, future: asyncio.Future, message_id: int):
+        self.route = route
+        self.func = func
+        self.kwargs = kwargs
+        self.future = future
+        self.queued_at = time.perf_counter()
+        self.message_id = message_id
+
+def _report_outbound_failure(future: asyncio.Future):
+    # 結果を待たない呼び出し元 (編集など) の失敗もログに残す
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Failed to deliver message: {future.exception()}")
+
+class OutboundDispatcher:
+    """Discordへの送信・編集をレーンごとの待ち行列で順番に処理する。
+    チャンネルへの送信・編集はチャンネルごとのレート制限 (rate 回 / per 秒) に収まるよう間隔を空け、
+    まだ送っていない同じメッセージへの編集は最新の内容にまとめる。
+    同じメッセージへの編集はレーンが違っても同時には送らず、送り始めた順に届くようにする。"""
+
+    def __init__(self, rate: int, per: float):
+        self.rate = rate
+        self.per = per
+        self._lanes = {}
+        self._workers = {}
+        self._edits = {}
+        self._message_locks = weakref.WeakValueDictionary()
+        self._history = {}
+        self.completed = 0
+        self.coalesced = 0
+        self.throttled = 0
+
+    def send(self, channel, **kwargs) -> asyncio.Future:
+        return self._enqueue(("channel", channel.id), "channel_send", channel.send, kwargs, None)
+
+    def edit_message(self, message, only_if=None, **kwargs) -> asyncio.Future:
+        """only_if (引数なしのコルーチン関数) を渡すと、送る直前に呼んでFalseなら編集しない"""
+        func = message.edit
+        if only_if is not None:
+            async def func(**kwargs):
+                if not await only_if():
+                    return None
+                return await message.edit(**kwargs)
+        return self._enqueue(("channel", message.channel.id), "channel_edit", func, kwargs, message.id)
+
+    def edit_interaction(self, interaction: discord.Interaction, **kwargs) -> asyncio.Future:
+        """defer済みのインタラクションの元メッセージを編集する。
+        インタラクションのトークン経由なのでチャンネルのレート制限には数えない"""
+        message_id = interaction.message.id
+        return self._enqueue(("message", message_id), "interaction_edit", interaction.edit_original_response, kwargs, message_id)
+
+    def _enqueue(self, lane: tuple, route: str, func, kwargs: dict, message_id: int) -> asyncio.Future:
+        if message_id is not None:
+            op = self._edits.get(message_id)
+            if op is not None:
+                # まだ送っていない編集に後の変更を重ねて、1回の編集で最新の状態にする
+                op.func = func
+                op.kwargs = {**op.kwargs, **kwargs}
+                self.coalesced += 1
+                return op.future
+        op = OutboundOp(route, func, kwargs, asyncio.get_running_loop().create_future(), message_id)
+        op.future.add_done_callback(_report_outbound_failure)
+        self._lanes.setdefault(lane, deque()).append(op)
+        if message_id is not None:
+            self._edits[message_id] = op
+        if lane not in self._workers:
+            self._workers[lane] = asyncio.create_task(self._run(lane))
+        return op.future
+
+    async def _run(self, lane: tuple):
+        queue = self._lanes[lane]
+        try:
+            while queue:
+                if lane[0] == "channel":
+                    # 待っている間に届いた編集は先頭の操作にまとめられる
+                    await self._throttle(lane)
+                op = queue.popleft()
+                if self._edits.get(op.message_id) is op:
+                    del self._edits[op.message_id]
+                metrics.observe("budgetbot_outbound_wait_seconds", time.perf_counter() - op.queued_at, route=op.route)
+                try:
+                    async with self._message_lock(op.message_id):
+                        result = await op.func(**op.kwargs)
+                except Exception as e:
+                    op.future.set_exception(e)
+                else:
+                    op.future.set_result(result)
+                self.completed += 1
+        finally:
+            for op in queue:
+                op.future.cancel()
+                if self._edits.get(op.message_id) is op:
+                    del self._edits[op.message_id]
+            del self._lanes[lane]
+            del self._workers[lane]
+            if lane in self._history:
+                asyncio.get_running_loop().call_later(self.per, self._forget, lane)
+
+    def _message_lock(self, message_id: int):
+        # チャンネルのレーンとインタラクションのレーンから同じメッセージを同時に編集すると、
+        # Discordに届く順番が決まらず、先に送った古い内容で上書きされることがある
+        if message_id is None:
+            return contextlib.nullcontext()
+        lock = self._message_locks.get(message_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._message_locks[message_id] = lock
+        return lock
+
+    async def _throttle(self, lane: tuple):
+        history = self._history.setdefault(lane, deque())
+        while True:
+            now = time.monotonic()
+            while history and now - history[0] >= self.per:
+                history.popleft()
+            if len(history) < self.rate:
+                break
+            self.throttled += 1
+            await asyncio.sleep(self.per - (now - history[0]))
+        history.append(time.monotonic())
+
+    def _forget(self, lane: tuple):
+        # 使われなくなったチャンネルの送信履歴を捨てる
+        if lane not in self._workers:
+            self._history.pop(lane, None)
+
+    def queue_depths(self) -> dict:
+        """ルートごとの未送信の操作数"""
+        depths = {"channel_send": 0, "channel_edit": 0, "interaction_edit": 0}
+        for queue in self._lanes.values():
+            for op in queue:
+                depths[op.route] += 1
+        return depths
+
+    async def drain(self, timeout: float = 30.0):
+        """終了前に待ち行列に残っている送信・編集を送り切る"""
+        deadline = time.monotonic() + timeout
+        while self._workers and time.monotonic() < deadline:
+            await asyncio.wait(list(self._workers.values()), timeout=deadline - time.monotonic())
+        for task in list(self._workers.values()):
+            task.cancel()
@@ -0,0 +1,61 @@
+"""会計権限の判定結果のキャッシュ"""
+from collections import OrderedDict
+
+class PermissionCache:
+    """(サーバー, メンバー) ごとの会計権限の判定結果を最近使った順に保持する。
+    メンバーのロール変更・ロール削除・会計ロールの追加/削除のイベントで無効化する。"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._members = {}
+        # 判定中に無効化された結果を書き込まないよう、無効化のたびに世代を進める
+        self._generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, guild_id: int, member_id: int):
+        """判定結果を返す。キャッシュになければNone"""
+        allowed = self._entries.get((guild_id, member_id))
+        if allowed is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end((guild_id, member_id))
+        self.hits += 1
+        return allowed
+
+    def generation(self, guild_id: int) -> int:
+        return self._generations.get(guild_id, 0)
+
+    def put(self, guild_id: int, member_id: int, allowed: bool, generation: int):
+        if generation != self.generation(guild_id):
+            return
+        self._entries[(guild_id, member_id)] = allowed
+        self._entries.move_to_end((guild_id, member_id))
+        self._members.setdefault(guild_id, set()).add(member_id)
+        while len(self._entries) > self.max_entries:
+            (old_guild_id, old_member_id), _ = self._entries.popitem(last=False)
+            self._discard_member(old_guild_id, old_member_id)
+
+    def _discard_member(self, guild_id: int, member_id: int):
+        members = self._members.get(guild_id)
+        if members is not None:
+            members.discard(member_id)
+            if not members:
+                del self._members[guild_id]
+
+    def invalidate_member(self, guild_id: int, member_id: int):
+        self._generations[guild_id] = self.generation(guild_id) + 1
+        if self._entries.pop((guild_id, member_id), None) is not None:
+            self._discard_member(guild_id, member_id)
+            self.invalidations += 1
+
+    def invalidate_guild(self, guild_id: int):
+        self._generations[guild_id] = self.generation(guild_id) + 1
+        for member_id in self._members.pop(guild_id, ()):
+            del self._entries[(guild_id, member_id)]
+            self.invalidations += 1
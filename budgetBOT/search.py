@@ -0,0 +1,178 @@
+"""予算名と審査記録の索引
+
+BudgetIndex は予算名の候補を、ReviewSearchIndex は !history で審査記録を引くのに使う。
+"""
+import bisect
+import functools
+import itertools
+import sys
+import unicodedata
+from array import array
+
+# --- Budget Name Index ---
+
+BUDGET_SUGGESTION_LIMIT = 25
+
+def normalize_search_key(name: str) -> str:
+    # 全角/半角・大文字/小文字の違いを無視して検索する
+    return unicodedata.normalize("NFKC", name).casefold()
+
+def bigrams(key: str) -> set:
+    return {key[i:i + 2] for i in range(len(key) - 1)}
+
+class BudgetIndex:
+    """予算名の索引。前方一致はソート済みのリスト、部分一致は2文字ずつの転置索引で引き、
+    どちらでも足りなければ文字が順に含まれる名前 (あいまい一致) を探す"""
+
+    def __init__(self, names=()):
+        self._keys = {}
+        self._sorted = []
+        self._grams = {}
+        for name in names:
+            self.add(name)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, name: str):
+        if name in self._keys:
+            return
+        key = normalize_search_key(name)
+        self._keys[name] = key
+        bisect.insort(self._sorted, (key, name))
+        for gram in bigrams(key):
+            self._grams.setdefault(gram, set()).add(name)
+
+    def remove(self, name: str):
+        key = self._keys.pop(name, None)
+        if key is None:
+            return
+        del self._sorted[bisect.bisect_left(self._sorted, (key, name))]
+        for gram in bigrams(key):
+            names = self._grams[gram]
+            names.discard(name)
+            if not names:
+                del self._grams[gram]
+
+    def search(self, query: str, limit: int = BUDGET_SUGGESTION_LIMIT) -> list:
+        query = normalize_search_key(query.strip())
+        if not query:
+            return [name for _, name in self._sorted[:limit]]
+        results = []
+        seen = set()
+
+        def take(names):
+            for name in names:
+                if len(results) >= limit:
+                    return
+                if name not in seen:
+                    seen.add(name)
+                    results.append(name)
+
+        start = bisect.bisect_left(self._sorted, (query,))
+        take(name for key, name in itertools.takewhile(lambda entry: entry[0].startswith(query), self._sorted[start:start + limit]))
+        if len(results) < limit:
+            grams = bigrams(query)
+            if grams:
+                postings = sorted((self._grams.get(gram, set()) for gram in grams), key=len)
+                candidates = set.intersection(*postings) if postings[0] else set()
+            else:
+                candidates = self._keys.keys()
+            take(sorted(name for name in candidates if query in self._keys[name]))
+        if len(results) < limit:
+            take(name for key, name in self._sorted if _is_subsequence(query, key))
+        return results
+
+def _is_subsequence(query: str, key: str) -> bool:
+    chars = iter(key)
+    return all(char in chars for char in query)
+
+def budget_index(data: dict) -> BudgetIndex:
+    """サーバーの予算名の索引。初回に予算一覧から作り、以降は予算の追加・削除に合わせて更新する"""
+    index = data.get("budget_index")
+    if index is None:
+        index = data["budget_index"] = BudgetIndex(data["budgets"])
+    return index
+
+# --- Review History Search ---
+
+def link_domains(link: str) -> tuple:
+    """リンクのドメインと、その上位のドメイン (example.com のような2階層まで)。shop.example.com を example.com でも引けるようにする"""
+    # 索引を作るときに全行で呼ぶので、urlsplitを使わずにホスト部分だけを切り出す
+    _, separator, rest = link.strip().partition("://")
+    if not separator:
+        return ()
+    host = rest.split("/", 1)[0].split("?", 1)[0].split("#", 1)[0].rpartition("@")[2]
+    return _domain_suffixes(host.rsplit(":", 1)[0] if host.count(":") == 1 else host)
+
+@functools.lru_cache(maxsize=4096)
+def _domain_suffixes(host: str) -> tuple:
+    host = host.lower()
+    if host.startswith("www."):
+        host = host[len("www."):]
+    if not host:
+        return ()
+    labels = host.split(".")
+    return tuple(".".join(labels[i:]) for i in range(max(len(labels) - 1, 1)))
+
+def review_terms(record: dict) -> set:
+    """審査記録を引くための語。項目ごとに接頭辞を付け、品名は2文字ずつに分けて部分一致で引けるようにする"""
+    terms = {
+        "a:" + normalize_search_key(record["applicant"]),
+        "p:" + normalize_search_key(record["approver"]),
+        "b:" + normalize_search_key(record["budget_name"]),
+        "r:" + record["result"],
+    }
+    terms.update("d:" + domain for domain in link_domains(record["link"]))
+    terms.update("n:" + gram for gram in bigrams(normalize_search_key(record["name"])))
+    return terms
+
+def _intersect_sorted(postings: list) -> list:
+    """昇順の行番号の配列の共通部分を昇順で返す。短い配列から順に絞り込む"""
+    postings = sorted(postings, key=len)
+    rows = set(postings[0])
+    for other in postings[1:]:
+        if not rows:
+            break
+        if len(rows) * 16 < len(other):
+            # 候補が十分少なければ、長い配列は二分探索で引く
+            rows = {row for row in rows if _contains_sorted(other, row)}
+        else:
+            rows = rows.intersection(other)
+    return sorted(rows)
+
+def _contains_sorted(values, value) -> bool:
+    i = bisect.bisect_left(values, value)
+    return i < len(values) and values[i] == value
+
+class ReviewSearchIndex:
+    """1サーバーの審査記録の転置索引。語ごとに行番号 (追記順) の配列を持ち、行番号からストレージ上の位置を引く"""
+
+    def __init__(self):
+        self.locators = array("Q")
+        self._postings = {}
+
+    def __len__(self) -> int:
+        return len(self.locators)
+
+    def add(self, record: dict, locator: int):
+        row = len(self.locators)
+        self.locators.append(locator)
+        for term in review_terms(record):
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = array("I")
+            postings.append(row)
+
+    def search(self, terms: list):
+        """すべての語を含む行番号を昇順で返す。語がなければ全行"""
+        if not terms:
+            return range(len(self.locators))
+        postings = [self._postings.get(term) for term in terms]
+        if not all(postings):
+            return []
+        return _intersect_sorted(postings)
+
+    def estimate_size(self) -> int:
+        size = sys.getsizeof(self.locators) + sys.getsizeof(self._postings)
+        return size + sum(sys.getsizeof(term) + sys.getsizeof(postings) for term, postings in self._postings.items())
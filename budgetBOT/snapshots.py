@@ -0,0 +1,391 @@
+"""data/ の増分スナップショットの作成・書き戻し・検証"""
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+from metrics import metrics
+from storage import atomic_write_text
+
+# --- Snapshots ---
+# data/ (SQLiteならデータベースも) の増分スナップショット。
+# ファイルをSNAPSHOT_CHUNK_BYTESごとのチャンクに分け、SHA-256を名前にして objects/ に1つずつ保存する。
+# スナップショットごとの manifests/<日時>.json が、各ファイルのサイズ・更新時刻とチャンクの並びを持つ。
+
+SNAPSHOT_CHUNK_BYTES = 4 * 1024 * 1024
+# SQLiteのデータベースは追記ではなくページ単位で書き換わるので、小さいチャンクに分ける。
+# SQLiteのページは最大64KiBの2の累乗なので、チャンクの境目は常にページの境目になり、
+# 1ページ書き換わってもそのページを含むチャンクだけを保存し直せばよい。
+SNAPSHOT_DB_CHUNK_BYTES = 64 * 1024
+SNAPSHOT_MANIFEST_DIR = "manifests"
+SNAPSHOT_OBJECT_DIR = "objects"
+
+def _sync_written_files(paths: list, root: str):
+    """書き込んだファイルだけをfsyncし、置き換えや新しく作ったディレクトリも残るよう、
+    root までの親ディレクトリを1回ずつfsyncする (os.sync() のようにほかのファイルまで書き出さない)"""
+    root = os.path.abspath(root)
+    directories = set()
+    for file_path in paths:
+        with open(file_path, "rb+") as f:
+            os.fsync(f.fileno())
+        directory = os.path.dirname(os.path.abspath(file_path))
+        directories.add(directory)
+        while directory.startswith(root + os.sep):
+            directory = os.path.dirname(directory)
+            directories.add(directory)
+    for directory in sorted(directories, reverse=True):
+        _sync_directory(directory)
+
+def _sync_directory(path: str):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Windowsではディレクトリを開けないので、置き換えの確定はOSに任せる
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _snapshot_object_path(snapshot_dir: str, digest: str) -> str:
+    return os.path.join(snapshot_dir, SNAPSHOT_OBJECT_DIR, digest[:2], digest)
+
+def _store_snapshot_object(snapshot_dir: str, data: bytes, stats: dict, written: list) -> str:
+    """チャンクを保存してハッシュを返す。同じ内容のチャンクがあれば書き込まない"""
+    digest = hashlib.sha256(data).hexdigest()
+    object_path = _snapshot_object_path(snapshot_dir, digest)
+    if not os.path.exists(object_path):
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        # 書きかけのチャンクが完成したものに見えないよう、一時ファイルから置き換える (同期は最後にまとめて行う)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(object_path), prefix=".tmp-", suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, object_path)
+        written.append(object_path)
+        stats["stored_bytes"] += len(data)
+    return digest
+
+def _read_snapshot_chunks(f, head: bytes, remaining: int, chunk_bytes: int):
+    """head に続けてファイルから remaining バイトを読み、chunk_bytes ごとに区切って返す"""
+    buffer = head
+    while remaining > 0:
+        data = f.read(min(chunk_bytes - len(buffer), remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        buffer += data
+        if len(buffer) >= chunk_bytes:
+            yield buffer
+            buffer = b""
+    if buffer:
+        yield buffer
+
+def _snapshot_file(snapshot_dir: str, file_path: str, previous: dict, stats: dict, written: list,
+                   chunk_bytes: int = None) -> dict:
+    """1ファイル分のマニフェストの項目を作る。
+    サイズと更新時刻が前回と同じなら読まずに前回の項目を使う。
+    同じファイル (inode) が伸びていて、前回の最後のチャンクも変わっていなければ追記とみなし、
+    最後のチャンクから後ろだけを読む。chunk_bytes を省くと SNAPSHOT_CHUNK_BYTES で区切る。"""
+    chunk_bytes = chunk_bytes or SNAPSHOT_CHUNK_BYTES
+    st = os.stat(file_path)
+    if previous is not None and previous["size"] == st.st_size and previous["mtime_ns"] == st.st_mtime_ns:
+        stats["unchanged"] += 1
+        return previous
+    with open(file_path, "rb") as f:
+        # 開いたファイルの情報を使う (statの後に置き換えられていても中身と食い違わない)
+        st = os.fstat(f.fileno())
+        chunks = []
+        head = b""
+        offset = 0
+        if (previous is not None and previous["chunks"] and previous.get("inode") == st.st_ino
+                and previous["size"] <= st.st_size):
+            digest, length = previous["chunks"][-1]
+            f.seek(previous["size"] - length)
+            last = f.read(length)
+            stats["read_bytes"] += len(last)
+            if hashlib.sha256(last).hexdigest() == digest:
+                offset = previous["size"]
+                # 小さい最後のチャンクは後ろの追記分とつなげて保存し直し、チャンクが細切れにならないようにする
+                if length < chunk_bytes:
+                    chunks = previous["chunks"][:-1]
+                    head = last
+                else:
+                    chunks = list(previous["chunks"])
+            else:
+                f.seek(0)
+        size = offset - len(head)
+        for data in _read_snapshot_chunks(f, head, st.st_size - offset, chunk_bytes):
+            chunks.append([_store_snapshot_object(snapshot_dir, data, stats, written), len(data)])
+            size += len(data)
+        stats["read_bytes"] += size - offset
+        stats["appended" if offset else "copied"] += 1
+    return {"size": size, "mtime_ns": st.st_mtime_ns, "inode": st.st_ino, "chunks": chunks}
+
+def backup_sqlite(db_path: str, dest_path: str):
+    """SQLiteのバックアップAPIで、書き込み中でも一貫した時点のコピーを作る"""
+    source = sqlite3.connect(db_path)
+    dest = sqlite3.connect(dest_path)
+    try:
+        source.backup(dest)
+    finally:
+        dest.close()
+        source.close()
+
+def list_snapshots(snapshot_dir: str) -> list:
+    """スナップショット名を古い順に返す"""
+    manifest_dir = os.path.join(snapshot_dir, SNAPSHOT_MANIFEST_DIR)
+    if not os.path.isdir(manifest_dir):
+        return []
+    return sorted(name[:-5] for name in os.listdir(manifest_dir) if name.endswith(".json") and not name.startswith(".tmp-"))
+
+def load_snapshot_manifest(snapshot_dir: str, name: str = None) -> dict:
+    """name を省略すると最新のスナップショットを返す。1つもなければNone"""
+    if name is None:
+        names = list_snapshots(snapshot_dir)
+        if not names:
+            return None
+        name = names[-1]
+    with open(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST_DIR, f"{name}.json"), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    manifest["name"] = name
+    return manifest
+
+def _iter_data_files(data_dir: str, snapshot_dir: str, db_path: str = None, exclude=()):
+    """data_dir 以下のファイルを (スナップショット上の名前, パス) で名前順に返す。
+    data_dir の中に置かれたスナップショット・SQLiteのファイル (別に扱う)・exclude のSQLiteのファイルは含めない"""
+    def key_of(path: str) -> str:
+        relative = os.path.relpath(os.path.abspath(path), os.path.abspath(data_dir))
+        return None if relative.startswith("..") else relative.replace(os.sep, "/")
+
+    skipped = {key_of(snapshot_dir)} | {key_of(path + suffix) for path in exclude for suffix in ("", "-wal", "-shm")}
+    if db_path:
+        skipped.update(key_of(db_path + suffix) for suffix in ("", "-wal", "-shm", "-journal"))
+
+    def walk(directory: str, prefix: str):
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            key = prefix + entry.name
+            if key in skipped:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk(entry.path, key + "/")
+            elif entry.is_file(follow_symlinks=False):
+                yield key, entry.path
+
+    if os.path.isdir(data_dir):
+        yield from walk(data_dir, "")
+
+def create_snapshot(data_dir: str, snapshot_dir: str, db_path: str = None, exclude=()) -> tuple:
+    """スナップショットを取り、(名前, 統計) を返す。db_path を渡すとSQLiteのデータベースも含める。
+    exclude にはスナップショットに含めないSQLiteのファイル (キャッシュなど) を渡す"""
+    started = time.perf_counter()
+    os.makedirs(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST_DIR), exist_ok=True)
+    previous = load_snapshot_manifest(snapshot_dir) or {}
+    previous_files = previous.get("files", {})
+    stats = dict.fromkeys(("files", "unchanged", "appended", "copied", "read_bytes", "stored_bytes"), 0)
+    files = {}
+    written = []
+    for key, file_path in _iter_data_files(data_dir, snapshot_dir, db_path, exclude):
+        if os.path.basename(key).startswith(".tmp-"):
+            continue
+        try:
+            files[key] = _snapshot_file(snapshot_dir, file_path, previous_files.get(key), stats, written)
+        except FileNotFoundError:
+            # 走査中に消えたファイル (書き込み済みの審査待ちの申請など)
+            continue
+    stats["files"] = len(files)
+    database = None
+    if db_path and os.path.exists(db_path):
+        fd, backup_path = tempfile.mkstemp(dir=snapshot_dir, prefix=".tmp-", suffix=".sqlite3")
+        os.close(fd)
+        try:
+            backup_sqlite(db_path, backup_path)
+            # コピーは毎回新しいファイルなので全体を読むが、変わったページを含まないチャンクは保存し直さない
+            # (バックアップAPIはページを同じ位置にコピーする)
+            database = _snapshot_file(snapshot_dir, backup_path, None, stats, written, SNAPSHOT_DB_CHUNK_BYTES)
+        finally:
+            os.remove(backup_path)
+        database["path"] = os.path.basename(db_path)
+        stats["files"] += 1
+    # マニフェストが、ディスクに書き込まれていないチャンクを指すことがないようにする
+    _sync_written_files(written, snapshot_dir)
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    now = datetime.datetime.now()
+    name = now.strftime("%Y%m%dT%H%M%S")
+    existing = set(list_snapshots(snapshot_dir))
+    suffix = 1
+    while name in existing:
+        name = f"{now.strftime('%Y%m%dT%H%M%S')}-{suffix}"
+        suffix += 1
+    manifest = {"version": 1, "created_at": now.isoformat(timespec="seconds"), "files": files, "database": database, "stats": stats}
+    atomic_write_text(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST_DIR, f"{name}.json"), json.dumps(manifest, separators=(",", ":")))
+    # マニフェストの中身は atomic_write_text がfsyncするので、置き換えを確定させる
+    _sync_directory(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST_DIR))
+    return name, stats
+
+def _read_snapshot_object(snapshot_dir: str, digest: str, length: int) -> bytes:
+    with open(_snapshot_object_path(snapshot_dir, digest), "rb") as f:
+        data = f.read()
+    if len(data) != length or hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError(f"スナップショットのデータが壊れています: {digest}")
+    return data
+
+def _restore_snapshot_file(snapshot_dir: str, entry: dict, file_path: str, written: list) -> bool:
+    """ファイルを書き戻す。サイズと更新時刻が一致していれば何もせずFalseを返す"""
+    try:
+        st = os.stat(file_path)
+        if st.st_size == entry["size"] and st.st_mtime_ns == entry["mtime_ns"]:
+            return False
+    except FileNotFoundError:
+        pass
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or ".", prefix=".tmp-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for digest, length in entry["chunks"]:
+                f.write(_read_snapshot_object(snapshot_dir, digest, length))
+        # 次のスナップショットや書き戻しで「変わっていない」と判定できるよう更新時刻も戻す
+        os.utime(tmp_path, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    written.append(file_path)
+    return True
+
+def restore_snapshot(snapshot_dir: str, name: str, data_dir: str, db_path: str = None, exclude=()) -> dict:
+    """スナップショットの時点に data_dir (とdb_path) を戻す。Botを止めてから実行すること。
+    サイズと更新時刻が一致するファイルは書き直さず、スナップショットにないファイルは消す。"""
+    manifest = load_snapshot_manifest(snapshot_dir, name)
+    if manifest is None:
+        raise FileNotFoundError(f"{snapshot_dir} にスナップショットがありません")
+    stats = {"name": manifest["name"], "restored": 0, "unchanged": 0, "removed": 0}
+    written = []
+    paths = {key: os.path.join(data_dir, *key.split("/")) for key in manifest["files"]}
+    for directory in {os.path.dirname(file_path) for file_path in paths.values()}:
+        os.makedirs(directory, exist_ok=True)
+    for key, entry in manifest["files"].items():
+        restored = _restore_snapshot_file(snapshot_dir, entry, paths[key], written)
+        stats["restored" if restored else "unchanged"] += 1
+    for key, file_path in list(_iter_data_files(data_dir, snapshot_dir, db_path, exclude)):
+        if key not in paths:
+            os.remove(file_path)
+            stats["removed"] += 1
+    database = manifest.get("database")
+    if database is not None and db_path:
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        # 古いWALが残っていると書き戻したデータベースに適用されてしまう
+        for side_path in (db_path + "-wal", db_path + "-shm", db_path + "-journal"):
+            if os.path.exists(side_path):
+                os.remove(side_path)
+        stats["restored" if _restore_snapshot_file(snapshot_dir, database, db_path, written) else "unchanged"] += 1
+    _sync_written_files(written, data_dir)
+    return stats
+
+def verify_snapshots(snapshot_dir: str, names: list) -> list:
+    """スナップショットが参照するチャンクがそろっていて壊れていないか調べ、問題の一覧を返す"""
+    problems = []
+    checked = {}
+    for name in names:
+        manifest = load_snapshot_manifest(snapshot_dir, name)
+        entries = list(manifest["files"].items())
+        if manifest.get("database") is not None:
+            entries.append((f"(database) {manifest['database']['path']}", manifest["database"]))
+        for key, entry in entries:
+            if sum(length for _, length in entry["chunks"]) != entry["size"]:
+                problems.append(f"{name}: {key} のサイズがチャンクの合計と一致しません")
+            for digest, length in entry["chunks"]:
+                if digest not in checked:
+                    try:
+                        _read_snapshot_object(snapshot_dir, digest, length)
+                        checked[digest] = None
+                    except (OSError, ValueError) as e:
+                        checked[digest] = str(e)
+                if checked[digest] is not None:
+                    problems.append(f"{name}: {key}: {checked[digest]}")
+    return problems
+
+def prune_snapshots(snapshot_dir: str, keep: int) -> int:
+    """新しい keep 個を残して古いスナップショットを消し、どこからも使われなくなったチャンクも消す"""
+    names = list_snapshots(snapshot_dir)
+    if keep is None or len(names) <= keep:
+        return 0
+    for name in names[:len(names) - keep]:
+        os.remove(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST_DIR, f"{name}.json"))
+    referenced = set()
+    for name in names[len(names) - keep:]:
+        manifest = load_snapshot_manifest(snapshot_dir, name)
+        entries = list(manifest["files"].values())
+        if manifest.get("database") is not None:
+            entries.append(manifest["database"])
+        for entry in entries:
+            referenced.update(digest for digest, _ in entry["chunks"])
+    removed = 0
+    for root, _, names_in_dir in os.walk(os.path.join(snapshot_dir, SNAPSHOT_OBJECT_DIR)):
+        for digest in names_in_dir:
+            if digest not in referenced:
+                os.remove(os.path.join(root, digest))
+                removed += 1
+    return removed
+
+class SnapshotScheduler:
+    """Botの動作中に interval 秒ごとにスナップショットを取る。
+    取っている間は quiesce() (非同期のコンテキストマネージャー) で保存処理を止め、
+    すべてのファイルが同じ時点の内容になるようにする (変更はメモリにたまる)。"""
+
+    def __init__(self, interval: float, snapshot_dir: str, keep: int, data_dir: str, db_path: str, exclude, quiesce):
+        self.interval = interval
+        self.snapshot_dir = snapshot_dir
+        self.keep = keep
+        self.data_dir = data_dir
+        self.db_path = db_path
+        self.exclude = exclude
+        self.quiesce = quiesce
+        self.taken = 0
+        self.failures = 0
+        self.last_stats = None
+        self._task = None
+
+    def start(self):
+        if self.interval and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.take()
+            except Exception as e:
+                self.failures += 1
+                print(f"Failed to take snapshot: {e}")
+
+    async def take(self) -> tuple:
+        loop = asyncio.get_running_loop()
+        async with self.quiesce():
+            name, stats = await loop.run_in_executor(
+                None, create_snapshot, self.data_dir, self.snapshot_dir, self.db_path, self.exclude
+            )
+        await loop.run_in_executor(None, prune_snapshots, self.snapshot_dir, self.keep)
+        metrics.observe("budgetbot_storage_seconds", stats["seconds"], operation="snapshot")
+        self.taken += 1
+        self.last_stats = stats
+        return name, stats
+
+def format_snapshot_stats(name: str, stats: dict) -> str:
+    return (
+        f"📦 スナップショット {name}: {stats['files']:,} ファイル "
+        f"(変更なし {stats['unchanged']:,} / 追記分のみ {stats['appended']:,} / 全体 {stats['copied']:,}), "
+        f"読み込み {stats['read_bytes'] / 1024:,.0f} KiB, 新規保存 {stats['stored_bytes'] / 1024:,.0f} KiB, {stats['seconds']:.2f}秒"
+    )
@@ -0,0 +1,1422 @@
+"""サーバーごとのデータの保存形式と保存先
+
+審査記録・予算の台帳・審査待ちの申請・集計の形式と、それを data/<サーバーID>/ 以下のJSON・CSVか
+SQLiteのデータベースに読み書きするバックエンド、JSONからSQLiteへの移行を置く。
+"""
+import bisect
+import csv
+import datetime
+import io
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+
+### ▼▼▼ ファイル設定 ▼▼▼
+REVIEW_LOG_FILE = "review_results.csv"
+BUDGET_FILE = "budgets.json"
+CHANNEL_FILE = "channels.json"
+SETTINGS_FILE = "settings.json"
+APPLIED_REQUESTS_FILE = "applied_requests.jsonl"
+REVIEW_LOG_INDEX_FILE = "review_log_index.json"
+AGGREGATES_FILE = "aggregates.json"
+PENDING_REQUESTS_DIR = "pending_requests"
+PENDING_INDEX_FILE = "pending_index.jsonl"
+LEDGER_DIR = "ledger"
+
+# --- Review Log Format ---
+
+# 現行のCSVヘッダー。日時は後から追加した列なので末尾に置いている
+REVIEW_LOG_HEADER = ["申請者", "購入物", "リンク", "単価", "個数", "合計金額", "結果", "承認者", "予算項目", "日時"]
+# 単価・個数を記録する前の旧形式 (金額の1列のみ)
+LEGACY_REVIEW_LOG_HEADER = ["申請者", "購入物", "リンク", "金額", "結果", "承認者", "予算項目"]
+
+def _to_int(value, default: int = 0) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+def now_timestamp() -> str:
+    """審査記録などに使うタイムスタンプ (ローカル時刻, タイムゾーン付き)"""
+    return datetime.datetime.now().astimezone().isoformat(timespec="seconds")
+
+def parse_review_row(row: list):
+    """CSVの1行を辞書に変換する。旧形式(7列)・日時なし(9列)・現行(10列)のどれでも読める。
+    ヘッダー行や壊れた行はNoneを返す。"""
+    if not row or row[0] == REVIEW_LOG_HEADER[0]:
+        return None
+    if len(row) == len(LEGACY_REVIEW_LOG_HEADER):
+        applicant, name, link, amount, result, approver, budget_name = row
+        return {
+            "applicant": applicant, "name": name, "link": link,
+            "unit_price": _to_int(amount), "quantity": 1, "amount": _to_int(amount),
+            "result": result, "approver": approver, "budget_name": budget_name, "created_at": None
+        }
+    if len(row) in (len(REVIEW_LOG_HEADER) - 1, len(REVIEW_LOG_HEADER)):
+        applicant, name, link, unit_price, quantity, amount, result, approver, budget_name = row[:9]
+        return {
+            "applicant": applicant, "name": name, "link": link,
+            "unit_price": _to_int(unit_price), "quantity": _to_int(quantity, 1), "amount": _to_int(amount),
+            "result": result, "approver": approver, "budget_name": budget_name,
+            "created_at": row[9] if len(row) > 9 and row[9] else None
+        }
+    return None
+
+def review_row_matches(record: dict, filters: dict) -> bool:
+    """審査記録が絞り込み条件に合うかどうか。
+    filters: since / until (YYYY-MM-DD, untilは含まない), budget_name, applicant, result"""
+    if not filters:
+        return True
+    for key in ("budget_name", "applicant", "result"):
+        if filters.get(key) is not None and record[key] != filters[key]:
+            return False
+    if filters.get("since") or filters.get("until"):
+        created_at = record["created_at"]
+        # 日時のない旧形式の記録は期間指定の対象外
+        if not created_at:
+            return False
+        if filters.get("since") and created_at[:10] < filters["since"]:
+            return False
+        if filters.get("until") and created_at[:10] >= filters["until"]:
+            return False
+    return True
+
+def review_row_to_csv(record: dict) -> list:
+    return [
+        record["applicant"], record["name"], record["link"], record["unit_price"], record["quantity"],
+        record["amount"], record["result"], record["approver"], record["budget_name"], record["created_at"] or ""
+    ]
+
+# --- Budget Ledger Format ---
+# 予算の残高は取引 (entry) の積み重ねとして記録する。
+# entry: {"seq": 通し番号, "at": 日時, "budget": 予算名, "delta": 増減額, "kind": "credit"/"debit"/"adjustment"/"review", "request_id", "actor"}
+# snapshot: {"seq": この番号までの取引を反映済み, "created_at": 日時, "balances": {予算名: 残高}, "applied": {申請ID: 反映日時}}
+# 審査結果の反映は必ず台帳に1件残す (引き落としのない却下は "review" で残高を変えない)。
+# どの申請を反映済みかは台帳だけを正として、スナップショットの "applied" とそれ以降の取引の request_id から読み直す。
+
+def ledger_snapshot(seq: int, balances: dict, applied: dict = None) -> dict:
+    return {"seq": seq, "created_at": now_timestamp(), "balances": balances, "applied": applied or {}}
+
+def apply_ledger_entry(balances: dict, entry: dict) -> int:
+    if entry["kind"] == "review":
+        return balances.get(entry["budget"])
+    balances[entry["budget"]] = balance = balances.get(entry["budget"], 0) + entry["delta"]
+    return balance
+
+def ledger_time_visible(timestamp: str, upto: str) -> bool:
+    """uptoは YYYY-MM-DDTHH:MM:SS 形式 (その時刻を含む)。Noneなら常にTrue"""
+    return upto is None or timestamp[:19] <= upto
+
+def replay_ledger(store, guild_id: int, upto: str = None, full: bool = False, applied: dict = None):
+    """スナップショットと以降の取引から残高を計算し、(残高, 反映した最後の取引番号) を返す。
+    full=Trueなら最初のスナップショットからすべての取引をたどり直す。
+    appliedを渡すと、反映済みの申請ID (スナップショットの分と以降の取引の分) をそこに集める。
+    upto より前の記録がなければNoneを返す。"""
+    base = store.ledger_base(guild_id, upto, full)
+    if base is None:
+        return None
+    balances = dict(base["balances"])
+    last_seq = base["seq"]
+    if applied is not None:
+        applied.update(base.get("applied") or {})
+    for entry in store.iter_ledger(guild_id, last_seq):
+        if not ledger_time_visible(entry["at"], upto):
+            break
+        apply_ledger_entry(balances, entry)
+        if applied is not None and entry["request_id"] is not None:
+            applied[entry["request_id"]] = entry["at"]
+        last_seq = entry["seq"]
+    return balances, last_seq
+
+# --- Pending Request Format ---
+
+class RequestItem:
+    """申請の品物1つ。審査待ちの申請は数が多くなるので、辞書ではなくスロットで持つ"""
+    __slots__ = ("name", "link", "unit_price", "quantity", "amount")
+
+    def __init__(self, name: str, link: str, unit_price: int, quantity: int = 1, amount: int = None):
+        self.name = name
+        self.link = link
+        self.unit_price = unit_price
+        self.quantity = quantity
+        self.amount = unit_price * quantity if amount is None else amount
+
+    def to_json(self) -> list:
+        return [self.name, self.link, self.unit_price, self.quantity, self.amount]
+
+    @classmethod
+    def from_json(cls, value):
+        # 以前は品物ごとに辞書で保存していた
+        if isinstance(value, dict):
+            return cls(value["name"], value["link"], value.get("unit_price", value["amount"]), value.get("quantity", 1), value["amount"])
+        return cls(*value)
+
+class PendingRequest:
+    """審査待ちの申請。申請者はIDと表示用の名前・アイコンだけを持ち、discord.Userは保持しない"""
+    __slots__ = (
+        "request_id", "guild_id", "channel_id", "message_id", "author_id", "author_name", "author_avatar",
+        "budget_name", "items", "created_at", "last_used"
+    )
+    FIELDS = __slots__[:-1]
+
+    def __init__(self, request_id: str, guild_id: int, author_id: int, author_name: str, author_avatar: str,
+                 budget_name: str, items: list, created_at: str, channel_id: int = None, message_id: int = None):
+        self.request_id = request_id
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.author_id = author_id
+        # 同じ申請者・予算の申請が多いので、文字列を共有させる
+        self.author_name = sys.intern(author_name)
+        self.author_avatar = author_avatar
+        self.budget_name = sys.intern(budget_name)
+        self.items = items
+        self.created_at = created_at
+        self.last_used = time.monotonic()
+
+    def to_json(self) -> str:
+        payload = {field: getattr(self, field) for field in self.FIELDS}
+        payload["items"] = [item.to_json() for item in self.items]
+        return json.dumps(payload, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, text: str):
+        payload = json.loads(text)
+        payload["items"] = [RequestItem.from_json(value) for value in payload["items"]]
+        return cls(**payload)
+
+    def estimate_size(self) -> int:
+        size = sys.getsizeof(self) + sys.getsizeof(self.items) + sys.getsizeof(self.author_avatar)
+        for item in self.items:
+            size += sys.getsizeof(item) + sys.getsizeof(item.name) + sys.getsizeof(item.link)
+        return size
+
+    def summary(self):
+        return PendingSummary(
+            self.request_id, self.budget_name, sum(item.amount for item in self.items), len(self.items),
+            self.created_at, self.author_id, self.author_name, self.channel_id, self.message_id
+        )
+
+class PendingSummary:
+    """!pending の一覧に出す申請の概要。中身をメモリから外した申請も、これだけは常に持っておく"""
+    __slots__ = (
+        "request_id", "budget_name", "amount", "item_count", "created_at", "author_id", "author_name", "channel_id", "message_id"
+    )
+
+    def __init__(self, request_id: str, budget_name: str, amount: int, item_count: int, created_at: str,
+                 author_id: int, author_name: str, channel_id: int = None, message_id: int = None):
+        self.request_id = request_id
+        self.budget_name = sys.intern(budget_name)
+        self.amount = amount
+        self.item_count = item_count
+        self.created_at = created_at
+        self.author_id = author_id
+        self.author_name = sys.intern(author_name)
+        self.channel_id = channel_id
+        self.message_id = message_id
+
+    def to_json(self) -> list:
+        """申請IDを除いた値のリスト (保存時は申請IDをキーにする)"""
+        return [getattr(self, field) for field in self.__slots__[1:]]
+
+    @classmethod
+    def from_json(cls, request_id: str, value: list):
+        return cls(request_id, *value)
+
+    def jump_url(self, guild_id: int):
+        if self.channel_id is None or self.message_id is None:
+            return None
+        return f"https://discord.com/channels/{guild_id}/{self.channel_id}/{self.message_id}"
+
+# !pending の並べ替え: (キー, 降順か)
+PENDING_SORTS = {
+    "age": (lambda summary: summary.created_at, False),
+    "new": (lambda summary: summary.created_at, True),
+    "amount": (lambda summary: summary.amount, True),
+    "budget": (lambda summary: (summary.budget_name, summary.created_at), False),
+}
+
+class PendingIndex:
+    """サーバーの審査待ちの申請の概要を申請IDと予算項目で引けるようにしておく。
+    申請の登録・審査のたびに更新するので、一覧を出すときにメッセージ履歴をたどる必要がない。"""
+
+    def __init__(self, summaries=()):
+        self._summaries = {}
+        self._by_budget = {}
+        for summary in summaries:
+            self.add(summary)
+
+    def __len__(self):
+        return len(self._summaries)
+
+    def __contains__(self, request_id: str):
+        return request_id in self._summaries
+
+    def __iter__(self):
+        return iter(self._summaries)
+
+    def get(self, request_id: str):
+        return self._summaries.get(request_id)
+
+    def add(self, summary: PendingSummary):
+        """登録する。同じ申請IDがあれば置き換える"""
+        self.remove(summary.request_id)
+        self._summaries[summary.request_id] = summary
+        self._by_budget.setdefault(summary.budget_name, set()).add(summary.request_id)
+
+    def remove(self, request_id: str):
+        summary = self._summaries.pop(request_id, None)
+        if summary is None:
+            return
+        ids = self._by_budget[summary.budget_name]
+        ids.discard(request_id)
+        if not ids:
+            del self._by_budget[summary.budget_name]
+
+    def budget_totals(self) -> dict:
+        """予算項目ごとの (件数, 合計金額)"""
+        return {
+            name: (len(ids), sum(self._summaries[request_id].amount for request_id in ids))
+            for name, ids in self._by_budget.items()
+        }
+
+    def query(self, budget_name: str = None, applicant: str = None, min_amount: int = None, max_amount: int = None,
+              created_before: str = None, sort: str = "age") -> list:
+        """条件に合う申請の概要を並べ替えて返す。applicantは申請者名の部分一致 (大文字・小文字は区別しない)"""
+        if budget_name is not None:
+            candidates = (self._summaries[request_id] for request_id in self._by_budget.get(budget_name, ()))
+        else:
+            candidates = self._summaries.values()
+        applicant = applicant.casefold() if applicant else None
+        matched = [
+            summary for summary in candidates
+            if (applicant is None or applicant in summary.author_name.casefold())
+            and (min_amount is None or summary.amount >= min_amount)
+            and (max_amount is None or summary.amount <= max_amount)
+            and (created_before is None or summary.created_at[:19] < created_before)
+        ]
+        key, reverse = PENDING_SORTS[sort]
+        matched.sort(key=key, reverse=reverse)
+        return matched
+
+    def estimate_size(self) -> int:
+        size = sys.getsizeof(self._summaries) + sum(sys.getsizeof(ids) for ids in self._by_budget.values())
+        for summary in self._summaries.values():
+            size += sys.getsizeof(summary) + sys.getsizeof(summary.created_at)
+        return size
+
+# --- Spending Aggregates Format ---
+
+AGGREGATE_DIMENSIONS = ("budget", "applicant", "month")
+
+def new_aggregates() -> dict:
+    """集計の形: {次元: {キー: [承認額, 承認件数, 却下額, 却下件数]}}"""
+    return {dimension: {} for dimension in AGGREGATE_DIMENSIONS}
+
+def add_to_aggregates(aggregates: dict, record: dict):
+    keys = {
+        "budget": record["budget_name"],
+        "applicant": record["applicant"],
+        "month": (record["created_at"] or "")[:7] or "不明"
+    }
+    offset = 0 if record["result"] == "承認" else 2
+    for dimension, key in keys.items():
+        totals = aggregates[dimension].setdefault(key, [0, 0, 0, 0])
+        totals[offset] += record["amount"]
+        totals[offset + 1] += 1
+
+# --- Storage Backends ---
+# どちらのバックエンドもスレッドプールから呼ばれることを前提にしている
+
+def _atomic_write_json(file_path: str, data, ensure_ascii: bool = True):
+    atomic_write_text(file_path, json.dumps(data, indent=4, ensure_ascii=ensure_ascii))
+
+def atomic_write_text(file_path: str, text: str):
+    """一時ファイルに書き込んでから置き換え、書きかけのファイルが残らないようにする"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix=".tmp-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def settle_applied_requests(store, guild_id: int, applied: dict, summaries: list) -> PendingIndex:
+    """台帳では反映済みなのに審査待ちに残っている申請 (反映の途中で止まったもの) を削除し、
+    残りの審査待ちの申請の一覧を返す。これで反映済みの申請はすべて審査待ちから消えるので、
+    読み込んだ後は反映済みの申請IDをメモリに持っておく必要はない"""
+    remaining = []
+    for summary in summaries:
+        if summary.request_id in applied:
+            store.save_pending_request(guild_id, summary.request_id, None)
+        else:
+            remaining.append(summary)
+    return PendingIndex(remaining)
+
+
+class JsonStorage:
+    """data/<guild_id>/ 以下のJSON・CSVファイルに保存する従来の形式"""
+
+    def __init__(self, data_dir: str, rotate: str = "none", max_segment_bytes: int = None, max_open_files: int = 64):
+        self.data_dir = data_dir
+        self.rotate = rotate
+        self.max_segment_bytes = max_segment_bytes
+        self.max_open_files = max_open_files
+        # 審査記録の書き込みは専用スレッドから、読み出しは任意のスレッドから行われる
+        self._log_lock = threading.Lock()
+        self._review_indexes = {}
+        self._dirty_indexes = set()
+        self._handles = OrderedDict()
+        self._unsynced = set()
+        # サーバーごとの (追記先のスナップショット番号, 書き込み済みの最後の取引番号)
+        self._ledger_state = {}
+        self._pending_index_lock = threading.Lock()
+
+    def close(self):
+        with self._log_lock:
+            for guild_id, (_, f) in self._handles.items():
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+            self._handles.clear()
+            self._unsynced.clear()
+            self._save_dirty_indexes()
+
+    def guild_path(self, guild_id: int) -> str:
+        path = os.path.join(self.data_dir, str(guild_id))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _read_json(self, guild_id: int, file_name: str) -> dict:
+        file_path = os.path.join(self.data_dir, str(guild_id), file_name)
+        try:
+            with open(file_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_json(self, guild_id: int, file_name: str, data, ensure_ascii: bool = True):
+        _atomic_write_json(os.path.join(self.guild_path(guild_id), file_name), data, ensure_ascii=ensure_ascii)
+
+    def guild_ids(self) -> list:
+        if not os.path.isdir(self.data_dir):
+            return []
+        return [int(name) for name in os.listdir(self.data_dir) if name.isdigit()]
+
+    def load_guild(self, guild_id: int) -> dict:
+        settings = self._read_json(guild_id, SETTINGS_FILE)
+        self._migrate_budget_file(guild_id)
+        # 以前は反映済みの申請IDを applied_requests.jsonl に別に記録していた
+        applied = self._read_applied_requests(guild_id)
+        replayed = replay_ledger(self, guild_id, applied=applied)
+        if replayed is None:
+            raise RuntimeError(f"budget ledger of guild {guild_id} has no readable snapshot")
+        budgets, last_seq = replayed
+        snapshot_seq = self._ledger_snapshot_seqs(guild_id)[-1]
+        self._ledger_state[guild_id] = (snapshot_seq, last_seq)
+        pending_index = settle_applied_requests(self, guild_id, applied, self._load_pending_summaries(guild_id))
+        # 突き合わせが済んだので、以前の形式の記録はもう要らない
+        try:
+            os.remove(os.path.join(self.data_dir, str(guild_id), APPLIED_REQUESTS_FILE))
+        except FileNotFoundError:
+            pass
+        return {
+            "budgets": budgets,
+            "ledger": deque(),
+            "ledger_seq": last_seq,
+            "ledger_saved_seq": last_seq,
+            "ledger_snapshot_seq": snapshot_seq,
+            "channels": set(self._read_json(guild_id, CHANNEL_FILE).get("registered_channels", [])),
+            "additional_roles": set(settings.get("additional_role_ids", [])),
+            "no_overdraft": settings.get("no_overdraft", False),
+            # 反映済みで、審査待ちからの削除をまだ書き出していない申請ID
+            "applied_requests": {},
+            # 審査待ちの申請は概要だけを持ち、中身はボタンが押されたときに読む
+            "pending_requests": dict.fromkeys(pending_index),
+            "pending_index": pending_index,
+            # ファイルがなければ集計はまだ作られていない
+            "aggregates": self._read_json(guild_id, AGGREGATES_FILE) or None
+        }
+
+    def read_guild(self, guild_id: int) -> dict:
+        """移行用に、ファイルを書き換えずにサーバーのデータを読む。
+        load_guild と違い、budgets.json の移し替え・反映済みの申請の削除・概要の一覧の書き直しはしない
+        (反映済みなのに審査待ちに残っている申請は、一覧から外すだけ)"""
+        settings = self._read_json(guild_id, SETTINGS_FILE)
+        applied = self._read_applied_requests(guild_id)
+        replayed = replay_ledger(self, guild_id, applied=applied)
+        if replayed is None:
+            raise RuntimeError(f"budget ledger of guild {guild_id} has no readable snapshot")
+        return {
+            "budgets": replayed[0],
+            "channels": set(self._read_json(guild_id, CHANNEL_FILE).get("registered_channels", [])),
+            "additional_roles": set(settings.get("additional_role_ids", [])),
+            "no_overdraft": settings.get("no_overdraft", False),
+            "pending_requests": [request_id for request_id in self._pending_request_ids(guild_id) if request_id not in applied],
+            "aggregates": self._read_json(guild_id, AGGREGATES_FILE) or None
+        }
+
+    def _pending_request_ids(self, guild_id: int) -> list:
+        try:
+            file_names = os.listdir(os.path.join(self.data_dir, str(guild_id), PENDING_REQUESTS_DIR))
+        except FileNotFoundError:
+            return []
+        return [file_name[:-len(".json")] for file_name in file_names if file_name.endswith(".json")]
+
+    # 審査待ちの申請の概要は pending_index.jsonl に {"request_id", "summary"} を追記し、審査済みになったらsummaryをnullにした行を足す。
+    # 申請ファイルの一覧が正しい内容なので、読み込み時に突き合わせ、概要がない申請はファイルから作り直す。
+
+    def _load_pending_summaries(self, guild_id: int) -> list:
+        request_ids = self._pending_request_ids(guild_id)
+        file_path = os.path.join(self.data_dir, str(guild_id), PENDING_INDEX_FILE)
+        summaries = {}
+        line_count = 0
+        try:
+            with open(file_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 書き込み途中で止まった最終行は読み飛ばす
+                        continue
+                    line_count += 1
+                    summaries[entry["request_id"]] = entry["summary"]
+        except FileNotFoundError:
+            pass
+        result = []
+        rebuilt = False
+        for request_id in request_ids:
+            value = summaries.get(request_id)
+            if value is not None:
+                result.append(PendingSummary.from_json(request_id, value))
+                continue
+            request = self.load_pending_request(guild_id, request_id)
+            if request is not None:
+                result.append(request.summary())
+                rebuilt = True
+        # 審査済みの行が溜まった、または作り直した概要があれば、今の内容で書き直す
+        if rebuilt or line_count > 2 * len(result) + 100:
+            with self._pending_index_lock:
+                atomic_write_text(file_path, "".join(self._pending_index_line(summary.request_id, summary) for summary in result))
+        return result
+
+    @staticmethod
+    def _pending_index_line(request_id: str, summary) -> str:
+        return json.dumps({"request_id": request_id, "summary": summary.to_json() if summary is not None else None}, ensure_ascii=False) + "\n"
+
+    def load_pending_request(self, guild_id: int, request_id: str):
+        file_path = os.path.join(self.data_dir, str(guild_id), PENDING_REQUESTS_DIR, f"{request_id}.json")
+        try:
+            with open(file_path, "r", encoding="utf-8") as f:
+                return PendingRequest.from_json(f.read())
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def _read_applied_requests(self, guild_id: int) -> dict:
+        applied = {}
+        file_path = os.path.join(self.data_dir, str(guild_id), APPLIED_REQUESTS_FILE)
+        try:
+            with open(file_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 書き込み途中で止まった最終行は読み飛ばす
+                        continue
+                    applied[entry["request_id"]] = entry["applied_at"]
+        except FileNotFoundError:
+            pass
+        return applied
+
+    # 予算の台帳は ledger/ 以下に、スナップショット <番号>.snapshot.json と、その後の取引を追記する <番号>.jsonl で持つ。
+    # スナップショットを取るたびに追記先を新しいファイルに切り替え、古いファイルは過去の残高をたどるために残しておく。
+    # 番号0のスナップショットがなければ残高0から始まったものとして扱う。
+
+    def _ledger_file(self, guild_id: int, file_name: str) -> str:
+        return os.path.join(self.data_dir, str(guild_id), LEDGER_DIR, file_name)
+
+    def _ledger_snapshot_seqs(self, guild_id: int) -> list:
+        try:
+            file_names = os.listdir(os.path.join(self.data_dir, str(guild_id), LEDGER_DIR))
+        except FileNotFoundError:
+            file_names = []
+        seqs = sorted(int(name.split(".")[0]) for name in file_names if name.endswith(".snapshot.json"))
+        if not seqs or seqs[0] != 0:
+            seqs.insert(0, 0)
+        return seqs
+
+    def _read_ledger_snapshot(self, guild_id: int, seq: int):
+        try:
+            with open(self._ledger_file(guild_id, f"{seq:010d}.snapshot.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            if seq != 0:
+                return None
+            # 以前の budgets.json がまだ移されていなければ、それを最初のスナップショットとして読む
+            budgets = self._read_json(guild_id, BUDGET_FILE)
+            return ledger_snapshot(0, budgets) if budgets else {"seq": 0, "created_at": "", "balances": {}}
+        except json.JSONDecodeError:
+            return None
+
+    def _iter_ledger_segment(self, guild_id: int, seq: int):
+        try:
+            f = open(self._ledger_file(guild_id, f"{seq:010d}.jsonl"), "r", encoding="utf-8")
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で止まった行は読み飛ばす
+                    continue
+
+    def _migrate_budget_file(self, guild_id: int):
+        """以前の budgets.json を台帳の最初のスナップショットに移す"""
+        budget_path = os.path.join(self.data_dir, str(guild_id), BUDGET_FILE)
+        if not os.path.exists(budget_path):
+            return
+        snapshot_path = self._ledger_file(guild_id, f"{0:010d}.snapshot.json")
+        if not os.path.exists(snapshot_path):
+            os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+            _atomic_write_json(snapshot_path, ledger_snapshot(0, self._read_json(guild_id, BUDGET_FILE)), ensure_ascii=False)
+        os.replace(budget_path, budget_path + ".migrated")
+
+    def ledger_base(self, guild_id: int, upto: str = None, full: bool = False):
+        """残高の計算を始めるスナップショット。upto以前に作られたもののうち最新 (fullなら最古) を返す"""
+        seqs = self._ledger_snapshot_seqs(guild_id)
+        for seq in (seqs if full else reversed(seqs)):
+            snapshot = self._read_ledger_snapshot(guild_id, seq)
+            # 壊れたスナップショットは飛ばして、ひとつ前から取引をたどる
+            if snapshot is not None and ledger_time_visible(snapshot["created_at"], upto):
+                return snapshot
+        return None
+
+    def ledger_snapshots(self, guild_id: int):
+        for seq in self._ledger_snapshot_seqs(guild_id):
+            snapshot = self._read_ledger_snapshot(guild_id, seq)
+            if snapshot is not None:
+                yield snapshot
+
+    def iter_ledger(self, guild_id: int, after_seq: int = 0):
+        seqs = self._ledger_snapshot_seqs(guild_id)
+        start = max(bisect.bisect_right(seqs, after_seq) - 1, 0)
+        for seq in seqs[start:]:
+            for entry in self._iter_ledger_segment(guild_id, seq):
+                if entry["seq"] > after_seq:
+                    yield entry
+
+    def recent_ledger_entries(self, guild_id: int, budget_name: str = None, limit: int = 20) -> list:
+        found = []
+        for seq in reversed(self._ledger_snapshot_seqs(guild_id)):
+            entries = [entry for entry in self._iter_ledger_segment(guild_id, seq) if budget_name is None or entry["budget"] == budget_name]
+            found[:0] = entries[-(limit - len(found)):] if entries else []
+            if len(found) >= limit:
+                break
+        return found
+
+    def append_ledger(self, guild_id: int, entries: list, snapshot: dict = None):
+        """取引を追記し、snapshotがあればそれを新しいスナップショットにする。書き込み済みの取引は読み飛ばす"""
+        state = self._ledger_state.get(guild_id)
+        if state is None:
+            seqs = self._ledger_snapshot_seqs(guild_id)
+            state = (seqs[-1], max((entry["seq"] for entry in self._iter_ledger_segment(guild_id, seqs[-1])), default=seqs[-1]))
+        snapshot_seq, last_seq = state
+        lines = [json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries if entry["seq"] > last_seq]
+        if lines:
+            file_path = os.path.join(self.guild_path(guild_id), LEDGER_DIR, f"{snapshot_seq:010d}.jsonl")
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "a+b") as f:
+                # 書きかけで止まった行があれば、改行で区切ってから追記する
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        f.write(b"\n")
+                f.write("".join(lines).encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+            last_seq = entries[-1]["seq"]
+        if snapshot is not None and snapshot["seq"] >= snapshot_seq:
+            os.makedirs(os.path.join(self.guild_path(guild_id), LEDGER_DIR), exist_ok=True)
+            _atomic_write_json(self._ledger_file(guild_id, f"{snapshot['seq']:010d}.snapshot.json"), snapshot, ensure_ascii=False)
+            snapshot_seq = snapshot["seq"]
+        self._ledger_state[guild_id] = (snapshot_seq, last_seq)
+
+    def save_channels(self, guild_id: int, channels: list):
+        self._write_json(guild_id, CHANNEL_FILE, {"registered_channels": channels})
+
+    def save_settings(self, guild_id: int, settings: dict):
+        self._write_json(guild_id, SETTINGS_FILE, {
+            "additional_role_ids": settings["additional_roles"],
+            "no_overdraft": settings["no_overdraft"]
+        })
+
+    def save_aggregates(self, guild_id: int, aggregates: dict):
+        self._write_json(guild_id, AGGREGATES_FILE, aggregates, ensure_ascii=False)
+
+    def save_pending_request(self, guild_id: int, request_id: str, payload: str, summary: PendingSummary = None):
+        """payloadがNoneなら審査済みとして削除する"""
+        pending_dir = os.path.join(self.guild_path(guild_id), PENDING_REQUESTS_DIR)
+        file_path = os.path.join(pending_dir, f"{request_id}.json")
+        if payload is None:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+        else:
+            os.makedirs(pending_dir, exist_ok=True)
+            atomic_write_text(file_path, payload)
+        # 申請ファイルを書いてから概要を足す (途中で止まっても、読み込み時にファイルから作り直せる)
+        with self._pending_index_lock:
+            with open(os.path.join(self.guild_path(guild_id), PENDING_INDEX_FILE), "a", encoding="utf-8") as f:
+                f.write(self._pending_index_line(request_id, summary if payload is not None else None))
+
+    # 審査記録は review_results*.csv のセグメントに分けて追記し、review_log_index.json に一覧を持つ。
+    # 以前からある review_results.csv は最初のセグメントとしてそのまま扱う。
+
+    def _load_review_index(self, guild_id: int) -> list:
+        segments = self._review_indexes.get(guild_id)
+        if segments is not None:
+            return segments
+        segments = self._read_json(guild_id, REVIEW_LOG_INDEX_FILE).get("segments")
+        if segments is None:
+            segments = []
+            legacy_path = os.path.join(self.data_dir, str(guild_id), REVIEW_LOG_FILE)
+            if os.path.exists(legacy_path):
+                segments.append({"file": REVIEW_LOG_FILE, "first_at": None, "last_at": None, "rows": None, "bytes": os.path.getsize(legacy_path)})
+        self._review_indexes[guild_id] = segments
+        return segments
+
+    def _save_dirty_indexes(self):
+        for guild_id in self._dirty_indexes:
+            self._write_json(guild_id, REVIEW_LOG_INDEX_FILE, {"segments": self._review_indexes[guild_id]})
+        self._dirty_indexes.clear()
+
+    def _needs_rotation(self, segment: dict, record: dict) -> bool:
+        if self.rotate == "month":
+            return segment["first_at"] is None or segment["first_at"][:7] != (record["created_at"] or "")[:7]
+        if self.rotate == "size":
+            return segment["bytes"] >= self.max_segment_bytes
+        return False
+
+    def _new_segment(self, guild_id: int, segments: list, record: dict) -> dict:
+        guild_path = self.guild_path(guild_id)
+        seq = len(segments)
+        while os.path.exists(os.path.join(guild_path, f"review_results.{seq:04d}.csv")):
+            seq += 1
+        segment = {
+            "file": f"review_results.{seq:04d}.csv", "first_at": record["created_at"], "last_at": None,
+            "rows": 0, "bytes": len(_csv_line(REVIEW_LOG_HEADER))
+        }
+        segments.append(segment)
+        # 期間での絞り込みはセグメントの開始日時に頼るので、作成時点で一覧を保存しておく
+        self._write_json(guild_id, REVIEW_LOG_INDEX_FILE, {"segments": segments})
+        return segment
+
+    def _segment_handle(self, guild_id: int, file_name: str):
+        entry = self._handles.get(guild_id)
+        if entry is not None and entry[0] == file_name:
+            self._handles.move_to_end(guild_id)
+            return entry[1]
+        if entry is not None:
+            self._close_handle(guild_id)
+        file_path = os.path.join(self.guild_path(guild_id), file_name)
+        f = open(file_path, "ab")
+        if f.tell() == 0:
+            f.write(_csv_line(REVIEW_LOG_HEADER))
+        self._handles[guild_id] = (file_name, f)
+        while len(self._handles) > self.max_open_files:
+            self._close_handle(next(iter(self._handles)))
+        return f
+
+    def _close_handle(self, guild_id: int):
+        _, f = self._handles.pop(guild_id)
+        f.flush()
+        if guild_id in self._unsynced:
+            os.fsync(f.fileno())
+            self._unsynced.discard(guild_id)
+        f.close()
+
+    def append_review_rows(self, guild_id: int, records: list) -> list:
+        """審査記録を追記し、各行の位置 (read_review_rows に渡せる値) を返す"""
+        with self._log_lock:
+            segments = self._load_review_index(guild_id)
+            groups = []
+            for record in records:
+                segment = segments[-1] if segments else None
+                if segment is None or self._needs_rotation(segment, record):
+                    segment = self._new_segment(guild_id, segments, record)
+                line = _csv_line(review_row_to_csv(record))
+                segment["bytes"] += len(line)
+                if segment["rows"] is not None:
+                    segment["rows"] += 1
+                segment["last_at"] = record["created_at"]
+                if groups and groups[-1][0] is segment:
+                    groups[-1][2].append(line)
+                else:
+                    groups.append((segment, len(segments) - 1, [line]))
+            # セグメントごとに1回の書き込みにまとめる
+            locators = []
+            for segment, segment_no, lines in groups:
+                f = self._segment_handle(guild_id, segment["file"])
+                # 索引のバイト数は保存前に止まると古いままなので、実際のファイルの末尾から位置を数える
+                position = f.tell()
+                for line in lines:
+                    locators.append(segment_no << REVIEW_LOCATOR_SHIFT | position)
+                    position += len(line)
+                f.write(b"".join(lines))
+                f.flush()
+            self._unsynced.add(guild_id)
+            self._dirty_indexes.add(guild_id)
+        return locators
+
+    def sync_review_logs(self):
+        """追記した審査記録をディスクに確実に書き込む"""
+        with self._log_lock:
+            for guild_id in self._unsynced:
+                entry = self._handles.get(guild_id)
+                if entry is not None:
+                    os.fsync(entry[1].fileno())
+            self._unsynced.clear()
+            self._save_dirty_indexes()
+
+    def iter_review_rows(self, guild_id: int, filters: dict = None):
+        with self._log_lock:
+            segments = [dict(segment) for segment in self._load_review_index(guild_id)]
+        filters = filters or {}
+        for i, segment in enumerate(segments):
+            # セグメントの期間は「自分の開始日時 〜 次のセグメントの開始日時」
+            next_first_at = segments[i + 1]["first_at"] if i + 1 < len(segments) else None
+            if filters.get("until") and segment["first_at"] and segment["first_at"][:10] >= filters["until"]:
+                continue
+            if filters.get("since") and next_first_at and next_first_at[:10] < filters["since"]:
+                continue
+            log_file_path = os.path.join(self.data_dir, str(guild_id), segment["file"])
+            for record in iter_review_log_file(log_file_path):
+                if review_row_matches(record, filters):
+                    yield record
+
+    def review_log_segments(self, guild_id: int) -> list:
+        with self._log_lock:
+            return [dict(segment) for segment in self._load_review_index(guild_id)]
+
+    # 審査記録の位置は (セグメントの番号 << REVIEW_LOCATOR_SHIFT) | ファイル内の行の先頭のバイト位置
+
+    def iter_review_locators(self, guild_id: int):
+        """すべての審査記録を (位置, 記録) の組で追記順に返す"""
+        for segment_no, segment in enumerate(self.review_log_segments(guild_id)):
+            log_file_path = os.path.join(self.data_dir, str(guild_id), segment["file"])
+            for offset, record in iter_review_log_offsets(log_file_path):
+                yield segment_no << REVIEW_LOCATOR_SHIFT | offset, record
+
+    def read_review_rows(self, guild_id: int, locators: list) -> list:
+        """位置を指定して審査記録を読む。読めなかった行はNone"""
+        segments = self.review_log_segments(guild_id)
+        records = []
+        files = {}
+        try:
+            for locator in locators:
+                segment_no, offset = locator >> REVIEW_LOCATOR_SHIFT, locator & REVIEW_LOCATOR_MASK
+                f = files.get(segment_no)
+                if f is None and segment_no < len(segments):
+                    try:
+                        f = files[segment_no] = open(os.path.join(self.data_dir, str(guild_id), segments[segment_no]["file"]), "rb")
+                    except FileNotFoundError:
+                        pass
+                records.append(read_review_row_at(f, offset) if f is not None else None)
+        finally:
+            for f in files.values():
+                f.close()
+        return records
+
+def _csv_line(row: list) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(row)
+    return buffer.getvalue().encode("utf-8")
+
+# 審査記録の位置のうち、ファイル内のバイト位置に使うビット数
+REVIEW_LOCATOR_SHIFT = 40
+REVIEW_LOCATOR_MASK = (1 << REVIEW_LOCATOR_SHIFT) - 1
+
+def _decoded_lines(f, starts: list = None):
+    """バイナリで開いたファイルを1行ずつ文字列にして返す。startsには各行の先頭の位置を足していく"""
+    while True:
+        position = f.tell()
+        line = f.readline()
+        if not line:
+            return
+        if starts is not None:
+            starts.append(position)
+        yield line.decode("utf-8")
+
+def iter_review_log_offsets(file_path: str):
+    """審査記録CSVを (行の先頭のバイト位置, 記録) の組で返す。引用符の中に改行がある行にも対応する"""
+    try:
+        f = open(file_path, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        starts = []
+        for row in csv.reader(_decoded_lines(f, starts)):
+            # csv.readerは1行分を読み終えたところで返すので、それまでに読んだ最初の行が先頭
+            offset = starts[0]
+            starts.clear()
+            record = parse_review_row(row)
+            if record is not None:
+                yield offset, record
+
+def read_review_row_at(f, offset: int):
+    f.seek(offset)
+    try:
+        row = next(csv.reader(_decoded_lines(f)), None)
+    except (csv.Error, UnicodeDecodeError):
+        return None
+    return parse_review_row(row)
+
+def iter_review_log_file(file_path: str):
+    """審査記録CSVを1行ずつ辞書にして返す (ファイルがなければ何も返さない)"""
+    try:
+        f = open(file_path, "r", newline="", encoding="utf-8")
+    except FileNotFoundError:
+        return
+    with f:
+        for row in csv.reader(f):
+            record = parse_review_row(row)
+            if record is not None:
+                yield record
+
+# スキーマの変更はこのリストの末尾に追記する (PRAGMA user_version で適用済みの位置を管理)
+SQLITE_MIGRATIONS = [
+    """
+    CREATE TABLE budgets (
+        guild_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        amount INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, name)
+    );
+    CREATE TABLE channels (
+        guild_id INTEGER NOT NULL,
+        channel_id INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, channel_id)
+    );
+    CREATE TABLE accounting_roles (
+        guild_id INTEGER NOT NULL,
+        role_id INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, role_id)
+    );
+    CREATE TABLE review_results (
+        id INTEGER PRIMARY KEY,
+        guild_id INTEGER NOT NULL,
+        applicant TEXT NOT NULL,
+        item_name TEXT NOT NULL,
+        link TEXT NOT NULL DEFAULT '',
+        unit_price INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        result TEXT NOT NULL,
+        approver TEXT NOT NULL,
+        budget_name TEXT NOT NULL,
+        created_at TEXT
+    );
+    CREATE INDEX idx_review_guild_time ON review_results (guild_id, created_at);
+    CREATE INDEX idx_review_guild_budget ON review_results (guild_id, budget_name);
+    CREATE INDEX idx_review_guild_applicant ON review_results (guild_id, applicant);
+    CREATE TABLE meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    """,
+    """
+    CREATE TABLE guild_settings (
+        guild_id INTEGER NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (guild_id, key)
+    );
+    CREATE TABLE applied_requests (
+        guild_id INTEGER NOT NULL,
+        request_id TEXT NOT NULL,
+        applied_at TEXT NOT NULL,
+        PRIMARY KEY (guild_id, request_id)
+    );
+    """,
+    """
+    CREATE TABLE pending_requests (
+        guild_id INTEGER NOT NULL,
+        request_id TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        PRIMARY KEY (guild_id, request_id)
+    );
+    """,
+    """
+    CREATE TABLE review_aggregates (
+        guild_id INTEGER NOT NULL,
+        dimension TEXT NOT NULL,
+        key TEXT NOT NULL,
+        approved_total INTEGER NOT NULL,
+        approved_count INTEGER NOT NULL,
+        rejected_total INTEGER NOT NULL,
+        rejected_count INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, dimension, key)
+    );
+    """,
+    """
+    CREATE TABLE budget_ledger (
+        guild_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        budget_name TEXT NOT NULL,
+        delta INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        request_id TEXT,
+        actor TEXT,
+        PRIMARY KEY (guild_id, seq)
+    );
+    CREATE INDEX idx_ledger_guild_budget ON budget_ledger (guild_id, budget_name, seq);
+    CREATE TABLE budget_snapshots (
+        guild_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        balances TEXT NOT NULL,
+        PRIMARY KEY (guild_id, seq)
+    );
+    """,
+    """
+    ALTER TABLE pending_requests ADD COLUMN summary TEXT;
+    """,
+    """
+    ALTER TABLE budget_snapshots ADD COLUMN applied TEXT;
+    """,
+]
+
+class SqliteStorage:
+    """1つのSQLiteデータベース (WALモード) に全サーバーのデータを保存する"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._migrate()
+
+    def _migrate(self):
+        # クラスタの複数のプロセスが同時に起動しても一度だけ適用されるよう、書き込みロックを取ってから版を確かめる
+        def run(conn):
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for i, script in enumerate(SQLITE_MIGRATIONS[version:], start=version + 1):
+                # executescriptは実行前にトランザクションを確定してしまうので、1文ずつ実行する
+                for statement in script.split(";"):
+                    if statement.strip():
+                        conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {i}")
+        self._transaction(run)
+
+    def _transaction(self, func):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def guild_ids(self) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT guild_id FROM budgets UNION SELECT guild_id FROM channels "
+                "UNION SELECT guild_id FROM accounting_roles UNION SELECT guild_id FROM guild_settings"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def load_guild(self, guild_id: int) -> dict:
+        with self._lock:
+            budgets = self._conn.execute("SELECT name, amount FROM budgets WHERE guild_id = ?", (guild_id,)).fetchall()
+            channels = self._conn.execute("SELECT channel_id FROM channels WHERE guild_id = ?", (guild_id,)).fetchall()
+            roles = self._conn.execute("SELECT role_id FROM accounting_roles WHERE guild_id = ?", (guild_id,)).fetchall()
+            settings = self._conn.execute("SELECT key, value FROM guild_settings WHERE guild_id = ?", (guild_id,)).fetchall()
+            # 以前は反映済みの申請IDを applied_requests テーブルに別に記録していた
+            legacy_applied = self._conn.execute("SELECT request_id, applied_at FROM applied_requests WHERE guild_id = ?", (guild_id,)).fetchall()
+            pending = self._conn.execute("SELECT request_id, summary FROM pending_requests WHERE guild_id = ?", (guild_id,)).fetchall()
+            aggregate_rows = self._conn.execute(
+                "SELECT dimension, key, approved_total, approved_count, rejected_total, rejected_count "
+                "FROM review_aggregates WHERE guild_id = ?", (guild_id,)
+            ).fetchall()
+            ledger_seq = self._conn.execute("SELECT MAX(seq) FROM budget_ledger WHERE guild_id = ?", (guild_id,)).fetchone()[0] or 0
+            snapshot = self._conn.execute(
+                "SELECT seq, applied FROM budget_snapshots WHERE guild_id = ? ORDER BY seq DESC LIMIT 1", (guild_id,)
+            ).fetchone()
+            # 反映済みの申請IDは、最新のスナップショットの分とそれ以降の取引から読み直す
+            applied = dict(legacy_applied)
+            if snapshot is not None and snapshot[1]:
+                applied.update(json.loads(snapshot[1]))
+            applied.update(self._conn.execute(
+                "SELECT request_id, created_at FROM budget_ledger WHERE guild_id = ? AND seq > ? AND request_id IS NOT NULL",
+                (guild_id, snapshot[0] if snapshot is not None else 0)
+            ).fetchall())
+        summaries = []
+        for request_id, summary in pending:
+            if summary is not None:
+                summaries.append(PendingSummary.from_json(request_id, json.loads(summary)))
+                continue
+            # 概要の列ができる前に保存された申請は、中身から作って書き戻す
+            request = self.load_pending_request(guild_id, request_id)
+            if request is not None:
+                summaries.append(request.summary())
+                self.save_pending_request(guild_id, request_id, request.to_json(), summaries[-1])
+        pending_index = settle_applied_requests(self, guild_id, applied, summaries)
+        if legacy_applied:
+            # 突き合わせが済んだので、以前の形式の記録はもう要らない
+            self._transaction(lambda conn: conn.execute("DELETE FROM applied_requests WHERE guild_id = ?", (guild_id,)))
+        snapshot_seq = snapshot[0] if snapshot is not None else 0
+        # 台帳ができる前からある残高 (台帳のテーブルを作った直後で、取引がまだない) を番号0のスナップショットとして残す。
+        # 取引があるのにスナップショットがなければ、残高0から取引をたどれば求まるので書かない
+        if snapshot is None and ledger_seq == 0 and budgets:
+            self.append_ledger(guild_id, [], ledger_snapshot(0, dict(budgets)))
+        settings = {key: json.loads(value) for key, value in settings}
+        aggregates = None
+        if settings.get("aggregates_built"):
+            aggregates = {dimension: {} for dimension in AGGREGATE_DIMENSIONS}
+            for dimension, key, *totals in aggregate_rows:
+                aggregates[dimension][key] = totals
+        return {
+            "budgets": dict(budgets),
+            "ledger": deque(),
+            "ledger_seq": ledger_seq,
+            "ledger_saved_seq": ledger_seq,
+            "ledger_snapshot_seq": snapshot_seq,
+            "channels": {row[0] for row in channels},
+            "additional_roles": {row[0] for row in roles},
+            "no_overdraft": settings.get("no_overdraft", False),
+            # 反映済みで、審査待ちからの削除をまだ書き出していない申請ID
+            "applied_requests": {},
+            "pending_requests": dict.fromkeys(pending_index),
+            "pending_index": pending_index,
+            "aggregates": aggregates
+        }
+
+    # 台帳 (budget_ledger) の取引はすべて残し、budgetsテーブルは同じトランザクションで更新する現在の残高として使う。
+    # スナップショットは過去の残高を求めるときの起点になる。
+
+    def append_ledger(self, guild_id: int, entries: list, snapshot: dict = None):
+        """取引を追記して残高に反映し、snapshotがあればその残高に揃える。書き込み済みの取引は読み飛ばす"""
+        def run(conn):
+            for entry in entries:
+                inserted = conn.execute(
+                    "INSERT OR IGNORE INTO budget_ledger (guild_id, seq, created_at, budget_name, delta, kind, request_id, actor) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (guild_id, entry["seq"], entry["at"], entry["budget"], entry["delta"], entry["kind"], entry["request_id"], entry["actor"])
+                ).rowcount
+                if inserted and entry["kind"] != "review":
+                    conn.execute(
+                        "INSERT INTO budgets (guild_id, name, amount) VALUES (?, ?, ?) "
+                        "ON CONFLICT (guild_id, name) DO UPDATE SET amount = amount + excluded.amount",
+                        (guild_id, entry["budget"], entry["delta"])
+                    )
+            if snapshot is not None:
+                balances = snapshot["balances"]
+                conn.execute(
+                    "INSERT INTO budget_snapshots (guild_id, seq, created_at, balances, applied) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (guild_id, seq) DO UPDATE SET created_at = excluded.created_at, balances = excluded.balances, "
+                    "applied = excluded.applied",
+                    (guild_id, snapshot["seq"], snapshot["created_at"], json.dumps(balances, ensure_ascii=False),
+                     json.dumps(snapshot.get("applied") or {}))
+                )
+                conn.executemany(
+                    "INSERT INTO budgets (guild_id, name, amount) VALUES (?, ?, ?) "
+                    "ON CONFLICT (guild_id, name) DO UPDATE SET amount = excluded.amount WHERE amount != excluded.amount",
+                    [(guild_id, name, amount) for name, amount in balances.items()]
+                )
+                stored = {row[0] for row in conn.execute("SELECT name FROM budgets WHERE guild_id = ?", (guild_id,))}
+                conn.executemany(
+                    "DELETE FROM budgets WHERE guild_id = ? AND name = ?",
+                    [(guild_id, name) for name in stored - balances.keys()]
+                )
+        self._transaction(run)
+
+    def ledger_base(self, guild_id: int, upto: str = None, full: bool = False):
+        """残高の計算を始めるスナップショット。upto以前に作られたもののうち最新 (fullなら最古) を返す"""
+        with self._lock:
+            if full:
+                row = self._conn.execute(
+                    "SELECT seq, created_at, balances FROM budget_snapshots WHERE guild_id = ? ORDER BY seq LIMIT 1", (guild_id,)
+                ).fetchone()
+            else:
+                row = self._conn.execute(
+                    "SELECT seq, created_at, balances FROM budget_snapshots WHERE guild_id = ? "
+                    "AND (? IS NULL OR substr(created_at, 1, 19) <= ?) ORDER BY seq DESC LIMIT 1", (guild_id, upto, upto)
+                ).fetchone()
+            has_opening = self._conn.execute(
+                "SELECT 1 FROM budget_snapshots WHERE guild_id = ? AND seq = 0", (guild_id,)
+            ).fetchone() is not None
+        if row is not None:
+            return {"seq": row[0], "created_at": row[1], "balances": json.loads(row[2])}
+        # 番号0のスナップショットがなければ残高0から始まったものとして扱う
+        return None if has_opening else {"seq": 0, "created_at": "", "balances": {}}
+
+    def iter_ledger(self, guild_id: int, after_seq: int = 0):
+        last_seq = after_seq
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT seq, created_at, budget_name, delta, kind, request_id, actor FROM budget_ledger "
+                    "WHERE guild_id = ? AND seq > ? ORDER BY seq LIMIT 1000", (guild_id, last_seq)
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield {"seq": row[0], "at": row[1], "budget": row[2], "delta": row[3], "kind": row[4], "request_id": row[5], "actor": row[6]}
+            last_seq = rows[-1][0]
+
+    def recent_ledger_entries(self, guild_id: int, budget_name: str = None, limit: int = 20) -> list:
+        query = "SELECT seq, created_at, budget_name, delta, kind, request_id, actor FROM budget_ledger WHERE guild_id = ?"
+        params = [guild_id]
+        if budget_name is not None:
+            query += " AND budget_name = ?"
+            params.append(budget_name)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY seq DESC LIMIT ?", (*params, limit)).fetchall()
+        return [
+            {"seq": row[0], "at": row[1], "budget": row[2], "delta": row[3], "kind": row[4], "request_id": row[5], "actor": row[6]}
+            for row in reversed(rows)
+        ]
+
+    def _replace_ids(self, table: str, column: str, guild_id: int, ids: list):
+        def run(conn):
+            stored = {row[0] for row in conn.execute(f"SELECT {column} FROM {table} WHERE guild_id = ?", (guild_id,))}
+            wanted = set(ids)
+            conn.executemany(f"INSERT INTO {table} (guild_id, {column}) VALUES (?, ?)", [(guild_id, i) for i in wanted - stored])
+            conn.executemany(f"DELETE FROM {table} WHERE guild_id = ? AND {column} = ?", [(guild_id, i) for i in stored - wanted])
+        self._transaction(run)
+
+    def save_channels(self, guild_id: int, channels: list):
+        self._replace_ids("channels", "channel_id", guild_id, channels)
+
+    def save_settings(self, guild_id: int, settings: dict):
+        self._replace_ids("accounting_roles", "role_id", guild_id, settings["additional_roles"])
+        self._transaction(lambda conn: conn.execute(
+            "INSERT INTO guild_settings (guild_id, key, value) VALUES (?, 'no_overdraft', ?) "
+            "ON CONFLICT (guild_id, key) DO UPDATE SET value = excluded.value",
+            (guild_id, json.dumps(settings["no_overdraft"]))
+        ))
+
+    def save_aggregates(self, guild_id: int, aggregates: dict):
+        rows = [
+            (guild_id, dimension, key, *totals)
+            for dimension, entries in aggregates.items()
+            for key, totals in entries.items()
+        ]
+
+        def run(conn):
+            conn.executemany(
+                "INSERT INTO review_aggregates (guild_id, dimension, key, approved_total, approved_count, rejected_total, rejected_count) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (guild_id, dimension, key) DO UPDATE SET "
+                "approved_total = excluded.approved_total, approved_count = excluded.approved_count, "
+                "rejected_total = excluded.rejected_total, rejected_count = excluded.rejected_count "
+                "WHERE approved_count != excluded.approved_count OR rejected_count != excluded.rejected_count "
+                "OR approved_total != excluded.approved_total OR rejected_total != excluded.rejected_total",
+                rows
+            )
+            stored = set(conn.execute("SELECT dimension, key FROM review_aggregates WHERE guild_id = ?", (guild_id,)).fetchall())
+            conn.executemany(
+                "DELETE FROM review_aggregates WHERE guild_id = ? AND dimension = ? AND key = ?",
+                [(guild_id, dimension, key) for dimension, key in stored - {(row[1], row[2]) for row in rows}]
+            )
+            conn.execute(
+                "INSERT INTO guild_settings (guild_id, key, value) VALUES (?, 'aggregates_built', 'true') "
+                "ON CONFLICT (guild_id, key) DO NOTHING", (guild_id,)
+            )
+        self._transaction(run)
+
+    def save_pending_request(self, guild_id: int, request_id: str, payload: str, summary: PendingSummary = None):
+        """payloadがNoneなら審査済みとして削除する"""
+        if payload is None:
+            self._transaction(lambda conn: conn.execute(
+                "DELETE FROM pending_requests WHERE guild_id = ? AND request_id = ?", (guild_id, request_id)
+            ))
+            return
+        self._transaction(lambda conn: conn.execute(
+            "INSERT INTO pending_requests (guild_id, request_id, payload, summary) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (guild_id, request_id) DO UPDATE SET payload = excluded.payload, summary = excluded.summary",
+            (guild_id, request_id, payload, json.dumps(summary.to_json(), ensure_ascii=False) if summary is not None else None)
+        ))
+
+    def load_pending_request(self, guild_id: int, request_id: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload FROM pending_requests WHERE guild_id = ? AND request_id = ?", (guild_id, request_id)
+            ).fetchone()
+        return PendingRequest.from_json(row[0]) if row else None
+
+    def sync_review_logs(self):
+        # WALモードのコミットで十分なので何もしない
+        pass
+
+    def append_review_rows(self, guild_id: int, records: list) -> list:
+        """審査記録を追記し、各行の位置 (行のid) を返す"""
+        def run(conn):
+            return [
+                conn.execute(
+                    "INSERT INTO review_results (guild_id, applicant, item_name, link, unit_price, quantity, amount, result, approver, budget_name, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (guild_id, r["applicant"], r["name"], r["link"], r["unit_price"], r["quantity"], r["amount"],
+                     r["result"], r["approver"], r["budget_name"], r["created_at"])
+                ).lastrowid
+                for r in records
+            ]
+        return self._transaction(run)
+
+    def replace_review_rows(self, guild_id: int, records) -> int:
+        """サーバーの審査記録をすべて消してから records を書き込み、書き込んだ行数を返す。
+        1つのトランザクションで行うので、途中で止まっても元の記録が残る"""
+        def run(conn):
+            conn.execute("DELETE FROM review_results WHERE guild_id = ?", (guild_id,))
+            return conn.executemany(
+                "INSERT INTO review_results (guild_id, applicant, item_name, link, unit_price, quantity, amount, result, approver, budget_name, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ((guild_id, r["applicant"], r["name"], r["link"], r["unit_price"], r["quantity"], r["amount"],
+                  r["result"], r["approver"], r["budget_name"], r["created_at"]) for r in records)
+            ).rowcount
+        return self._transaction(run)
+
+    @staticmethod
+    def _review_record(row) -> dict:
+        return {
+            "applicant": row[1], "name": row[2], "link": row[3], "unit_price": row[4], "quantity": row[5],
+            "amount": row[6], "result": row[7], "approver": row[8], "budget_name": row[9], "created_at": row[10]
+        }
+
+    def iter_review_rows(self, guild_id: int, filters: dict = None):
+        return (record for _, record in self._select_review_rows(guild_id, filters))
+
+    def iter_review_locators(self, guild_id: int):
+        """すべての審査記録を (位置, 記録) の組で追記順に返す。位置は行のid"""
+        return self._select_review_rows(guild_id, None)
+
+    def _select_review_rows(self, guild_id: int, filters: dict):
+        filters = filters or {}
+        conditions = ["guild_id = ?", "id > ?"]
+        params = [guild_id]
+        for column in ("budget_name", "applicant", "result"):
+            if filters.get(column) is not None:
+                conditions.append(f"{column} = ?")
+                params.append(filters[column])
+        if filters.get("since"):
+            conditions.append("created_at >= ?")
+            params.append(filters["since"])
+        if filters.get("until"):
+            conditions.append("created_at < ?")
+            params.append(filters["until"])
+        query = (
+            "SELECT id, applicant, item_name, link, unit_price, quantity, amount, result, approver, budget_name, created_at "
+            f"FROM review_results WHERE {' AND '.join(conditions)} ORDER BY id LIMIT 1000"
+        )
+        last_id = 0
+        while True:
+            # 大きなログでもメモリに載せきらないよう、主キー順に少しずつ読む
+            with self._lock:
+                rows = self._conn.execute(query, (*params[:1], last_id, *params[1:])).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row[0], self._review_record(row)
+            last_id = rows[-1][0]
+
+    def read_review_rows(self, guild_id: int, locators: list) -> list:
+        """位置 (行のid) を指定して審査記録を読む。見つからない行はNone"""
+        records = {}
+        for i in range(0, len(locators), 500):
+            chunk = locators[i:i + 500]
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, applicant, item_name, link, unit_price, quantity, amount, result, approver, budget_name, created_at "
+                    f"FROM review_results WHERE guild_id = ? AND id IN ({', '.join('?' * len(chunk))})", (guild_id, *chunk)
+                ).fetchall()
+            records.update((row[0], self._review_record(row)) for row in rows)
+        return [records.get(locator) for locator in locators]
+
+    def get_meta(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        self._transaction(lambda conn: conn.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value", (key, value)
+        ))
+
+# --- Migration from JSON ---
+
+def migrate_json_to_sqlite(data_dir: str, db_path: str, legacy_log: str = None, legacy_guild_id: int = None, force: bool = False):
+    """data/ 以下のJSON・CSVをSQLiteデータベースへ一括で移行する。
+    --force で移し直すときは、審査記録はサーバーごとに入れ替えるので二重にならない"""
+    if legacy_log and legacy_guild_id is None:
+        raise ValueError("legacy_log を移行するには legacy_guild_id が必要です")
+    source = JsonStorage(data_dir)
+    target = SqliteStorage(db_path)
+    try:
+        if target.get_meta("migrated_from_json") and not force:
+            print(f"⚠️ {db_path} は移行済みです。再実行する場合は --force を指定してください。")
+            return
+        guild_ids = source.guild_ids()
+        if legacy_log and legacy_guild_id not in guild_ids:
+            guild_ids.append(legacy_guild_id)
+        for guild_id in guild_ids:
+            # 移行元のファイルは書き換えない (移行をやり直しても同じ内容を読める)
+            data = source.read_guild(guild_id)
+            _copy_ledger(source, target, guild_id)
+            target.save_channels(guild_id, list(data["channels"]))
+            target.save_settings(guild_id, {"additional_roles": list(data["additional_roles"]), "no_overdraft": data["no_overdraft"]})
+            for request_id in data["pending_requests"]:
+                request = source.load_pending_request(guild_id, request_id)
+                if request is not None:
+                    target.save_pending_request(guild_id, request_id, request.to_json(), request.summary())
+            if data["aggregates"] is not None:
+                target.save_aggregates(guild_id, data["aggregates"])
+            records = source.iter_review_rows(guild_id)
+            if legacy_log and guild_id == legacy_guild_id:
+                # 以前の1ファイルの審査記録は、そのサーバーの記録の後ろに続ける
+                records = itertools.chain(records, iter_review_log_file(legacy_log))
+                print(f"-> {legacy_log} をサーバー {guild_id} の審査記録に含めます")
+            count = target.replace_review_rows(guild_id, records)
+            print(f"-> サーバー {guild_id}: 予算 {len(data['budgets'])} 件, 審査記録 {count} 行")
+        target.set_meta("migrated_from_json", now_timestamp())
+    finally:
+        target.close()
+
+def _copy_ledger(source: JsonStorage, target: SqliteStorage, guild_id: int):
+    """スナップショットと取引を番号順に写す (スナップショットの時点で残高が揃う)"""
+    entries = source.iter_ledger(guild_id)
+    entry = next(entries, None)
+    for snapshot in source.ledger_snapshots(guild_id):
+        batch = []
+        while entry is not None and entry["seq"] <= snapshot["seq"]:
+            batch.append(entry)
+            entry = next(entries, None)
+        target.append_ledger(guild_id, batch, snapshot)
+    batch = [] if entry is None else [entry, *entries]
+    if batch:
+        target.append_ledger(guild_id, batch)
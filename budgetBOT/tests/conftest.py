@@ -0,0 +1,66 @@
+"""テスト共通の準備
+
+budgetBOT は読み込み時に config.json を読み、ストレージや書き込みキューを作るので、
+一時ディレクトリに config.json を置いてから読み込む。テストごとに空のデータディレクトリへ移り、
+ストレージ・キャッシュ・書き込みキューなどを作り直して、ほかのテストの状態を持ち込まない。
+"""
+import json
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+
+import pytest
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REVIEWER_ROLE_ID = 1
+
+def _import_bot():
+    workdir = tempfile.mkdtemp(prefix="budgetbot-test-")
+    with open(os.path.join(workdir, "config.json"), "w", encoding="utf-8") as f:
+        json.dump({"TOKEN": "test", "ALLOWED_ROLE_ID": REVIEWER_ROLE_ID, "PERSIST_DELAY": 0.01}, f)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        sys.path.insert(0, BOT_DIR)
+        import budgetBOT
+    finally:
+        os.chdir(cwd)
+    return budgetBOT
+
+budgetBOT = _import_bot()
+
+def reset_bot_state(bb, monkeypatch, backend: str):
+    """再起動したときと同じく、メモリ上の状態を捨ててストレージから読み直す状態にする。
+    書き込みキューも作り直すので、まだ書き出していない変更は失われる"""
+    monkeypatch.setattr(bb, "storage", bb.create_storage(backend))
+    monkeypatch.setattr(bb, "guild_data", bb.GuildCache(bb.storage, bb.GUILD_CACHE_MAX_GUILDS, bb.GUILD_CACHE_MAX_BYTES, bb.guilds_with_pending_writes))
+    monkeypatch.setattr(bb, "persistence", bb.WriteBehindQueue(bb.PERSIST_DELAY, bb.update_guild_size))
+    monkeypatch.setattr(bb, "review_log", bb.ReviewLogWriter(
+        bb.storage, bb.REVIEW_LOG_BATCH_DELAY, bb.REVIEW_LOG_BATCH_MAX_ROWS, bb.REVIEW_LOG_FSYNC, bb.REVIEW_LOG_FSYNC_INTERVAL,
+        bb.index_review_rows
+    ))
+    monkeypatch.setattr(bb, "review_search", bb.ReviewSearchCache(bb.REVIEW_SEARCH_MAX_GUILDS))
+    monkeypatch.setattr(bb, "permission_cache", bb.PermissionCache(bb.PERMISSION_CACHE_MAX_ENTRIES))
+    monkeypatch.setattr(bb, "dormant_requests", bb.DormantRequestSweeper(bb.PENDING_REQUEST_IDLE_SECONDS))
+    monkeypatch.setattr(bb, "outbound", bb.OutboundDispatcher(bb.OUTBOUND_CHANNEL_RATE, bb.OUTBOUND_CHANNEL_PER))
+    monkeypatch.setattr(bb, "request_renderers", OrderedDict())
+
+@pytest.fixture(params=["json", "sqlite"])
+def bb(request, tmp_path, monkeypatch):
+    """空のデータディレクトリで動く budgetBOT (JSON・SQLiteの両方で実行する)"""
+    monkeypatch.chdir(tmp_path)
+    reset_bot_state(budgetBOT, monkeypatch, request.param)
+    yield budgetBOT
+    budgetBOT.storage.close()
+
+@pytest.fixture
+def restart(bb, monkeypatch):
+    """Botを落として起動し直す。書き込みキューに残っていた変更は書き出されない"""
+    backend = "sqlite" if isinstance(bb.storage, bb.SqliteStorage) else "json"
+
+    def restart():
+        bb.storage.close()
+        reset_bot_state(bb, monkeypatch, backend)
+
+    return restart
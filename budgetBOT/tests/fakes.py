@@ -0,0 +1,167 @@
+"""Discordに接続せずにBotのコマンド・ボタンを動かすための偽のオブジェクト
+
+discord.py の Interaction / Context / Member などのうち、Botが使う属性とメソッドだけを持つ。
+"""
+import asyncio
+import types
+
+class FakeRole:
+    def __init__(self, role_id: int):
+        self.id = role_id
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self.filesize_limit = 25 * 1024 * 1024
+
+class FakeMember:
+    def __init__(self, member_id: int, guild: FakeGuild, role_ids=()):
+        self.id = member_id
+        self.guild = guild
+        self.roles = [FakeRole(role_id) for role_id in role_ids]
+        self.display_name = f"member-{member_id}"
+        self.display_avatar = types.SimpleNamespace(url=f"https://cdn.example.com/avatars/{member_id}.png")
+        self.mention = f"<@{member_id}>"
+
+class FakeDiscord:
+    """Discord APIの代わり。応答ごとに latency 秒待ち、呼び出し回数を数える"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+        self._next_id = 1
+
+    async def call(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def next_id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+class FakeChannel:
+    def __init__(self, api: FakeDiscord, channel_id: int):
+        self.api = api
+        self.id = channel_id
+
+    async def send(self, content=None, **kwargs):
+        await self.api.call()
+        return FakeMessage(self.api, self)
+
+class FakeMessage:
+    def __init__(self, api: FakeDiscord, channel: FakeChannel):
+        self.api = api
+        self.id = api.next_id()
+        self.channel = channel
+        self.edits = 0
+
+    async def edit(self, **kwargs):
+        self.edits += 1
+        await self.api.call()
+
+    async def delete(self):
+        await self.api.call()
+
+class RecordingChannel(FakeChannel):
+    """送信したメッセージを messages に記録するチャンネル"""
+
+    def __init__(self, api: FakeDiscord, channel_id: int, messages: list):
+        super().__init__(api, channel_id)
+        self.messages = messages
+
+    async def send(self, content=None, **kwargs):
+        message = await super().send(content, **kwargs)
+        self.messages.append(message)
+        return message
+
+class FakeResponse:
+    def __init__(self, api: FakeDiscord, sent: list):
+        self.api = api
+        self.sent = sent
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def _respond(self):
+        # 本物と同じく、1つのインタラクションには1回しか応答できない
+        if self._done:
+            raise RuntimeError("interaction already responded")
+        await self.api.call()
+        self._done = True
+
+    async def send_message(self, content=None, **kwargs):
+        await self._respond()
+        self.sent.append(content)
+
+    async def edit_message(self, *args, **kwargs):
+        await self._respond()
+
+    async def defer(self, *args, **kwargs):
+        await self._respond()
+
+    async def send_modal(self, *args, **kwargs):
+        await self._respond()
+
+class FakeFollowup:
+    def __init__(self, api: FakeDiscord, response: FakeResponse, sent: list):
+        self.api = api
+        self.response = response
+        self.sent = sent
+
+    async def send(self, content=None, **kwargs):
+        # 本物と同じく、先に応答 (defer など) していなければ送れない
+        if not self.response.is_done():
+            raise RuntimeError("followup before the interaction response")
+        await self.api.call()
+        self.sent.append(content)
+
+class FakeInteraction:
+    def __init__(self, api: FakeDiscord, user: FakeMember, message: FakeMessage):
+        self.user = user
+        self.guild = user.guild
+        self.guild_id = user.guild.id
+        self.message = message
+        self.channel = message.channel
+        # 本人にだけ見える返信を含め、送ったメッセージの本文を順に記録する
+        self.sent = []
+        self.response = FakeResponse(api, self.sent)
+        self.followup = FakeFollowup(api, self.response, self.sent)
+        self.api = api
+
+    async def edit_original_response(self, **kwargs):
+        await self.api.call()
+
+class FakeContext:
+    def __init__(self, api: FakeDiscord, author: FakeMember, channel: FakeChannel):
+        self.author = author
+        self.guild = author.guild
+        self.channel = channel
+        self.message = types.SimpleNamespace(attachments=[])
+        self.interaction = None
+        self.api = api
+        self.files = []
+
+    async def defer(self, ephemeral: bool = False):
+        # プレフィックスのコマンドと同じく何もしない
+        pass
+
+    async def send(self, content=None, **kwargs):
+        if kwargs.get("file") is not None:
+            self.files.append(kwargs["file"])
+        return await self.channel.send(content, **kwargs)
+
+class SentChannel(FakeChannel):
+    """送ったメッセージの本文と引数を記録するチャンネル"""
+
+    def __init__(self, api: FakeDiscord, channel_id: int):
+        super().__init__(api, channel_id)
+        self.contents = []
+        self.kwargs = []
+
+    async def send(self, content=None, **kwargs):
+        self.contents.append(content)
+        self.kwargs.append(kwargs)
+        return await super().send(content, **kwargs)
@@ -0,0 +1,265 @@
+"""審査ボタンの同時押し・二重押しと、途中で止まった後の再起動で予算が二重に引き落とされないことを確かめる"""
+import asyncio
+import os
+import random
+
+import pytest
+
+from storage import APPLIED_REQUESTS_FILE
+from tests.fakes import FakeChannel, FakeDiscord, FakeGuild, FakeInteraction, FakeMember, FakeMessage
+
+GUILD_ID = 1000
+BUDGET = "備品"
+INITIAL_BALANCE = 10 ** 9
+
+async def add_budget(bb, amount: int = INITIAL_BALANCE):
+    data = await bb.load_guild_data(GUILD_ID)
+    bb.post_ledger_entry(GUILD_ID, data, BUDGET, amount, "credit")
+    return data
+
+async def open_requests(bb, api, count: int, items_per_request: int = 3) -> list:
+    applicant = FakeMember(3, FakeGuild(GUILD_ID))
+    channel = FakeChannel(api, GUILD_ID * 10)
+    requests = []
+    for i in range(count):
+        items = [bb.RequestItem(f"部品{i}-{j}", "", 100 + j, 2) for j in range(items_per_request)]
+        request = await bb.open_pending_request(applicant.id, applicant.display_name, applicant.display_avatar.url, GUILD_ID, items, BUDGET)
+        await bb.attach_request_message(request, FakeMessage(api, channel))
+        requests.append(request)
+    return requests
+
+async def click(bb, api, action: str, request_id: str):
+    reviewer = FakeMember(2, FakeGuild(GUILD_ID), [bb.ALLOWED_ROLE_ID])
+    button = bb.ApprovalButton(action, GUILD_ID, request_id)
+    interaction = FakeInteraction(api, reviewer, FakeMessage(api, FakeChannel(api, GUILD_ID * 10)))
+    if await button.interaction_check(interaction):
+        await button.callback(interaction)
+
+def stored_decisions(bb) -> dict:
+    """ストレージの台帳にある申請IDごとの取引の件数"""
+    counts = {}
+    for entry in bb.storage.iter_ledger(GUILD_ID):
+        if entry["request_id"] is not None:
+            counts[entry["request_id"]] = counts.get(entry["request_id"], 0) + 1
+    return counts
+
+def flush_ledger_only(bb):
+    """台帳だけを書き出したところで止まった状態を作る (ほかの予約済みの書き込みは捨てる)"""
+    snapshot, writer, _ = bb.persistence._dirty.pop((GUILD_ID, "ledger"))
+    writer(snapshot())
+
+def test_concurrent_double_clicks_debit_each_request_once(bb):
+    async def scenario():
+        api = FakeDiscord(0.001)
+        data = await add_budget(bb)
+        requests = await open_requests(bb, api, 300)
+        await bb.persistence.flush()
+        # 1件につき承認を2回ずつ押し、一部は承認と却下を同時に押す
+        clicks = [("approve", request.request_id) for request in requests for _ in range(2)]
+        clicks += [("reject", request.request_id) for request in requests[::10]]
+        random.Random(0).shuffle(clicks)
+        await asyncio.gather(*(click(bb, api, action, request_id) for action, request_id in clicks))
+        await bb.persistence.drain()
+        await bb.review_log.flush(force_sync=True)
+
+        rows = list(bb.storage.iter_review_rows(GUILD_ID))
+        # 1件の申請につき、反映されたのは承認か却下のどちらか1回だけ
+        assert len(rows) == 3 * len(requests)
+        approved = sum(row["amount"] for row in rows if row["result"] == "承認")
+        assert INITIAL_BALANCE - data["budgets"][BUDGET] == approved
+        assert stored_decisions(bb) == {request.request_id: 1 for request in requests}
+        assert not data["pending_requests"]
+        assert not data["pending_index"]
+
+    asyncio.run(scenario())
+
+def test_applied_request_is_not_debited_again_after_restart(bb, restart):
+    async def scenario():
+        api = FakeDiscord(0)
+        await add_budget(bb)
+        [request] = await open_requests(bb, api, 1)
+        await click(bb, api, "approve", request.request_id)
+        await bb.persistence.drain()
+        return request.request_id, sum(item.amount for item in request.items)
+
+    request_id, amount = asyncio.run(scenario())
+    restart()
+
+    async def after_restart():
+        api = FakeDiscord(0)
+        data = await bb.load_guild_data(GUILD_ID)
+        assert request_id not in data["pending_requests"]
+        # 再起動前に表示していた申請のボタンをもう一度押しても反映済みとして扱われる
+        await click(bb, api, "approve", request_id)
+        # ボタンを通さずに反映し直そうとしても反映済みとして扱われる
+        stale = bb.PendingRequest(request_id, GUILD_ID, 3, "member-3", "", BUDGET, [bb.RequestItem("部品", "", amount)], bb.now_timestamp())
+        status, _ = await bb.apply_review_decision(GUILD_ID, stale, "member-2", stale.items, [])
+        assert status == "duplicate"
+        assert data["budgets"][BUDGET] == INITIAL_BALANCE - amount
+
+    asyncio.run(after_restart())
+
+def test_restart_after_ledger_only_flush_does_not_debit_twice(bb, restart):
+    async def scenario():
+        api = FakeDiscord(0)
+        await add_budget(bb)
+        [request] = await open_requests(bb, api, 1)
+        await bb.persistence.flush()
+        await click(bb, api, "approve", request.request_id)
+        # 台帳が書き出されるまで申請の削除は予約しない
+        assert not bb.persistence.is_pending((GUILD_ID, "pending", request.request_id))
+        flush_ledger_only(bb)
+        return sum(item.amount for item in request.items), request.request_id
+
+    amount, request_id = asyncio.run(scenario())
+    restart()
+
+    async def after_restart():
+        api = FakeDiscord(0)
+        data = await bb.load_guild_data(GUILD_ID)
+        # 台帳に反映済みの申請は審査待ちから外れている
+        assert request_id not in data["pending_requests"]
+        assert bb.storage.load_pending_request(GUILD_ID, request_id) is None
+        await click(bb, api, "approve", request_id)
+        await bb.persistence.drain()
+        assert data["budgets"][BUDGET] == INITIAL_BALANCE - amount
+        assert stored_decisions(bb) == {request_id: 1}
+
+    asyncio.run(after_restart())
+
+@pytest.mark.parametrize("snapshot_interval", [1, 1000])
+def test_restart_after_rejection_keeps_decision(bb, restart, monkeypatch, snapshot_interval):
+    # 間隔1では台帳のスナップショットも同じ書き込みで作られ、反映済みの申請IDはスナップショットから読み直される
+    monkeypatch.setattr(bb, "LEDGER_SNAPSHOT_INTERVAL", snapshot_interval)
+
+    async def scenario():
+        api = FakeDiscord(0)
+        await add_budget(bb)
+        [request] = await open_requests(bb, api, 1)
+        await bb.persistence.flush()
+        await click(bb, api, "reject", request.request_id)
+        flush_ledger_only(bb)
+        return request.request_id
+
+    request_id = asyncio.run(scenario())
+    restart()
+
+    async def after_restart():
+        api = FakeDiscord(0)
+        data = await bb.load_guild_data(GUILD_ID)
+        assert request_id not in data["pending_requests"]
+        await click(bb, api, "approve", request_id)
+        await bb.persistence.drain()
+        assert data["budgets"] == {BUDGET: INITIAL_BALANCE}
+        assert stored_decisions(bb) == {request_id: 1}
+
+    asyncio.run(after_restart())
+
+def test_applied_request_ids_are_dropped_once_settled(bb):
+    async def scenario():
+        api = FakeDiscord(0)
+        await add_budget(bb)
+        requests = await open_requests(bb, api, 50)
+        await bb.persistence.flush()
+        await asyncio.gather(*(click(bb, api, "approve", request.request_id) for request in requests))
+        data = await bb.load_guild_data(GUILD_ID)
+        assert len(data["applied_requests"]) == len(requests)
+        await bb.persistence.drain()
+        # 審査待ちからの削除まで書き出したら、反映済みの申請IDはメモリに残らない
+        assert data["applied_requests"] == {}
+        assert not data.get("ledger_waiters")
+
+    asyncio.run(scenario())
+
+def test_legacy_applied_records_are_settled_and_removed(bb, restart):
+    async def scenario():
+        api = FakeDiscord(0)
+        [request] = await open_requests(bb, api, 1)
+        await bb.persistence.drain()
+        return request.request_id
+
+    request_id = asyncio.run(scenario())
+    # 以前の形式で反映済みとして記録されたまま、審査待ちにも残っている申請
+    if isinstance(bb.storage, bb.SqliteStorage):
+        bb.storage._transaction(lambda conn: conn.execute(
+            "INSERT INTO applied_requests (guild_id, request_id, applied_at) VALUES (?, ?, ?)", (GUILD_ID, request_id, bb.now_timestamp())
+        ))
+    else:
+        with open(f"data/{GUILD_ID}/{APPLIED_REQUESTS_FILE}", "w", encoding="utf-8") as f:
+            f.write(f'{{"request_id": "{request_id}", "applied_at": "{bb.now_timestamp()}"}}\n')
+    restart()
+
+    async def after_restart():
+        data = await bb.load_guild_data(GUILD_ID)
+        assert request_id not in data["pending_requests"]
+        assert data["applied_requests"] == {}
+
+    asyncio.run(after_restart())
+    if isinstance(bb.storage, bb.SqliteStorage):
+        with bb.storage._lock:
+            assert bb.storage._conn.execute("SELECT COUNT(*) FROM applied_requests").fetchone()[0] == 0
+    else:
+        assert not os.path.exists(f"data/{GUILD_ID}/{APPLIED_REQUESTS_FILE}")
+
+def test_pending_request_buttons_work_after_restart(bb, restart):
+    async def scenario():
+        api = FakeDiscord(0)
+        await add_budget(bb)
+        [request] = await open_requests(bb, api, 1)
+        await bb.persistence.drain()
+        return request
+
+    request = asyncio.run(scenario())
+    restart()
+
+    async def after_restart():
+        api = FakeDiscord(0)
+        # ボタンはcustom_idから作り直され、申請はストレージから読み直される
+        assert (await bb.get_pending_request(GUILD_ID, request.request_id)).to_json() == request.to_json()
+        await click(bb, api, "approve", request.request_id)
+        await bb.persistence.drain()
+        data = await bb.load_guild_data(GUILD_ID)
+        assert data["budgets"][BUDGET] == INITIAL_BALANCE - sum(item.amount for item in request.items)
+        assert not data["pending_requests"]
+
+    asyncio.run(after_restart())
+
+def test_no_overdraft_refuses_approvals_beyond_the_balance(bb):
+    async def scenario():
+        data = await add_budget(bb, 500)
+        data["no_overdraft"] = True
+
+        async def review(amount: int, approve: bool = True, budget_name: str = BUDGET):
+            items = [bb.RequestItem("部品", "", amount)]
+            request = await bb.open_pending_request(3, "member-3", "", GUILD_ID, items, budget_name)
+            approved, rejected = (items, []) if approve else ([], items)
+            return await bb.apply_review_decision(GUILD_ID, request, "member-2", approved, rejected)
+
+        assert await review(600) == ("insufficient", 500)
+        # 却下は残高が足りなくても反映できる
+        assert (await review(600, approve=False))[0] == "applied"
+        assert await review(500) == ("applied", 0)
+        assert (await review(100, budget_name="未登録"))[0] == "unknown_budget"
+
+    asyncio.run(scenario())
+
+def test_click_is_deferred_before_waiting_for_the_guild_lock(bb):
+    async def scenario():
+        api = FakeDiscord(0)
+        await add_budget(bb)
+        [request] = await open_requests(bb, api, 1)
+        reviewer = FakeMember(2, FakeGuild(GUILD_ID), [bb.ALLOWED_ROLE_ID])
+        interactions = [FakeInteraction(api, reviewer, FakeMessage(api, FakeChannel(api, GUILD_ID * 10))) for _ in range(2)]
+        async with bb.get_guild_lock(GUILD_ID):
+            tasks = [
+                asyncio.create_task(bb.ApprovalButton("approve", GUILD_ID, request.request_id).callback(interaction))
+                for interaction in interactions
+            ]
+            await asyncio.sleep(0.05)
+            # ほかの処理がロックを持っている間も、応答の期限に間に合うよう先に応答している
+            assert all(interaction.response.is_done() for interaction in interactions)
+        await asyncio.gather(*tasks)
+        # 後から押した方には、本人にだけ見える返信で審査済みと伝える
+        assert sum(interaction.sent == ["ℹ️ この申請は既に審査済みです。"] for interaction in interactions) == 1
+
+    asyncio.run(scenario())
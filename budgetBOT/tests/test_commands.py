@@ -0,0 +1,45 @@
+"""一覧を出すコマンドが、件数の多いサーバーでもDiscordの上限に収まる形で送ることを確かめる"""
+import asyncio
+
+from embeds import EMBED_DESCRIPTION_LIMIT
+from tests.fakes import FakeContext, FakeDiscord, FakeGuild, FakeMember, SentChannel
+
+GUILD_ID = 2000
+
+def test_budget_lists_more_than_25_budgets_in_pages(bb):
+    async def scenario():
+        api = FakeDiscord(0)
+        data = await bb.load_guild_data(GUILD_ID)
+        names = [f"予算{i:04d}-{'x' * 40}" for i in range(300)]
+        for i, name in enumerate(names):
+            bb.post_ledger_entry(GUILD_ID, data, name, 1000 + i, "credit")
+        channel = SentChannel(api, 10)
+        await bb.budget(FakeContext(api, FakeMember(3, FakeGuild(GUILD_ID)), channel))
+        await bb.outbound.drain()
+
+        [sent] = channel.kwargs
+        view = sent["view"]
+        assert isinstance(view, bb.EmbedPageView)
+        assert len(view.embeds) > 1
+        for embed in view.embeds:
+            assert len(embed.fields) <= 25
+            assert len(embed.description) <= EMBED_DESCRIPTION_LIMIT
+        text = "\n".join(embed.description for embed in view.embeds)
+        assert all(f"**{name}**: ¥{1000 + i:,}" in text for i, name in enumerate(names))
+
+    asyncio.run(scenario())
+
+def test_budget_with_few_budgets_is_a_single_embed(bb):
+    async def scenario():
+        api = FakeDiscord(0)
+        data = await bb.load_guild_data(GUILD_ID)
+        bb.post_ledger_entry(GUILD_ID, data, "備品", 5000, "credit")
+        channel = SentChannel(api, 10)
+        await bb.budget(FakeContext(api, FakeMember(3, FakeGuild(GUILD_ID)), channel))
+        await bb.outbound.drain()
+
+        [sent] = channel.kwargs
+        assert "view" not in sent
+        assert "**備品**: ¥5,000" in sent["embed"].description
+
+    asyncio.run(scenario())
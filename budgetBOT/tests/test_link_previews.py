@@ -0,0 +1,230 @@
+"""申請の参考リンクの読み込みと、読み込んだ後のEmbedの描き直しを確かめる"""
+import asyncio
+import socket
+import threading
+
+import pytest
+from aiohttp import web
+
+import link_preview
+from benchmark import LinkPageServer
+from tests.fakes import FakeChannel, FakeContext, FakeDiscord, FakeGuild, FakeInteraction, FakeMember, FakeMessage
+
+GUILD_ID = 3000
+BUDGET = "備品"
+
+class EmbedMessage(FakeMessage):
+    """最後に届いた (編集が終わった) Embedを持つメッセージ。
+    チャンネル経由の編集は delay 秒かかり、送り始めたら preview_started を立てる"""
+
+    def __init__(self, api, channel, embed, delay: float):
+        super().__init__(api, channel)
+        self.embed = embed
+        self.delay = delay
+        self.preview_started = asyncio.Event()
+
+    async def edit(self, **kwargs):
+        self.preview_started.set()
+        await asyncio.sleep(self.delay)
+        await super().edit(**kwargs)
+        if "embed" in kwargs:
+            self.embed = kwargs["embed"]
+
+class EmbedChannel(FakeChannel):
+    def __init__(self, api, channel_id: int, delay: float = 0):
+        super().__init__(api, channel_id)
+        self.delay = delay
+        self.messages = []
+
+    async def send(self, content=None, **kwargs):
+        await self.api.call()
+        message = EmbedMessage(self.api, self, kwargs.get("embed"), self.delay)
+        self.messages.append(message)
+        return message
+
+class EditingInteraction(FakeInteraction):
+    """インタラクション経由の編集はすぐに届く"""
+
+    async def edit_original_response(self, **kwargs):
+        await super().edit_original_response(**kwargs)
+        if "embed" in kwargs:
+            self.message.embed = kwargs["embed"]
+
+def use_link_previews(bb, monkeypatch, allow_private: bool = True):
+    resolver = bb.LinkPreviewResolver(
+        bb.LinkPreviewStore("link_previews.sqlite3"), bb.LINK_PREVIEW_CACHE_SIZE, bb.LINK_PREVIEW_TTL,
+        bb.LINK_PREVIEW_CONCURRENCY, bb.LINK_PREVIEW_PER_HOST, bb.LINK_PREVIEW_TIMEOUT, allow_private
+    )
+    monkeypatch.setattr(bb, "LINK_PREVIEW", True)
+    monkeypatch.setattr(bb, "link_previews", resolver)
+    return resolver
+
+async def send_request(bb, api, channel, link: str, unit_price: int) -> EmbedMessage:
+    data = await bb.load_guild_data(GUILD_ID)
+    if BUDGET not in data["budgets"]:
+        bb.post_ledger_entry(GUILD_ID, data, BUDGET, 10 ** 6, "credit")
+    await bb.send(FakeContext(api, FakeMember(3, FakeGuild(GUILD_ID)), channel), "member-3", "部品", link, unit_price, BUDGET)
+    return channel.messages[-1]
+
+async def wait_for_previews(bb):
+    while bb.link_previews.pending_count():
+        await asyncio.sleep(0.01)
+    await bb.outbound.drain()
+
+def field_values(embed) -> dict:
+    return {field.name: field.value for field in embed.fields}
+
+def test_redraw_shows_title_and_listed_price(bb, monkeypatch):
+    server = LinkPageServer(0)
+
+    async def scenario():
+        base_url = await server.start()
+        resolver = use_link_previews(bb, monkeypatch)
+        resolver.start()
+        try:
+            api = FakeDiscord(0)
+            channel = EmbedChannel(api, 10)
+            # ページ7の掲載価格は1,007円
+            same = await send_request(bb, api, channel, f"{base_url}/items/7", 1007)
+            other = await send_request(bb, api, channel, f"{base_url}/items/8?utm_source=discord", 1000)
+            assert "リンク先" not in field_values(same.embed)
+            await wait_for_previews(bb)
+            assert field_values(same.embed)["リンク先"] == "🔎 部品 7 ・ 掲載価格 ¥1,007"
+            assert field_values(other.embed)["リンク先"] == "🔎 部品 8 ・ 掲載価格 ¥1,008 ⚠️ 単価と異なります"
+            assert same.embed.footer.text == "ステータス: 審査中"
+            assert server.hits == {"7": 1, "8": 1}
+        finally:
+            await resolver.close()
+            await server.stop()
+
+    asyncio.run(scenario())
+
+def test_review_result_is_not_overwritten_by_a_redraw_in_flight(bb, monkeypatch):
+    server = LinkPageServer(0)
+
+    async def scenario():
+        base_url = await server.start()
+        resolver = use_link_previews(bb, monkeypatch)
+        resolver.start()
+        try:
+            api = FakeDiscord(0)
+            # 描き直しの編集は審査結果の編集より遅れて届く
+            channel = EmbedChannel(api, 10, delay=0.2)
+            message = await send_request(bb, api, channel, f"{base_url}/items/1", 1001)
+            [request_id] = (await bb.load_guild_data(GUILD_ID))["pending_requests"]
+            await asyncio.wait_for(message.preview_started.wait(), 5)
+
+            reviewer = FakeMember(2, FakeGuild(GUILD_ID), [bb.ALLOWED_ROLE_ID])
+            interaction = EditingInteraction(api, reviewer, message)
+            await bb.ApprovalButton("approve", GUILD_ID, request_id).callback(interaction)
+            await wait_for_previews(bb)
+            assert message.embed.title == "審査結果"
+        finally:
+            await resolver.close()
+            await server.stop()
+
+    asyncio.run(scenario())
+
+def test_redraw_is_skipped_once_the_request_is_reviewed(bb):
+    async def scenario():
+        api = FakeDiscord(0)
+        message = FakeMessage(api, FakeChannel(api, 10))
+        reviewed = False
+
+        async def still_pending():
+            return not reviewed
+
+        # 予約した後、送る前に審査が済んだ場合
+        bb.outbound.edit_message(message, only_if=still_pending, embed=None)
+        reviewed = True
+        await bb.outbound.drain()
+        assert message.edits == 0
+        bb.outbound.edit_message(message, embed=None)
+        await bb.outbound.drain()
+        assert message.edits == 1
+
+    asyncio.run(scenario())
+
+class ShopResolver:
+    """shop.example だけを手元のサーバーに向け、ほかは本来の PublicAddressResolver に任せる"""
+
+    def __init__(self, public_resolver):
+        self.public_resolver = public_resolver
+
+    def __call__(self):
+        resolver = self.public_resolver()
+        original = resolver.resolve
+
+        async def resolve(host, port=0, family=socket.AF_INET):
+            if host == "shop.example":
+                return [{"hostname": host, "host": "127.0.0.1", "port": port, "family": socket.AF_INET, "proto": 0, "flags": socket.AI_NUMERICHOST}]
+            return await original(host, port, family)
+
+        resolver.resolve = resolve
+        return resolver
+
+@pytest.mark.parametrize("bb", ["json"], indirect=True)
+@pytest.mark.parametrize("target", ["127.0.0.1", "localhost"])
+def test_redirect_to_private_address_is_refused(bb, monkeypatch, target):
+    hits = []
+
+    async def redirect(request):
+        hits.append(request.path)
+        raise web.HTTPFound(f"http://{target}:{request.url.port}/secret")
+
+    async def secret(request):
+        hits.append(request.path)
+        return web.Response(text='<html><head><meta property="og:title" content="内部"></head></html>', content_type="text/html")
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get("/item", redirect)
+        app.router.add_get("/secret", secret)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        monkeypatch.setattr(link_preview, "PublicAddressResolver", ShopResolver(link_preview.PublicAddressResolver))
+        resolver = use_link_previews(bb, monkeypatch, allow_private=False)
+        resolver.start()
+        try:
+            assert await resolver.resolve(f"http://shop.example:{port}/item") is None
+            # 公開されていないアドレスを直接指定しても読み込まない
+            assert await resolver.resolve(f"http://localhost:{port}/secret") is None
+            assert await resolver.resolve(f"http://127.0.0.1:{port}/secret") is None
+            # 最初のページは読みに行くが、リダイレクト先には接続しない
+            assert hits == ["/item"]
+        finally:
+            await resolver.close()
+            await runner.cleanup()
+
+    asyncio.run(scenario())
+
+def test_pages_are_parsed_off_the_event_loop_and_close_stops_the_thread(bb, monkeypatch):
+    server = LinkPageServer(0)
+    threads = []
+    parse = link_preview.parse_link_preview
+
+    def recording_parse(body, charset=None):
+        threads.append(threading.current_thread())
+        return parse(body, charset)
+
+    monkeypatch.setattr(link_preview, "parse_link_preview", recording_parse)
+
+    async def scenario():
+        base_url = await server.start()
+        resolver = use_link_previews(bb, monkeypatch)
+        resolver.start()
+        try:
+            preview = await resolver.resolve(f"{base_url}/items/3")
+            assert preview.title == "部品 3"
+        finally:
+            await resolver.close()
+            await server.stop()
+        # 閉じた後はスレッドも止まっていて、新しい処理を受け付けない
+        with pytest.raises(RuntimeError):
+            resolver._executor.submit(int)
+
+    asyncio.run(scenario())
+    assert threads and threading.main_thread() not in threads
@@ -0,0 +1,41 @@
+"""LOW_MEMORY_MODE で、必要なインテントを残したままメンバーをキャッシュせずに動くことを確かめる"""
+import asyncio
+import json
+import subprocess
+import sys
+
+from tests.fakes import FakeGuild, FakeMember
+from tests.conftest import BOT_DIR, REVIEWER_ROLE_ID
+
+GUILD_ID = 7000
+
+def test_low_memory_mode_drops_member_intents_but_keeps_reactions(tmp_path):
+    with open(tmp_path / "config.json", "w", encoding="utf-8") as f:
+        json.dump({"TOKEN": "test", "ALLOWED_ROLE_ID": REVIEWER_ROLE_ID, "LOW_MEMORY_MODE": True}, f)
+    # インテントは読み込み時に決まるので、別のプロセスで読み込む
+    code = (
+        "import json, budgetBOT; bot = budgetBOT.bot; "
+        "print(json.dumps([bot.intents.members, bot.intents.message_content, bot.intents.reactions, bot.intents.guilds, "
+        "bot._connection.member_cache_flags.value, bot._connection.max_messages]))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=tmp_path, env={"PYTHONPATH": BOT_DIR}, capture_output=True, text=True, timeout=60
+    )
+    assert result.returncode == 0, result.stderr
+    members, message_content, reactions, guilds, member_cache_flags, max_messages = json.loads(result.stdout.splitlines()[-1])
+    assert (members, message_content) == (False, False)
+    assert (reactions, guilds) == (True, True)
+    assert member_cache_flags == 0
+    assert max_messages is None
+
+def test_low_memory_mode_checks_roles_from_each_payload(bb, monkeypatch):
+    monkeypatch.setattr(bb, "LOW_MEMORY_MODE", True)
+
+    async def scenario():
+        guild = FakeGuild(GUILD_ID)
+        assert await bb.has_accounting_role(FakeMember(7, guild, [REVIEWER_ROLE_ID]))
+        # メンバーの更新イベントが届かなくても、ペイロードのロールが変われば判定も変わる
+        assert not await bb.has_accounting_role(FakeMember(7, guild))
+        assert len(bb.permission_cache) == 0
+
+    asyncio.run(scenario())
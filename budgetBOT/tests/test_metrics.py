@@ -0,0 +1,66 @@
+"""処理時間のヒストグラムと、メトリクスのエンドポイントの出力を確かめる"""
+import asyncio
+import resource
+import sys
+import types
+
+import aiohttp
+import pytest
+
+from metrics import METRIC_BUCKETS, Histogram, Metrics, peak_rss_bytes, start_metrics_server
+
+def test_histogram_quantiles_use_bucket_upper_bounds():
+    histogram = Histogram()
+    for _ in range(90):
+        histogram.observe(0.003)
+    for _ in range(10):
+        histogram.observe(0.4)
+    assert histogram.quantile(0.5) == 0.005
+    assert histogram.quantile(0.99) == 0.4
+    # 上端のバケットより遅い呼び出しは最大値で表す
+    histogram.observe(30.0)
+    assert histogram.quantile(1.0) == 30.0
+
+@pytest.mark.parametrize("platform, max_rss", [("linux", 2048), ("darwin", 2048 * 1024)])
+def test_peak_rss_is_reported_in_bytes_on_every_platform(monkeypatch, platform, max_rss):
+    # ru_maxrss はLinuxではKiB、macOSではバイト
+    monkeypatch.setattr(sys, "platform", platform)
+    monkeypatch.setattr(resource, "getrusage", lambda who: types.SimpleNamespace(ru_maxrss=max_rss))
+    assert peak_rss_bytes() == 2048 * 1024
+
+def test_render_writes_cumulative_buckets_and_samples(capsys):
+    metrics = Metrics(slow_threshold=1.0)
+    metrics.observe("budgetbot_command_seconds", 0.002, command="send")
+    metrics.observe("budgetbot_command_seconds", 2.0, command="send")
+    metrics.observe("budgetbot_command_seconds", 0.02, command='say "hi"')
+    assert "🐢 Slow call: budgetbot_command_seconds (command=send) 2000ms" in capsys.readouterr().out
+
+    text = metrics.render([("budgetbot_pending_writes", "gauge", 3)])
+    lines = text.splitlines()
+    assert lines.count("# TYPE budgetbot_command_seconds histogram") == 1
+    assert 'budgetbot_command_seconds_bucket{command="send",le="0.0025"} 1' in lines
+    assert 'budgetbot_command_seconds_bucket{command="send",le="2.5"} 2' in lines
+    assert 'budgetbot_command_seconds_bucket{command="send",le="+Inf"} 2' in lines
+    assert 'budgetbot_command_seconds_count{command="send"} 2' in lines
+    assert 'budgetbot_command_seconds_count{command="say \\"hi\\""} 1' in lines
+    assert sum(line.startswith('budgetbot_command_seconds_bucket{command="send"') for line in lines) == len(METRIC_BUCKETS) + 1
+    assert "# TYPE budgetbot_pending_writes gauge" in lines
+    assert "budgetbot_pending_writes 3" in lines
+
+def test_metrics_endpoint_reports_bot_state(bb):
+    async def scenario():
+        await bb.load_guild_data(1)
+        runner = await start_metrics_server("127.0.0.1", 0, bb.collect_metric_samples)
+        try:
+            port = runner.addresses[0][1]
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                    assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+                    lines = (await response.text()).splitlines()
+        finally:
+            await runner.cleanup()
+        assert "budgetbot_guild_cache_entries 1" in lines
+        assert "budgetbot_guild_cache_misses_total 1" in lines
+        assert any(line.startswith('budgetbot_storage_seconds_count{operation="load_guild"}') for line in lines)
+
+    asyncio.run(scenario())
@@ -0,0 +1,80 @@
+"""Discordへの送信・編集の待ち行列で、編集がまとめられ、チャンネルの送信間隔が守られることを確かめる"""
+import asyncio
+import time
+
+from tests.fakes import FakeChannel, FakeDiscord, FakeMessage
+from outbound import OutboundDispatcher
+
+class TimedChannel(FakeChannel):
+    """送信した時刻を記録するチャンネル"""
+
+    def __init__(self, api, channel_id: int):
+        super().__init__(api, channel_id)
+        self.sent_at = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent_at.append(time.monotonic())
+        return await super().send(content, **kwargs)
+
+class LastEditMessage(FakeMessage):
+    def __init__(self, api, channel):
+        super().__init__(api, channel)
+        self.content = None
+
+    async def edit(self, **kwargs):
+        await super().edit(**kwargs)
+        self.content = kwargs.get("content", self.content)
+
+def test_queued_edits_to_the_same_message_are_coalesced():
+    async def scenario():
+        api = FakeDiscord(0.01)
+        channel = FakeChannel(api, 10)
+        message = LastEditMessage(api, channel)
+        outbound = OutboundDispatcher(5, 5.0)
+        futures = [outbound.edit_message(message, content=f"v{i}") for i in range(20)]
+        await outbound.drain()
+        assert all(future.done() for future in futures)
+        # まだ送っていない編集は1回にまとまり、最新の内容が届く
+        assert message.edits == 1
+        assert message.content == "v19"
+        assert outbound.coalesced == 19
+        # 送っている間に届いた編集は、その後にもう1回送る
+        outbound.edit_message(message, content="v20")
+        await asyncio.sleep(0)
+        outbound.edit_message(message, content="v21")
+        outbound.edit_message(message, content="v22")
+        await outbound.drain()
+        assert message.edits == 3
+        assert message.content == "v22"
+
+    asyncio.run(scenario())
+
+def test_sends_to_one_channel_stay_within_the_rate_limit():
+    async def scenario():
+        api = FakeDiscord(0)
+        busy = TimedChannel(api, 10)
+        other = TimedChannel(api, 11)
+        outbound = OutboundDispatcher(2, 0.2)
+        futures = [outbound.send(busy, content=str(i)) for i in range(6)]
+        futures.append(outbound.send(other, content="other"))
+        await asyncio.gather(*futures)
+        for i in range(2, len(busy.sent_at)):
+            assert busy.sent_at[i] - busy.sent_at[i - 2] >= 0.2 - 0.01
+        # ほかのチャンネルへの送信は待たされない
+        assert other.sent_at[0] - busy.sent_at[0] < 0.1
+        assert outbound.throttled > 0
+
+    asyncio.run(scenario())
+
+def test_failed_send_is_reported_to_the_caller():
+    class BrokenChannel(FakeChannel):
+        async def send(self, content=None, **kwargs):
+            raise RuntimeError("missing permissions")
+
+    async def scenario():
+        outbound = OutboundDispatcher(5, 5.0)
+        future = outbound.send(BrokenChannel(FakeDiscord(0), 10), content="x")
+        await outbound.drain()
+        assert isinstance(future.exception(), RuntimeError)
+
+    asyncio.run(scenario())
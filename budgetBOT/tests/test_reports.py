@@ -0,0 +1,162 @@
+"""審査待ちの一覧・集計・エクスポート・審査記録の検索のコマンドが、条件に合う記録だけを返すことを確かめる"""
+import asyncio
+import csv
+import gzip
+import io
+
+from tests.fakes import FakeContext, FakeDiscord, FakeGuild, FakeMember, SentChannel
+
+GUILD_ID = 5000
+
+def make_flags(flags_class, values: dict):
+    flags = flags_class.__new__(flags_class)
+    for flag in flags_class.get_flags().values():
+        setattr(flags, flag.attribute, values.get(flag.attribute, flag.default))
+    return flags
+
+def reviewer_context(bb, api):
+    reviewer = FakeMember(2, FakeGuild(GUILD_ID), [bb.ALLOWED_ROLE_ID])
+    return FakeContext(api, reviewer, SentChannel(api, 10))
+
+def review_record(i: int, **values) -> dict:
+    record = {
+        "applicant": f"member-{i % 3}", "name": f"部品{i}", "link": "", "unit_price": 100 * (i + 1), "quantity": 1,
+        "amount": 100 * (i + 1), "result": "承認", "approver": "member-2", "budget_name": "備品",
+        "created_at": f"2025-{i % 12 + 1:02d}-15T12:00:00"
+    }
+    record.update(values)
+    return record
+
+def store_review_rows(bb, records: list):
+    bb.storage.append_review_rows(GUILD_ID, records)
+    bb.storage.sync_review_logs()
+
+def test_pending_filters_and_sorts_open_requests(bb):
+    async def scenario():
+        api = FakeDiscord(0)
+        data = await bb.load_guild_data(GUILD_ID)
+        for name in ("備品", "消耗品"):
+            bb.post_ledger_entry(GUILD_ID, data, name, 10 ** 6, "credit")
+        for amount, budget_name in ((300, "備品"), (5000, "消耗品"), (1200, "備品")):
+            await bb.open_pending_request(3, "member-3", "", GUILD_ID, [bb.RequestItem("部品", "", amount)], budget_name)
+        ctx = reviewer_context(bb, api)
+
+        await bb.pending(ctx, flags=make_flags(bb.PendingFlags, {"sort": "amount"}))
+        description = ctx.channel.kwargs[-1]["embed"].description
+        assert description.index("¥5,000") < description.index("¥1,200") < description.index("¥300")
+        assert ctx.channel.kwargs[-1]["embed"].footer.text == "3件 ・ 合計 ¥6,500"
+
+        await bb.pending(ctx, flags=make_flags(bb.PendingFlags, {"budget": "備品", "min_amount": 1000}))
+        embed = ctx.channel.kwargs[-1]["embed"]
+        assert "¥1,200" in embed.description and "¥300" not in embed.description
+        assert embed.footer.text == "1件 ・ 合計 ¥1,200"
+
+        await bb.pending(ctx, flags=make_flags(bb.PendingFlags, {"applicant": "member-9"}))
+        assert ctx.channel.contents[-1] == "ℹ️ 条件に合う審査待ちの申請はありません。"
+
+    asyncio.run(scenario())
+
+def test_report_totals_follow_reviews_and_match_a_rebuild(bb):
+    async def scenario():
+        api = FakeDiscord(0)
+        data = await bb.load_guild_data(GUILD_ID)
+        bb.post_ledger_entry(GUILD_ID, data, "備品", 10 ** 6, "credit")
+        items = [bb.RequestItem("部品", "", 300), bb.RequestItem("工具", "", 200, 2)]
+        request = await bb.open_pending_request(3, "member-3", "", GUILD_ID, items, "備品")
+        ctx = reviewer_context(bb, api)
+        # 初回の !report で審査記録から集計を作り、以降は審査の反映に合わせて足していく
+        await bb.report(ctx)
+        assert ctx.channel.contents[-1] == "ℹ️ まだ審査記録がありません。"
+        await bb.apply_review_decision(GUILD_ID, request, "member-2", items[:1], items[1:])
+
+        await bb.report(ctx, "budget", key="備品")
+        expected = "承認 ¥300 (1件) / 却下 ¥400 (1件) / 承認率 50%"
+        assert ctx.channel.kwargs[-1]["embed"].description == expected
+        await bb.report(ctx, "rebuild")
+        await bb.report(ctx, "applicant", key="member-3")
+        assert ctx.channel.kwargs[-1]["embed"].description == expected
+
+    asyncio.run(scenario())
+
+def test_export_csv_writes_only_matching_rows(bb):
+    async def scenario():
+        api = FakeDiscord(0)
+        store_review_rows(bb, [
+            review_record(i, budget_name="備品" if i % 2 else "消耗品", result="承認" if i % 3 else "却下")
+            for i in range(24)
+        ])
+        ctx = reviewer_context(bb, api)
+        values = {"since": "2025-03-01", "until": "2025-06-30", "budget": "備品", "result": "承認", "file_format": "gzip"}
+        await bb.export_csv(ctx, flags=make_flags(bb.ExportFlags, values))
+        [file] = ctx.files
+        assert file.filename == "review_results.csv.gz"
+        rows = list(csv.reader(io.StringIO(gzip.decompress(file.fp.getvalue()).decode("utf-8"))))
+        assert rows[0] == bb.REVIEW_LOG_HEADER
+        # 3〜6月 (i = 2〜5, 14〜17) のうち、備品 (奇数) で承認 (3の倍数以外) された記録
+        expected = [
+            i for i in range(24)
+            if i % 2 and i % 3 and "2025-03" <= f"2025-{i % 12 + 1:02d}" <= "2025-06"
+        ]
+        assert [row[1] for row in rows[1:]] == [f"部品{i}" for i in expected]
+
+    asyncio.run(scenario())
+
+def test_export_csv_splits_large_exports_into_parts(bb, monkeypatch):
+    monkeypatch.setattr(bb, "EXPORT_PART_MAX_BYTES", 4096)
+
+    async def scenario():
+        api = FakeDiscord(0)
+        store_review_rows(bb, [review_record(i) for i in range(300)])
+        ctx = reviewer_context(bb, api)
+        await bb.export_csv(ctx, flags=make_flags(bb.ExportFlags, {}))
+        assert len(ctx.files) > 1
+        names = []
+        for part, file in enumerate(ctx.files, 1):
+            assert file.filename == f"review_results_part{part}.csv"
+            data = file.fp.getvalue()
+            # 上限を超えるのは最後の1行の分まで
+            assert len(data) < 4096 + 200
+            rows = list(csv.reader(io.StringIO(data.decode("utf-8"))))
+            assert rows[0] == bb.REVIEW_LOG_HEADER
+            names += [row[1] for row in rows[1:]]
+        assert names == [f"部品{i}" for i in range(300)]
+
+    asyncio.run(scenario())
+
+def test_export_csv_rejects_bad_flags(bb):
+    async def scenario():
+        api = FakeDiscord(0)
+        ctx = reviewer_context(bb, api)
+        await bb.export_csv(ctx, flags=make_flags(bb.ExportFlags, {"result": "保留"}))
+        assert ctx.channel.contents[-1] == "⚠️ result には 承認 または 却下 を指定してください。"
+        await bb.export_csv(ctx, flags=make_flags(bb.ExportFlags, {}))
+        assert ctx.channel.contents[-1] == "ℹ️ 条件に合う審査記録がありません。"
+        assert not ctx.files
+
+    asyncio.run(scenario())
+
+def test_history_finds_rows_by_domain_keyword_and_approver(bb):
+    async def scenario():
+        api = FakeDiscord(0)
+        store_review_rows(bb, [
+            review_record(0, name="M3ネジ", link="https://www.partscabi.net/items/1", approver="member-5"),
+            review_record(1, name="M3ネジ", link="https://shop.example.com/items/2", approver="member-5"),
+            review_record(2, name="ケーブル", link="https://partscabi.net/items/3", approver="member-5"),
+            review_record(3, name="Ｍ３ネジ", link="https://partscabi.net/items/4", approver="member-6"),
+        ])
+        ctx = reviewer_context(bb, api)
+        flags = make_flags(bb.HistoryFlags, {"domain": "partscabi.net", "keyword": "m3ネジ", "approver": "member-5"})
+        await bb.history(ctx, flags=flags)
+        description = ctx.channel.kwargs[-1]["embed"].description
+        assert "items/1" in description
+        assert "items/2" not in description and "items/3" not in description and "items/4" not in description
+
+        # 索引を作った後に追記された記録も検索できる
+        bb.review_log.append(GUILD_ID, [review_record(4, name="m3ネジ", link="https://partscabi.net/items/5", approver="member-5")])
+        await bb.review_log.flush()
+        await bb.history(ctx, flags=flags)
+        description = ctx.channel.kwargs[-1]["embed"].description
+        # 新しい順に並ぶ
+        assert description.index("items/5") < description.index("items/1")
+
+    asyncio.run(scenario())
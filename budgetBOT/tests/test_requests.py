@@ -0,0 +1,132 @@
+"""申請の作成 (一括申請・予算名の候補・品物の多い申請のページ送り) と会計権限の判定を確かめる"""
+import asyncio
+import types
+
+from tests.fakes import FakeChannel, FakeContext, FakeDiscord, FakeGuild, FakeInteraction, FakeMember, FakeMessage, SentChannel
+
+GUILD_ID = 6000
+
+def attachment(text: str, encoding: str = "utf-8"):
+    raw = text.encode(encoding)
+
+    async def read():
+        return raw
+
+    return types.SimpleNamespace(size=len(raw), read=read)
+
+async def add_budgets(bb, names):
+    data = await bb.load_guild_data(GUILD_ID)
+    for name in names:
+        bb.post_ledger_entry(GUILD_ID, data, name, 10 ** 6, "credit")
+    return data
+
+def test_bulk_send_groups_rows_into_one_request_per_budget(bb):
+    async def scenario():
+        api = FakeDiscord(0)
+        data = await add_budgets(bb, ("備品", "消耗品"))
+        # Excelで保存したShift_JISのCSV。予算項目の列が空の行は引数の予算名を使う
+        text = "購入物,リンク,単価,個数,予算項目\nネジ,,\"￥1,200\",,消耗品\nドライバー,https://shop.example/1,\"1,500\",2,\nナット,,80,10,消耗品\n"
+        ctx = FakeContext(api, FakeMember(3, FakeGuild(GUILD_ID)), SentChannel(api, 10))
+        await bb.bulk_send(ctx, attachment(text, "cp932"), budget_name="備品")
+        assert ctx.channel.contents[-1] == "✅ 3件の品物を 2件の申請にまとめて送信しました。"
+        requests = [await bb.get_pending_request(GUILD_ID, request_id) for request_id in data["pending_requests"]]
+        assert sorted((request.budget_name, [item.to_json() for item in request.items]) for request in requests) == [
+            ("備品", [["ドライバー", "https://shop.example/1", 1500, 2, 3000]]),
+            ("消耗品", [["ネジ", "", 1200, 1, 1200], ["ナット", "", 80, 10, 800]]),
+        ]
+
+    asyncio.run(scenario())
+
+def test_bulk_send_with_errors_sends_nothing(bb):
+    async def scenario():
+        api = FakeDiscord(0)
+        data = await add_budgets(bb, ("備品",))
+        text = "購入物\t単価\t予算項目\nネジ\t100\t備品\n\t二百\t備品\nナット\t50\t未登録\n"
+        ctx = FakeContext(api, FakeMember(3, FakeGuild(GUILD_ID)), SentChannel(api, 10))
+        await bb.bulk_send(ctx, attachment(text))
+        assert ctx.channel.contents[-1] == (
+            "⚠️ 2件のエラーがあるため申請しませんでした。\n"
+            "3行目: 購入物が空です / 単価「二百」が数字ではありません\n"
+            "4行目: 予算項目「未登録」は存在しません"
+        )
+        assert not data["pending_requests"]
+
+    asyncio.run(scenario())
+
+def test_budget_autocomplete_matches_prefix_substring_and_width(bb):
+    async def scenario():
+        api = FakeDiscord(0)
+        await add_budgets(bb, ("F3EC 機体", "F3EC 電装", "電装 予備", "ＦＳ 試作"))
+        reviewer = FakeMember(2, FakeGuild(GUILD_ID), [bb.ALLOWED_ROLE_ID])
+        interaction = FakeInteraction(api, reviewer, FakeMessage(api, FakeChannel(api, 10)))
+
+        async def suggest(current):
+            return [choice.value for choice in await bb.send_budget_name_autocomplete(interaction, current)]
+
+        # 前方一致を先に、部分一致を後に出す
+        assert await suggest("電装") == ["電装 予備", "F3EC 電装"]
+        assert await suggest("f3ec") == ["F3EC 機体", "F3EC 電装"]
+        assert await suggest("fs") == ["ＦＳ 試作"]
+        # 索引を作った後に追加した予算も候補に出る
+        await bb.add_budget(FakeContext(api, reviewer, FakeChannel(api, 10)), "F3EC 予備", 100)
+        assert await suggest("f3ec") == ["F3EC 予備", "F3EC 機体", "F3EC 電装"]
+
+    asyncio.run(scenario())
+
+def test_long_request_is_paged_with_buttons_that_survive_restarts(bb, restart):
+    async def scenario():
+        await add_budgets(bb, ("備品",))
+        items = [bb.RequestItem(f"部品{i}-{'x' * 60}", f"https://shop.example/items/{i}", 100 + i) for i in range(120)]
+        request = await bb.open_pending_request(3, "member-3", "", GUILD_ID, items, "備品")
+        first = bb.build_request_embed(request)
+        pages = len(bb.request_renderer(request).pages)
+        assert pages > 1
+        assert first.footer.text == f"ステータス: 審査中 ・ ページ 1/{pages}"
+        assert first.fields[0].value == f"**¥{sum(item.amount for item in items):,}**"
+        custom_ids = [item.custom_id for item in bb.ApprovalView(request).children]
+        assert f"budget:page:{GUILD_ID}:{request.request_id}:1" in custom_ids
+        await bb.persistence.drain()
+        return request.request_id, pages
+
+    request_id, pages = asyncio.run(scenario())
+    restart()
+
+    async def after_restart():
+        # 再起動後はcustom_idからボタンを作り直し、ストレージから申請を読み直して開く
+        api = FakeDiscord(0)
+        button = bb.RequestPageButton(GUILD_ID, request_id, 1, "次のページ", "▶️")
+        interaction = FakeInteraction(api, FakeMember(2, FakeGuild(GUILD_ID)), FakeMessage(api, FakeChannel(api, 10)))
+        edits = []
+
+        async def edit_original_response(**kwargs):
+            edits.append(kwargs)
+
+        interaction.edit_original_response = edit_original_response
+        await button.callback(interaction)
+        await bb.outbound.drain()
+        [edit] = edits
+        assert edit["embed"].footer.text == f"ステータス: 審査中 ・ ページ 2/{pages}"
+        assert "**1. 部品0" not in edit["embed"].description
+
+    asyncio.run(after_restart())
+
+def test_accounting_role_checks_are_cached_until_roles_change(bb):
+    async def scenario():
+        api = FakeDiscord(0)
+        guild = FakeGuild(GUILD_ID)
+        member = FakeMember(7, guild, [77])
+        assert not await bb.has_accounting_role(member)
+        assert not await bb.has_accounting_role(member)
+        assert bb.permission_cache.hits == 1
+
+        # 会計ロールを追加するとサーバーの判定結果を捨てる
+        admin = FakeMember(1, guild)
+        await bb.add_accounting_role(FakeContext(api, admin, FakeChannel(api, 10)), types.SimpleNamespace(id=77, mention="<@&77>"))
+        assert await bb.has_accounting_role(member)
+
+        # ロールを外されたメンバーの判定結果も捨てる
+        demoted = FakeMember(7, guild)
+        await bb.on_member_update(member, demoted)
+        assert not await bb.has_accounting_role(demoted)
+
+    asyncio.run(scenario())
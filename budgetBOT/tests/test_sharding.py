@@ -0,0 +1,55 @@
+"""別のクラスタが受け持つサーバーのデータを読まず、コマンドにはエラーとして返すことを確かめる"""
+import asyncio
+
+import pytest
+from discord.ext import commands
+
+from tests.fakes import FakeChannel, FakeContext, FakeDiscord, FakeGuild, FakeInteraction, FakeMember, FakeMessage, RecordingChannel
+
+OWNED_GUILD = 0
+OTHER_GUILD = 1 << 22
+
+@pytest.fixture
+def two_clusters(bb, monkeypatch):
+    # シャード2つのうちシャード0だけを受け持つ
+    monkeypatch.setattr(bb.bot, "shard_count", 2)
+    monkeypatch.setattr(bb.bot, "shard_ids", [0])
+    return bb
+
+def test_owns_guild_follows_discord_shard_assignment(two_clusters):
+    assert two_clusters.owns_guild(OWNED_GUILD)
+    assert not two_clusters.owns_guild(OTHER_GUILD)
+
+def test_loading_another_clusters_guild_raises_guild_not_owned(two_clusters):
+    bb = two_clusters
+
+    async def scenario():
+        with pytest.raises(bb.GuildNotOwned):
+            await bb.load_guild_data(OTHER_GUILD)
+        assert OTHER_GUILD not in bb.guild_data
+        await bb.load_guild_data(OWNED_GUILD)
+
+    asyncio.run(scenario())
+
+def test_command_error_handler_reports_another_clusters_guild(two_clusters):
+    bb = two_clusters
+
+    async def scenario():
+        api = FakeDiscord(0)
+        messages = []
+        ctx = FakeContext(api, FakeMember(2, FakeGuild(OTHER_GUILD)), RecordingChannel(api, 10, messages))
+        await bb.on_command_error(ctx, commands.CommandInvokeError(bb.GuildNotOwned(OTHER_GUILD)))
+        assert len(messages) == 1
+
+    asyncio.run(scenario())
+
+def test_budget_autocomplete_for_another_clusters_guild_suggests_nothing(two_clusters):
+    bb = two_clusters
+
+    async def scenario():
+        api = FakeDiscord(0)
+        interaction = FakeInteraction(api, FakeMember(2, FakeGuild(OTHER_GUILD)), FakeMessage(api, FakeChannel(api, 10)))
+        assert await bb.send_budget_name_autocomplete(interaction, "備品") == []
+        assert OTHER_GUILD not in bb.guild_data
+
+    asyncio.run(scenario())
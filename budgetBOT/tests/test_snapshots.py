@@ -0,0 +1,84 @@
+"""スナップショットの増分保存と書き戻しを確かめる"""
+import asyncio
+import os
+import sqlite3
+
+import pytest
+
+import snapshots
+
+GUILD_ID = 1000
+BUDGET = "備品"
+
+async def post_credits(bb, count: int):
+    data = await bb.load_guild_data(GUILD_ID)
+    for i in range(count):
+        bb.post_ledger_entry(GUILD_ID, data, BUDGET, 100, "credit", actor=f"member-{i}")
+    await bb.persistence.drain()
+
+def read_files(data_dir: str) -> dict:
+    files = {}
+    for root, _, names in os.walk(data_dir):
+        for name in names:
+            with open(os.path.join(root, name), "rb") as f:
+                files[os.path.relpath(os.path.join(root, name), data_dir)] = f.read()
+    return files
+
+@pytest.mark.parametrize("bb", ["json"], indirect=True)
+def test_appended_files_store_only_the_new_tail_and_restore_exactly(bb, monkeypatch):
+    monkeypatch.setattr(bb, "LEDGER_SNAPSHOT_INTERVAL", 10 ** 6)
+    monkeypatch.setattr(snapshots, "SNAPSHOT_CHUNK_BYTES", 64 * 1024)
+    asyncio.run(post_credits(bb, 5000))
+    full_name, full = bb.create_snapshot(bb.DATA_DIR, "snapshots")
+    expected = read_files(bb.DATA_DIR)
+
+    asyncio.run(post_credits(bb, 1))
+    name, incremental = bb.create_snapshot(bb.DATA_DIR, "snapshots")
+    # 台帳は追記だけなので、最後のチャンクから後ろだけを読んで保存する
+    assert incremental["appended"] >= 1 and incremental["copied"] == 0
+    assert incremental["stored_bytes"] < 2 * 64 * 1024 < full["stored_bytes"]
+    assert incremental["read_bytes"] < 2 * 64 * 1024
+    assert bb.verify_snapshots("snapshots", [full_name, name]) == []
+
+    # 最初のスナップショットに戻すと、後から追記した分もスナップショットにないファイルも消える
+    with open(os.path.join(bb.DATA_DIR, "extra.json"), "w", encoding="utf-8") as f:
+        f.write("{}")
+    stats = bb.restore_snapshot("snapshots", full_name, bb.DATA_DIR)
+    assert stats["removed"] == 1
+    assert read_files(bb.DATA_DIR) == expected
+
+@pytest.mark.parametrize("bb", ["sqlite"], indirect=True)
+def test_small_database_change_stores_only_changed_pages(bb):
+    asyncio.run(post_credits(bb, 20000))
+    full_name, full = bb.create_snapshot(bb.DATA_DIR, "snapshots", bb.SQLITE_PATH)
+    assert full["stored_bytes"] > 1024 * 1024
+
+    asyncio.run(post_credits(bb, 1))
+    name, incremental = bb.create_snapshot(bb.DATA_DIR, "snapshots", bb.SQLITE_PATH)
+    # 1件の取引で書き換わるのは数ページなので、データベース全体を保存し直さない
+    assert incremental["stored_bytes"] < full["stored_bytes"] / 10
+    assert bb.verify_snapshots("snapshots", [full_name, name]) == []
+
+    restore_db = os.path.join("restored", "budgetbot.sqlite3")
+    bb.restore_snapshot("snapshots", name, "restored", restore_db)
+    conn = sqlite3.connect(restore_db)
+    try:
+        assert conn.execute("SELECT COUNT(*) FROM budget_ledger WHERE guild_id=? AND kind='credit'", (GUILD_ID,)).fetchone()[0] == 20001
+    finally:
+        conn.close()
+
+@pytest.mark.parametrize("bb", ["json"], indirect=True)
+def test_snapshot_syncs_only_the_files_it_wrote(bb, monkeypatch):
+    asyncio.run(post_credits(bb, 100))
+    bb.create_snapshot(bb.DATA_DIR, "snapshots")
+    asyncio.run(post_credits(bb, 1))
+    objects_before = set(read_files(os.path.join("snapshots", "objects")))
+
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(fd) or fsync(fd))
+    monkeypatch.setattr(os, "sync", lambda: pytest.fail("os.sync() はほかのファイルまで書き出す"), raising=False)
+    bb.create_snapshot(bb.DATA_DIR, "snapshots")
+    new_objects = set(read_files(os.path.join("snapshots", "objects"))) - objects_before
+    # 新しいチャンクとマニフェスト、その親ディレクトリ (objects/xx, objects, snapshots, manifests) だけ
+    assert 1 <= len(new_objects) and len(synced) <= 2 * len(new_objects) + 4
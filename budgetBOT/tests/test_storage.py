@@ -0,0 +1,292 @@
+"""サーバーデータと審査待ちの申請の保存・読み込み・メモリからの追い出し・台帳からの残高の計算と、JSONからSQLiteへの移行を確かめる"""
+import asyncio
+import os
+import sqlite3
+
+import pytest
+
+from tests.fakes import FakeChannel, FakeDiscord, FakeMessage
+from storage import (
+    APPLIED_REQUESTS_FILE, BUDGET_FILE, PENDING_INDEX_FILE, SQLITE_MIGRATIONS, JsonStorage, PendingRequest, RequestItem, SqliteStorage,
+    migrate_json_to_sqlite, replay_ledger
+)
+
+GUILD_ID = 4000
+BUDGET = "備品"
+
+async def open_request(bb, guild_id: int = GUILD_ID, amount: int = 300):
+    data = await bb.load_guild_data(guild_id)
+    if BUDGET not in data["budgets"]:
+        bb.post_ledger_entry(guild_id, data, BUDGET, 10000, "credit")
+    items = [bb.RequestItem("部品", "https://shop.example/1", amount, 1), bb.RequestItem("工具", "", 50, 2)]
+    request = await bb.open_pending_request(3, "member-3", "", guild_id, items, BUDGET)
+    api = FakeDiscord(0)
+    await bb.attach_request_message(request, FakeMessage(api, FakeChannel(api, 10)))
+    return request
+
+def review_record(i: int) -> dict:
+    return {
+        "applicant": "member-3", "name": f"部品{i}", "link": "", "unit_price": 100, "quantity": i + 1, "amount": 100 * (i + 1),
+        "result": "承認" if i % 2 else "却下", "approver": "member-2", "budget_name": BUDGET, "created_at": "2025-01-15 12:00:00"
+    }
+
+def test_saved_guild_data_is_read_back_after_restart(bb, restart):
+    async def scenario():
+        data = await bb.load_guild_data(GUILD_ID)
+        bb.post_ledger_entry(GUILD_ID, data, BUDGET, 1000, "credit")
+        data["channels"].add(10)
+        bb.save_channels(GUILD_ID, data)
+        data["additional_roles"].add(77)
+        bb.save_settings(GUILD_ID, data)
+        bb.post_ledger_entry(GUILD_ID, data, "消耗品", 500, "credit")
+        bb.post_ledger_entry(GUILD_ID, data, "消耗品", -500, "adjustment")
+        await bb.persistence.drain()
+
+    asyncio.run(scenario())
+    restart()
+    data = asyncio.run(bb.load_guild_data(GUILD_ID))
+    assert {key: data[key] for key in ("budgets", "ledger_seq", "channels", "additional_roles", "no_overdraft", "applied_requests")} == {
+        "budgets": {BUDGET: 1000, "消耗品": 0}, "ledger_seq": 3, "channels": {10}, "additional_roles": {77}, "no_overdraft": False,
+        "applied_requests": {}
+    }
+    assert data["pending_requests"] == {} and data["aggregates"] is None
+
+def test_guild_cache_evicts_least_recently_used_guilds(bb, monkeypatch):
+    monkeypatch.setattr(bb, "guild_data", bb.GuildCache(bb.storage, 2, pending_guilds=bb.guilds_with_pending_writes))
+
+    async def scenario():
+        for guild_id in (1, 2, 3):
+            await bb.load_guild_data(guild_id)
+        assert 1 not in bb.guild_data and len(bb.guild_data) == 2
+        # 書き出していない変更のあるサーバーは上限を超えても追い出さない
+        data = await bb.load_guild_data(1)
+        bb.post_ledger_entry(1, data, BUDGET, 100, "credit")
+        for guild_id in (4, 5):
+            await bb.load_guild_data(guild_id)
+        assert 1 in bb.guild_data
+        await bb.persistence.drain()
+        await bb.load_guild_data(6)
+        assert 1 not in bb.guild_data
+        # 追い出した後に読み直しても、書き出した残高が戻る
+        assert (await bb.load_guild_data(1))["budgets"] == {BUDGET: 100}
+
+    asyncio.run(scenario())
+
+def test_concurrent_loads_of_one_guild_share_a_read(bb, monkeypatch):
+    loads = []
+    load_guild = bb.storage.load_guild
+
+    def counting_load(guild_id):
+        loads.append(guild_id)
+        return load_guild(guild_id)
+
+    monkeypatch.setattr(bb.storage, "load_guild", counting_load)
+
+    async def scenario():
+        results = await asyncio.gather(*(bb.load_guild_data(GUILD_ID) for _ in range(10)))
+        assert all(data is results[0] for data in results)
+
+    asyncio.run(scenario())
+    assert loads == [GUILD_ID]
+
+def test_dormant_request_is_reloaded_when_its_button_is_used(bb):
+    async def scenario():
+        request = await open_request(bb)
+        assert bb.dormant_requests.sweep() == 0
+        await bb.persistence.drain()
+        # 書き出した申請だけを、しばらく使われていなければメモリから外す
+        assert bb.dormant_requests.sweep(now=request.last_used + bb.dormant_requests.idle_seconds + 1) == 1
+        data = await bb.load_guild_data(GUILD_ID)
+        assert data["pending_requests"][request.request_id] is None
+        assert data["pending_index"].get(request.request_id).amount == 400
+
+        reloaded = await bb.get_pending_request(GUILD_ID, request.request_id)
+        assert reloaded is not request
+        assert [item.to_json() for item in reloaded.items] == [item.to_json() for item in request.items]
+        assert reloaded.message_id == request.message_id
+        assert bb.dormant_requests.rehydrations == 1
+
+    asyncio.run(scenario())
+
+def test_pending_request_reads_the_older_dict_item_format():
+    text = (
+        '{"request_id": "ab", "guild_id": 1, "author_id": 3, "author_name": "member-3", "author_avatar": "", '
+        '"budget_name": "備品", "created_at": "2024-01-01 00:00:00", '
+        '"items": [{"name": "部品", "link": "", "amount": 600, "unit_price": 200, "quantity": 3}]}'
+    )
+    request = PendingRequest.from_json(text)
+    assert request.items[0].to_json() == ["部品", "", 200, 3, 600]
+    assert PendingRequest.from_json(request.to_json()).items[0].to_json() == ["部品", "", 200, 3, 600]
+
+@pytest.mark.parametrize("snapshot_interval", [3, 1000])
+def test_balances_are_rebuilt_from_the_ledger_after_restart(bb, restart, monkeypatch, snapshot_interval):
+    monkeypatch.setattr(bb, "LEDGER_SNAPSHOT_INTERVAL", snapshot_interval)
+
+    async def scenario():
+        data = await bb.load_guild_data(GUILD_ID)
+        for i in range(10):
+            bb.post_ledger_entry(GUILD_ID, data, BUDGET, 1000, "credit")
+            bb.post_ledger_entry(GUILD_ID, data, "消耗品", 500, "credit")
+            bb.post_ledger_entry(GUILD_ID, data, BUDGET, -300 - i, "debit")
+            await bb.persistence.flush()
+        # まだ書き出していない取引も残高の計算に含める
+        bb.post_ledger_entry(GUILD_ID, data, "消耗品", -5, "adjustment")
+        expected = dict(data["budgets"])
+        assert await bb.replay_guild_ledger(GUILD_ID, data) == expected
+        assert await bb.replay_guild_ledger(GUILD_ID, data, full=True) == expected
+        # 最初の取引より前にはどの予算もない
+        assert await bb.replay_guild_ledger(GUILD_ID, data, upto="2000-01-01T00:00:00") == {}
+        await bb.persistence.drain()
+        return expected
+
+    expected = asyncio.run(scenario())
+    assert expected == {BUDGET: 10000 - sum(300 + i for i in range(10)), "消耗品": 4995}
+    restart()
+
+    async def after_restart():
+        data = await bb.load_guild_data(GUILD_ID)
+        assert data["budgets"] == expected
+        assert data["ledger_seq"] == 31
+        assert await bb.replay_guild_ledger(GUILD_ID, data, full=True) == expected
+
+    asyncio.run(after_restart())
+
+def test_review_rows_are_read_back_in_order(bb):
+    records = [review_record(i) for i in range(2500)]
+    bb.storage.append_review_rows(GUILD_ID, records[:1000])
+    bb.storage.append_review_rows(GUILD_ID, records[1000:])
+    assert list(bb.storage.iter_review_rows(GUILD_ID)) == records
+
+def test_json_review_log_rotates_monthly_and_skips_segments_outside_the_range(tmp_path):
+    store = JsonStorage(str(tmp_path / "data"), rotate="month")
+    records = [dict(review_record(i), created_at=f"2025-{i // 10 + 1:02d}-15T12:00:00") for i in range(30)]
+    try:
+        for i in range(0, 30, 5):
+            store.append_review_rows(GUILD_ID, records[i:i + 5])
+        store.sync_review_logs()
+        files = sorted(name for name in os.listdir(tmp_path / "data" / str(GUILD_ID)) if name.startswith("review_results"))
+        assert files == ["review_results.0000.csv", "review_results.0001.csv", "review_results.0002.csv"]
+        assert list(store.iter_review_rows(GUILD_ID)) == records
+        # 期間外のセグメントは開かずに飛ばす
+        os.remove(tmp_path / "data" / str(GUILD_ID) / "review_results.0000.csv")
+        assert list(store.iter_review_rows(GUILD_ID, {"since": "2025-02-01"})) == records[10:]
+    finally:
+        store.close()
+
+@pytest.mark.parametrize("bb", ["sqlite"], indirect=True)
+def test_sqlite_schema_is_migrated_once(bb):
+    conn = sqlite3.connect(bb.SQLITE_PATH)
+    try:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == len(SQLITE_MIGRATIONS)
+    finally:
+        conn.close()
+    # 適用済みのデータベースを開き直しても移行し直さない
+    SqliteStorage(bb.SQLITE_PATH).close()
+
+def test_sqlite_opening_snapshot_is_written_only_for_balances_older_than_the_ledger(tmp_path):
+    store = SqliteStorage(str(tmp_path / "budgetbot.sqlite3"))
+    try:
+        def snapshot_seqs(guild_id):
+            with store._lock:
+                return [row[0] for row in store._conn.execute("SELECT seq FROM budget_snapshots WHERE guild_id = ?", (guild_id,))]
+
+        # 台帳のテーブルを作る前からある残高は、番号0のスナップショットとして残す
+        store._transaction(lambda conn: conn.execute("INSERT INTO budgets (guild_id, name, amount) VALUES (?, ?, ?)", (GUILD_ID, BUDGET, 1000)))
+        assert store.load_guild(GUILD_ID)["budgets"] == {BUDGET: 1000}
+        assert snapshot_seqs(GUILD_ID) == [0]
+        assert replay_ledger(store, GUILD_ID) == ({BUDGET: 1000}, 0)
+
+        # 取引だけがある台帳には、読み込んだときの残高をスナップショットとして書かない
+        store.append_ledger(GUILD_ID + 1, [
+            {"seq": 1, "at": "2025-01-15T12:00:00", "budget": BUDGET, "delta": 700, "kind": "credit", "request_id": None, "actor": None}
+        ])
+        data = store.load_guild(GUILD_ID + 1)
+        assert (data["budgets"], data["ledger_seq"], data["ledger_snapshot_seq"]) == ({BUDGET: 700}, 1, 0)
+        assert snapshot_seqs(GUILD_ID + 1) == []
+    finally:
+        store.close()
+
+def test_json_data_is_migrated_to_sqlite(tmp_path):
+    source = JsonStorage(str(tmp_path / "data"))
+    source.append_ledger(GUILD_ID, [
+        {"seq": 1, "at": "2025-01-15T12:00:00", "budget": BUDGET, "delta": 1000, "kind": "credit", "request_id": None, "actor": None},
+        {"seq": 2, "at": "2025-01-15T12:00:00", "budget": "消耗品", "delta": 500, "kind": "credit", "request_id": None, "actor": None},
+        # 反映済みの申請IDは、読み込んだ後はメモリに残さない
+        {"seq": 3, "at": "2025-01-15T12:00:00", "budget": BUDGET, "delta": -200, "kind": "debit", "request_id": "ab", "actor": "member-2"}
+    ])
+    source.save_channels(GUILD_ID, [10, 11])
+    source.save_settings(GUILD_ID, {"additional_roles": [77], "no_overdraft": True})
+    pending = PendingRequest("cd", GUILD_ID, 3, "member-3", "", BUDGET, [RequestItem("部品", "", 100, 2)], "2025-01-15 12:00:00")
+    source.save_pending_request(GUILD_ID, "cd", pending.to_json())
+    source.append_review_rows(GUILD_ID, [review_record(i) for i in range(3)])
+    expected = source.load_guild(GUILD_ID)
+    # 審査待ちの申請の概要は比べられる形にしてから比べる
+    expected_index = {request_id: expected.pop("pending_index").get(request_id).to_json() for request_id in expected["pending_requests"]}
+    assert expected["applied_requests"] == {}
+
+    db_path = str(tmp_path / "migrated.sqlite3")
+    migrate_json_to_sqlite(source.data_dir, db_path)
+    target = SqliteStorage(db_path)
+    try:
+        migrated = target.load_guild(GUILD_ID)
+        migrated_index = migrated.pop("pending_index")
+        assert migrated == expected
+        assert {request_id: migrated_index.get(request_id).to_json() for request_id in migrated_index} == expected_index
+        assert list(target.iter_review_rows(GUILD_ID)) == list(source.iter_review_rows(GUILD_ID))
+        assert target.load_pending_request(GUILD_ID, "cd").to_json() == pending.to_json()
+    finally:
+        target.close()
+    # 移行済みのデータベースには --force なしでは書き込まない
+    source.append_review_rows(GUILD_ID, [review_record(3)])
+    migrate_json_to_sqlite(source.data_dir, db_path)
+    target = SqliteStorage(db_path)
+    try:
+        assert len(list(target.iter_review_rows(GUILD_ID))) == 3
+    finally:
+        target.close()
+
+def test_forced_migration_replaces_review_rows_instead_of_duplicating_them(tmp_path):
+    source = JsonStorage(str(tmp_path / "data"))
+    source.append_review_rows(GUILD_ID, [review_record(i) for i in range(3)])
+    db_path = str(tmp_path / "migrated.sqlite3")
+    migrate_json_to_sqlite(source.data_dir, db_path)
+    source.append_review_rows(GUILD_ID, [review_record(3)])
+    # 移行し直すたびに、データベースの審査記録はJSONの記録と同じ行になる
+    for _ in range(2):
+        migrate_json_to_sqlite(source.data_dir, db_path, force=True)
+        target = SqliteStorage(db_path)
+        try:
+            assert list(target.iter_review_rows(GUILD_ID)) == list(source.iter_review_rows(GUILD_ID))
+        finally:
+            target.close()
+
+def read_tree(path: str) -> dict:
+    files = {}
+    for root, _, names in os.walk(path):
+        for name in names:
+            with open(os.path.join(root, name), "rb") as f:
+                files[os.path.relpath(os.path.join(root, name), path)] = f.read()
+    return files
+
+def test_migration_does_not_modify_the_json_data(tmp_path):
+    source = JsonStorage(str(tmp_path / "data"))
+    for request_id in ("ab", "cd"):
+        pending = PendingRequest(request_id, GUILD_ID, 3, "member-3", "", BUDGET, [RequestItem("部品", "", 100)], "2025-01-15 12:00:00")
+        source.save_pending_request(GUILD_ID, request_id, pending.to_json())
+    guild_dir = tmp_path / "data" / str(GUILD_ID)
+    # 以前の形式のファイル: 台帳より前の budgets.json、反映済みの申請の記録、概要の一覧がない審査待ちの申請
+    os.remove(guild_dir / PENDING_INDEX_FILE)
+    (guild_dir / BUDGET_FILE).write_text('{"備品": 1000}', encoding="utf-8")
+    (guild_dir / APPLIED_REQUESTS_FILE).write_text('{"request_id": "ab", "applied_at": "2025-01-15 12:00:00"}\n', encoding="utf-8")
+    before = read_tree(source.data_dir)
+
+    db_path = str(tmp_path / "migrated.sqlite3")
+    migrate_json_to_sqlite(source.data_dir, db_path)
+    assert read_tree(source.data_dir) == before
+    target = SqliteStorage(db_path)
+    try:
+        migrated = target.load_guild(GUILD_ID)
+        assert migrated["budgets"] == {BUDGET: 1000}
+        assert list(migrated["pending_requests"]) == ["cd"]
+    finally:
+        target.close()
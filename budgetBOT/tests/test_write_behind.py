@@ -0,0 +1,158 @@
+"""変更をまとめて書き出すキューと、審査記録の一括追記を確かめる"""
+import asyncio
+import threading
+
+from write_behind import ReviewLogWriter, WriteBehindQueue
+
+def test_repeated_changes_to_the_same_key_are_written_once_with_the_latest_data():
+    written = []
+    flushed = []
+
+    async def scenario():
+        queue = WriteBehindQueue(0, flushed.append)
+        state = {"balance": 0}
+        for balance in range(100):
+            state["balance"] = balance
+            queue.mark_dirty((1, "budgets"), lambda: dict(state), written.append)
+        queue.mark_dirty((1, "settings"), lambda: {"no_overdraft": True}, written.append)
+        queue.mark_dirty((2, "budgets"), lambda: {"balance": -1}, written.append)
+        await queue.drain()
+
+    asyncio.run(scenario())
+    assert sorted(written, key=str) == sorted([{"balance": 99}, {"no_overdraft": True}, {"balance": -1}], key=str)
+    # 書き出しの通知はサーバーごとに1回
+    assert sorted(flushed) == [1, 2]
+
+def test_writer_runs_off_the_event_loop_and_on_written_runs_on_it():
+    threads = {}
+
+    def writer(data):
+        threads["writer"] = threading.current_thread()
+        return data * 2
+
+    async def scenario():
+        queue = WriteBehindQueue(0)
+        queue.mark_dirty((1, "ledger"), lambda: 21, writer, lambda result: threads.update(loop=threading.current_thread(), result=result))
+        await queue.drain()
+
+    asyncio.run(scenario())
+    assert threads["writer"] is not threading.main_thread()
+    assert threads["loop"] is threading.main_thread()
+    assert threads["result"] == 42
+
+def test_failed_write_is_retried_unless_a_newer_change_is_queued():
+    attempts = []
+
+    def flaky_writer(data):
+        attempts.append(data)
+        if len(attempts) == 1:
+            raise OSError("disk full")
+
+    async def scenario():
+        queue = WriteBehindQueue(0)
+        queue.mark_dirty((1, "budgets"), lambda: "v1", flaky_writer)
+        await queue.flush()
+        assert queue.pending_guilds() == {1}
+        await queue.drain()
+        assert queue.pending_guilds() == set()
+
+    asyncio.run(scenario())
+    assert attempts == ["v1", "v1"]
+
+def test_newer_change_replaces_a_failed_write():
+    attempts = []
+
+    def flaky_writer(data):
+        attempts.append(data)
+        if len(attempts) == 1:
+            raise OSError("disk full")
+
+    async def scenario():
+        queue = WriteBehindQueue(0)
+        queue.mark_dirty((1, "budgets"), lambda: "v1", flaky_writer)
+        flush = asyncio.create_task(queue.flush())
+        await asyncio.sleep(0)
+        # 書き込み中に新しい変更が予約されたら、失敗した古い内容は書き直さない
+        queue.mark_dirty((1, "budgets"), lambda: "v2", flaky_writer)
+        await flush
+        await queue.drain()
+
+    asyncio.run(scenario())
+    assert attempts == ["v1", "v2"]
+
+class MemoryReviewStore:
+    """審査記録を追記するだけの保存先。fail_guilds のサーバーへの追記は失敗させる"""
+
+    def __init__(self, fail_guilds=()):
+        self.rows = {}
+        self.fail_guilds = set(fail_guilds)
+        self.syncs = 0
+        self.batches = 0
+        self.threads = set()
+
+    def append_review_rows(self, guild_id: int, records: list):
+        if guild_id in self.fail_guilds:
+            raise OSError("disk full")
+        self.batches += 1
+        self.threads.add(threading.current_thread())
+        self.rows.setdefault(guild_id, []).extend(records)
+
+    def sync_review_logs(self):
+        self.syncs += 1
+
+def test_failed_snapshot_keeps_its_change_and_does_not_block_other_keys():
+    written = []
+    attempts = []
+
+    def flaky_snapshot():
+        attempts.append(None)
+        if len(attempts) == 1:
+            raise KeyError("budgets")
+        return "v1"
+
+    async def scenario():
+        queue = WriteBehindQueue(0)
+        queue.mark_dirty((1, "budgets"), flaky_snapshot, written.append)
+        queue.mark_dirty((2, "budgets"), lambda: "other", written.append)
+        await queue.flush()
+        # 取り出せなかった変更は予約のまま残り、書き込み中として止まらない
+        assert written == ["other"]
+        assert queue.is_pending((1, "budgets")) and not queue._inflight
+        await queue.drain()
+        assert queue.pending_guilds() == set()
+
+    asyncio.run(scenario())
+    assert written == ["other", "v1"]
+
+def test_review_log_rows_are_appended_in_batches_on_one_thread():
+    store = MemoryReviewStore()
+
+    async def scenario():
+        writer = ReviewLogWriter(store, 0.05, 1000, "batch", 1.0)
+        writer.start()
+        for i in range(500):
+            writer.append(1 + i % 2, [{"n": i}])
+        await asyncio.sleep(0.2)
+        await writer.drain()
+
+    asyncio.run(scenario())
+    assert store.rows[1] == [{"n": i} for i in range(0, 500, 2)]
+    assert store.rows[2] == [{"n": i} for i in range(1, 500, 2)]
+    # 500件をサーバーごとに1回ずつの追記で書き込む
+    assert store.batches == 2
+    assert len(store.threads) == 1 and threading.main_thread() not in store.threads
+    assert store.syncs >= 1
+
+def test_failed_review_log_append_keeps_rows_in_order():
+    store = MemoryReviewStore(fail_guilds=[1])
+
+    async def scenario():
+        writer = ReviewLogWriter(store, 0, 1000, "none", 1.0)
+        writer.append(1, [{"n": 0}])
+        await writer.flush()
+        writer.append(1, [{"n": 1}])
+        store.fail_guilds.clear()
+        await writer.drain()
+
+    asyncio.run(scenario())
+    assert store.rows[1] == [{"n": 0}, {"n": 1}]
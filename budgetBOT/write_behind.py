@@ -0,0 +1,234 @@
+"""変更をメモリにためておき、バックグラウンドでまとめて書き出すキュー
+
+WriteBehindQueue はサーバーのデータ (台帳・設定・審査待ちの申請など)、ReviewLogWriter は審査記録の追記を受け持つ。
+どちらもスナップショットを取る間は paused() で書き込みを止められる。
+"""
+import asyncio
+import contextlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+
+# --- Write-behind Persistence ---
+
+DRAIN_MAX_ROUNDS = 100
+
+class WriteBehindQueue:
+    """変更のあったデータを記録しておき、バックグラウンドでまとめてスレッドプール上に書き出す。
+    on_flushed を渡すと、書き出しが終わるたびに書き出したサーバーのIDを渡して呼ぶ"""
+
+    def __init__(self, delay: float, on_flushed=None):
+        self.delay = delay
+        self.on_flushed = on_flushed
+        self._dirty = {}
+        self._inflight = set()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def mark_dirty(self, key: tuple, snapshot, writer, on_written=None):
+        """書き込みを予約する。フラッシュ時にイベントループ上でsnapshot()を呼んでデータを取り出し、
+        writer(data)をスレッドプールで実行する。同じkeyへの予約は最新のものだけが書き出される。
+        on_writtenを渡すと、書き込みが終わった後にイベントループ上でwriterの戻り値を渡して呼ぶ。"""
+        self._dirty[key] = (snapshot, writer, on_written)
+        self._wakeup.set()
+
+    def pending_count(self) -> int:
+        return len(self._dirty) + len(self._inflight)
+
+    def is_pending(self, key: tuple) -> bool:
+        return key in self._dirty or key in self._inflight
+
+    def pending_guilds(self) -> set:
+        """未書き込み・書き込み中のデータがあるサーバーIDの集合"""
+        return {key[0] for key in self._dirty} | {key[0] for key in self._inflight}
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            await asyncio.sleep(self.delay)
+            await self.flush()
+            if self._dirty:
+                self._wakeup.set()
+
+    async def flush(self):
+        """予約済みの書き込みを実行する。書き込み中のkeyは次回に回す。"""
+        async with self._flush_lock:
+            await self._flush()
+
+    @contextlib.asynccontextmanager
+    async def paused(self):
+        """書き込み中のものが終わるのを待ち、抜けるまで書き込みを止める (スナップショット用)"""
+        async with self._flush_lock:
+            yield
+
+    async def _flush(self):
+        loop = asyncio.get_running_loop()
+        jobs = []
+        guild_ids = set()
+        for key in [key for key in self._dirty if key not in self._inflight]:
+            snapshot, writer, on_written = self._dirty.pop(key)
+            # 書き込み中の印を付ける前にデータを取り出す (失敗したkeyが書き込み中のまま残らないように)
+            try:
+                data = snapshot()
+            except Exception as e:
+                print(f"Failed to snapshot {key}: {e}")
+                # 予約は残して次回に取り出し直し、ほかのkeyの書き込みは続ける
+                self._dirty.setdefault(key, (snapshot, writer, on_written))
+                continue
+            self._inflight.add(key)
+            guild_ids.add(key[0])
+            jobs.append(self._write(loop, key, data, writer, on_written))
+        if jobs:
+            await asyncio.gather(*jobs)
+        # 件数の多いサーバーで書き込みごとに知らせないよう、サーバーごとに1回にまとめる
+        if self.on_flushed is not None:
+            for guild_id in guild_ids:
+                self.on_flushed(guild_id)
+
+    async def _write(self, loop, key: tuple, data, writer, on_written):
+        started = time.perf_counter()
+        try:
+            result = await loop.run_in_executor(None, writer, data)
+            metrics.observe("budgetbot_storage_seconds", time.perf_counter() - started, operation=f"save_{key[1]}")
+        except Exception as e:
+            print(f"Failed to persist {key}: {e}")
+            # より新しい変更が予約されていなければ、同じ内容で再試行する
+            self._dirty.setdefault(key, (lambda: data, writer, on_written))
+            self._wakeup.set()
+        else:
+            # サーバーのデータはイベントループ上でだけ書き換える
+            if on_written is not None:
+                on_written(result)
+        finally:
+            self._inflight.discard(key)
+
+    async def drain(self):
+        """未書き込みのデータをすべて書き出してからバックグラウンドタスクを止める"""
+        for _ in range(DRAIN_MAX_ROUNDS):
+            if not (self._dirty or self._inflight):
+                break
+            await self.flush()
+            if self._dirty or self._inflight:
+                await asyncio.sleep(0.05)
+        if self._dirty:
+            print(f"Gave up persisting {len(self._dirty)} pending writes on shutdown.")
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+# --- Review Log Writer ---
+
+class ReviewLogWriter:
+    """審査記録をメモリにためておき、専用スレッドで store にまとめて追記する。
+    on_appended を渡すと、追記が終わるたびに (サーバーID, 審査記録, 書き込んだ位置) を渡して呼ぶ"""
+
+    def __init__(self, store, batch_delay: float, batch_max_rows: int, fsync_policy: str, fsync_interval: float, on_appended=None):
+        self.store = store
+        self.on_appended = on_appended
+        self.batch_delay = batch_delay
+        self.batch_max_rows = batch_max_rows
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self._buffers = {}
+        self._buffered_rows = 0
+        self._unsynced = False
+        self._last_sync = time.monotonic()
+        self._wakeup = asyncio.Event()
+        # ファイルハンドルを1つのスレッドからだけ触るよう、専用のスレッドで書き込む
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="review-log")
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    @property
+    def buffered_rows(self) -> int:
+        return self._buffered_rows
+
+    def append(self, guild_id: int, records: list):
+        self._buffers.setdefault(guild_id, []).extend(records)
+        self._buffered_rows += len(records)
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        timeout = self.fsync_interval if self.fsync_policy == "interval" else None
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if 0 < self._buffered_rows < self.batch_max_rows:
+                await asyncio.sleep(self.batch_delay)
+            # 終了時にキャンセルされても書き込み途中の分は最後まで処理させる
+            await asyncio.shield(self.flush())
+
+    async def flush(self, force_sync: bool = False):
+        """たまっている審査記録を書き込み、fsyncの設定に従ってディスクに同期する"""
+        async with self._flush_lock:
+            await self._flush(force_sync)
+
+    @contextlib.asynccontextmanager
+    async def paused(self):
+        """書き込み中のものが終わるのを待ち、抜けるまで追記を止める (スナップショット用)"""
+        async with self._flush_lock:
+            yield
+
+    async def _flush(self, force_sync: bool):
+        batches, self._buffers, self._buffered_rows = self._buffers, {}, 0
+        if batches:
+            self._unsynced = True
+        sync = self._unsynced and (
+            force_sync
+            or self.fsync_policy == "batch"
+            or (self.fsync_policy == "interval" and time.monotonic() - self._last_sync >= self.fsync_interval)
+        )
+        if not batches and not sync:
+            return
+        started = time.perf_counter()
+        failed, written = await asyncio.get_running_loop().run_in_executor(self._executor, self._write, batches, sync)
+        metrics.observe("budgetbot_storage_seconds", time.perf_counter() - started, operation="append_review_log")
+        if self.on_appended is not None:
+            for guild_id, locators in written.items():
+                self.on_appended(guild_id, batches[guild_id], locators)
+        if sync:
+            self._unsynced = False
+            self._last_sync = time.monotonic()
+        # 書き込めなかった分は次回に回す (後から追加された分より前に戻す)
+        for guild_id, records in failed.items():
+            self._buffers[guild_id] = records + self._buffers.get(guild_id, [])
+            self._buffered_rows += len(records)
+        if failed:
+            self._wakeup.set()
+
+    def _write(self, batches: dict, sync: bool):
+        """(書き込めなかった分, 書き込めた分の位置) を返す"""
+        failed = {}
+        written = {}
+        for guild_id, records in batches.items():
+            try:
+                written[guild_id] = self.store.append_review_rows(guild_id, records)
+            except Exception as e:
+                print(f"Failed to append review log for guild {guild_id}: {e}")
+                failed[guild_id] = records
+        if sync:
+            self.store.sync_review_logs()
+        return failed, written
+
+    async def drain(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush(force_sync=True)
+        if self._buffered_rows:
+            print(f"Gave up appending {self._buffered_rows} review log rows on shutdown.")
+        self._executor.shutdown(wait=True)